@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark the time and memory used by IceCharts
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark the time and memory used by IceCharts - making the STAC items as the charts are made or read from the
+database, against making them only when they are used
+
+Usage:
+  bench_charts [-n COUNT]
+
+Options:
+  -n COUNT   number of charts [default: 100000]
+
+"""
+import os
+import sys
+import json
+import time
+import tracemalloc
+import pystac
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from icechart import IceChart  # noqa: E402
+from stackdb import StackDB, item_row  # noqa: E402
+from bench_stackdb import synthetic_charts  # noqa: E402
+
+
+def eager_name(name, href):
+    """ a chart with its STAC item, as from_name made them before the items were lazy """
+    chart = IceChart.from_name(name, href)
+    chart.tostac()
+    return chart
+
+
+def eager_row(row):
+    """ a chart from a database row, parsing the STAC item as update_geometry did before from_row """
+    r = dict(row)
+    r['stac'] = pystac.Item.from_dict(json.loads(r['stac']))
+    return IceChart(r)
+
+
+def parsed(rows):
+    """ item_row rows with their STAC JSON parsed, charts read back from the database keep the compact text from
+    the stac_items view while the eager ones are written out again by pystac """
+    return [row[:6] + (json.loads(row[6]),) + row[7:] for row in rows]
+
+
+def measured(func, args, sample=10000):
+    """ call func for each of args, returns the seconds taken, the bytes of memory per result, and the results
+    the memory is measured in a separate run of the first sample args, as tracing it slows everything down """
+    start = time.perf_counter()
+    results = [func(*arg) for arg in args]
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    kept = [func(*arg) for arg in args[:sample]]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, memory / len(kept), results
+
+
+def report(task, count, eager, lazy):
+    print('{0:>14}  eager: {1:6.2f}s {2:6.0f} bytes/chart   lazy: {3:6.2f}s {4:6.0f} bytes/chart   '
+          'speedup {5:.1f}x'.format(task, eager[0], eager[1], lazy[0], lazy[1], eager[0] / lazy[0]))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    count = int(arguments['-n'])
+    names = [(chart.name, chart.href) for chart in synthetic_charts(count)]
+
+    eager = measured(eager_name, names)
+    lazy = measured(IceChart.from_name, names)
+    report('from_name', count, eager, lazy)
+
+    eager_rows = measured(item_row, [(chart,) for chart in eager[2]])
+    lazy_rows = measured(item_row, [(chart,) for chart in lazy[2]])
+    assert eager_rows[2] == lazy_rows[2]
+    report('item_row', count, eager_rows, lazy_rows)
+
+    db = StackDB()
+    db.add_items(lazy[2])
+    rows = [(row,) for row in db.get_items()]
+    eager = measured(eager_row, rows)
+    lazy = measured(IceChart.from_row, rows)
+    report('from_row', count, eager, lazy)
+    eager_rows = measured(item_row, [(chart,) for chart in eager[2]])
+    lazy_rows = measured(item_row, [(chart,) for chart in lazy[2]])
+    assert parsed(eager_rows[2]) == parsed(lazy_rows[2])
+    report('item_row again', count, eager_rows, lazy_rows)
+    db.close()
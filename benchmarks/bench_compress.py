@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark compressing the STAC items in the database
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark a database with and without its STAC items compressed: the time to add the charts, the size of the
+database, the time to read all of the items, and the time to write them as a STAC catalog
+
+Usage:
+  bench_compress [-n COUNT] [-e EXACT] [-p POINTS]
+
+Options:
+  -n COUNT    number of charts [default: 10000]
+  -e EXACT    one chart in this many has exact geometry of its own [default: 10]
+  -p POINTS   number of points in the outline of a chart with exact geometry [default: 200]
+
+"""
+import os
+import sys
+import time
+import tempfile
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from stackdb import StackDB  # noqa: E402
+from catseaice import save_catalog  # noqa: E402
+from bench_stackdb import synthetic_charts  # noqa: E402
+from bench_dbsize import outline  # noqa: E402
+
+
+def measure(tmpdir, charts, compress):
+    """ the seconds to add the charts, the size of the database, and the seconds to scan it and write the catalog
+    compress is 'off', 'new' to compress the empty database, or 'existing' to compress it once the charts are added """
+    dbname = os.path.join(tmpdir, compress + '.sqlite')
+    db = StackDB(dbname)
+    if compress == 'new':
+        db.compress()
+    start = time.perf_counter()
+    db.add_items(charts)
+    added = time.perf_counter() - start
+    if compress == 'existing':
+        db.compress()
+    db.query('VACUUM;')
+    size = os.path.getsize(dbname)
+
+    start = time.perf_counter()
+    assert sum(1 for stac in db.iter_stac_items()) == len(charts)
+    scanned = time.perf_counter() - start
+    db.close()
+
+    start = time.perf_counter()
+    save_catalog(dbname, root_href=os.path.join(tmpdir, compress))
+    written = time.perf_counter() - start
+    return added, size, scanned, written
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    count, exact, points = int(arguments['-n']), int(arguments['-e']), int(arguments['-p'])
+    charts = synthetic_charts(count)
+    for i, chart in enumerate(charts[::exact]):
+        geometry = outline(i, points)
+        chart.set_geometry({'crs': chart.stac.properties['proj:wkt2'], 'bbox': [-65, 55, -55, 65], 'geometry': geometry,
+                            'pbbox': [-65, 55, -55, 65], 'pgeometry': geometry})
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # save_catalog prints its progress
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        for compress in ('off', 'new', 'existing'):
+            results[compress] = measure(tmpdir, charts, compress)
+        sys.stdout = stdout
+
+    print('{0} charts, 1 in {1} with exact geometry of {2} points'.format(count, exact, points))
+    for compress, (added, size, scanned, written) in results.items():
+        print('  compression {0:>8}:  add {1:6.2f}s   size {2:7.2f} MB   scan {3:6.2f}s   write {4:7.2f}s'.format(
+            compress, added, size / 1e6, scanned, written))
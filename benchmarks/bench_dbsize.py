@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark the size of the database
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark the size of a database, and the time to read all of its STAC items, before and after it is updated
+from schema version 2, with the whole STAC item in each row, to the current schema
+
+Usage:
+  bench_dbsize [-n COUNT] [-e EXACT] [-p POINTS]
+
+Options:
+  -n COUNT    number of charts [default: 100000]
+  -e EXACT    one chart in this many has exact geometry of its own [default: 10]
+  -p POINTS   number of points in the outline of a chart with exact geometry [default: 200]
+
+"""
+import os
+import sys
+import math
+import time
+import sqlite3
+import tempfile
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from stackdb import StackDB, MIGRATIONS, item_row  # noqa: E402
+from bench_stackdb import synthetic_charts  # noqa: E402
+
+
+def outline(i, points):
+    """ a polygon geometry with points vertices, different for each i """
+    ring = [[round(-60 + i % 1000 / 100 + 5 * math.cos(2 * math.pi * k / points), 6),
+             round(60 + 5 * math.sin(2 * math.pi * k / points), 6)] for k in range(points)]
+    return {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+
+
+def version2(dbname, charts):
+    """ make a database with schema version 2 holding charts """
+    conn = sqlite3.connect(dbname)
+    for migration in MIGRATIONS[:2]:
+        migration(conn.cursor())
+    conn.execute('PRAGMA user_version = 2;')
+    conn.executemany('INSERT INTO items (name, href, source, region, epoch, format, stac, exactgeo)'
+                     ' VALUES(?,?,?,?,?,?,?,?);', (item_row(chart) for chart in charts))
+    conn.commit()
+    conn.execute('VACUUM;')
+    conn.close()
+
+
+def scan(conn, table):
+    """ seconds to read the STAC items of every chart, and the characters read """
+    start = time.perf_counter()
+    size = sum(len(row[0]) for row in conn.execute('SELECT stac FROM {0};'.format(table)))
+    elapsed = time.perf_counter() - start
+    return elapsed, size
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    count, exact, points = int(arguments['-n']), int(arguments['-e']), int(arguments['-p'])
+    charts = synthetic_charts(count)
+    for i, chart in enumerate(charts[::exact]):
+        geometry = outline(i, points)
+        chart.set_geometry({'crs': chart.stac.properties['proj:wkt2'], 'bbox': [-65, 55, -55, 65], 'geometry': geometry,
+                            'pbbox': [-65, 55, -55, 65], 'pgeometry': geometry})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbname = os.path.join(tmpdir, 'bench.sqlite')
+        version2(dbname, charts)
+        before = os.path.getsize(dbname)
+        conn = sqlite3.connect(dbname)
+        scanned = scan(conn, 'items')
+        conn.close()
+
+        start = time.perf_counter()
+        StackDB(dbname).close()
+        updated = time.perf_counter() - start
+        after = os.path.getsize(dbname)
+        # the stac_items view needs the SQL functions a StackDB connection has, such as inflate
+        with StackDB(dbname) as db:
+            rescanned = scan(db.conn, 'stac_items')
+
+    print('{0} charts, 1 in {1} with exact geometry of {2} points, updated in {3:.1f}s'.format(
+        count, exact, points, updated))
+    print('  size  before: {0:8.1f} MB   after: {1:8.1f} MB   {2:.0%} of the size'.format(
+        before / 1e6, after / 1e6, after / before))
+    print('  scan  before: {0:8.2f}s     after: {1:8.2f}s     {2:.1f} MB of JSON before, {3:.1f} MB after'.format(
+        scanned[0], rescanned[0], scanned[1] / 1e6, rescanned[1] / 1e6))
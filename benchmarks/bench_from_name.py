@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark making IceCharts from their names
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark making the STAC items of IceCharts - sharing or copying the template dicts against StacTemplate
+
+Usage:
+  bench_from_name [-n COUNT]
+
+Options:
+  -n COUNT   number of charts to make [default: 100000]
+
+"""
+import os
+import sys
+import json
+import time
+import tracemalloc
+from copy import deepcopy
+import pystac
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from icechart import IceChart, CIS_STAC  # noqa: E402
+from stackdb import item_row  # noqa: E402
+from bench_stackdb import synthetic_charts  # noqa: E402
+
+
+class SharedChart(IceChart):
+    """ the way STAC items were made before StacTemplate - every item holds the template dicts themselves """
+
+    def tostac(self):
+        bplate = CIS_STAC[self.region]
+        self.stac = pystac.Item(id=self.name, geometry=bplate['geometry'], bbox=bplate['bbox'], datetime=self.epoch,
+                                properties=bplate['properties'], stac_extensions=bplate['stac_extensions'])
+        self.stac.properties['region'] = self.region
+        self.stac.add_asset(key='data', asset=pystac.Asset(href=self.href, media_type='x-gis/x-shapefile'))
+
+
+class CopiedChart(SharedChart):
+    """ the simple fix - every item gets a deep copy of the template """
+
+    def tostac(self):
+        bplate = deepcopy(CIS_STAC[self.region])
+        self.stac = pystac.Item(id=self.name, geometry=bplate['geometry'], bbox=bplate['bbox'], datetime=self.epoch,
+                                properties=bplate['properties'], stac_extensions=bplate['stac_extensions'])
+        self.stac.properties['region'] = self.region
+        self.stac.add_asset(key='data', asset=pystac.Asset(href=self.href, media_type='x-gis/x-shapefile'))
+
+
+def made(cls, name, href):
+    """ a chart with its STAC item made from the template """
+    chart = cls.from_name(name, href)
+    chart.tostac()
+    return chart
+
+
+def timed(cls, names, repeat=3):
+    """ make a chart for each name, and then a database row for each chart, returns the best times of repeat runs """
+    t_make, t_rows = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        charts = [made(cls, name, href) for name, href in names]
+        t_make.append(time.perf_counter() - start)
+        # give the first chart its exact geometry, with a shared template every other chart of its region gets it too
+        charts[0].set_geometry({'crs': 'EXACT', 'bbox': [0, 0, 1, 1], 'pbbox': [0, 0, 1, 1],
+                                'geometry': None, 'pgeometry': None})
+        start = time.perf_counter()
+        rows = [item_row(chart) for chart in charts]
+        t_rows.append(time.perf_counter() - start)
+    return min(t_make), min(t_rows), rows
+
+
+def allocated(cls, names):
+    """ the memory used by the charts """
+    tracemalloc.start()
+    charts = [made(cls, name, href) for name, href in names]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory / len(charts)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    count = int(arguments['-n'])
+    names = [(chart.name, chart.href) for chart in synthetic_charts(count)]
+    # SharedChart goes last, as it changes the templates for everything that follows
+    for cls in (IceChart, CopiedChart, SharedChart):
+        t_make, t_rows, rows = timed(cls, names)
+        wrong = sum(json.loads(row[6])['properties']['proj:wkt2'] == 'EXACT' for row in rows[1:])
+        print('{0:>11}  from_name: {1:7.0f} charts/s   item_row: {2:7.0f} rows/s   {3:5.0f} bytes per chart   '
+              '{4} charts changed by another'.format(cls.__name__, count / t_make, count / t_rows,
+                                                     allocated(cls, names[:10000]), wrong))
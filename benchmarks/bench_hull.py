@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark streaming convex hulls against shapely
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark chart outlines - one big MultiPolygon convex hull against StreamingHull
+
+Usage:
+  bench_hull [-n COUNTS] [-v VERTICES]
+
+Options:
+  -n COUNTS     comma separated list of total vertex counts [default: 1000,10000,100000,1000000]
+  -v VERTICES   vertices in each polygon [default: 1000]
+
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+import fiona
+from fiona.crs import from_epsg
+from docopt import docopt
+from shapely.geometry import shape, MultiPolygon, mapping
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from geometry import StreamingHull  # noqa: E402
+
+
+def synthetic_shapefile(path, vertices, per_polygon):
+    """ write a shapefile of wiggly polygons scattered over a polar stereographic chart """
+    rnd = np.random.default_rng(1)
+    schema = {'geometry': 'Polygon', 'properties': {'id': 'int'}}
+    with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema, crs=from_epsg(3413)) as out:
+        for i in range(max(vertices // per_polygon, 1)):
+            centre = rnd.uniform(-3e6, 3e6, 2)
+            angles = np.linspace(0, 2 * np.pi, per_polygon, endpoint=False)
+            radii = rnd.uniform(1e4, 5e4, per_polygon)
+            ring = np.column_stack([centre[0] + radii * np.cos(angles), centre[1] + radii * np.sin(angles)])
+            out.write({'geometry': {'type': 'Polygon', 'coordinates': [ring.tolist() + ring[:1].tolist()]},
+                       'properties': {'id': i}})
+
+
+def multipolygon_hull(path):
+    with fiona.open(path) as fin:
+        return MultiPolygon([shape(f['geometry']) for f in fin]).convex_hull
+
+
+def streaming_hull(path):
+    hull = StreamingHull()
+    with fiona.open(path) as fin:
+        for f in fin:
+            hull.add_geometry(f['geometry'])
+    return hull.outline()
+
+
+def measure(func, path, results):
+    """ run in a fresh process so the peak memory belongs to func alone """
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    outline = func(path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    results.put((elapsed, peak, mapping(outline)))
+
+
+def run(func, path):
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    proc = ctx.Process(target=measure, args=(func, path, results))
+    proc.start()
+    result = results.get()
+    proc.join()
+    return result
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    per_polygon = int(arguments['-v'])
+    for count in [int(n) for n in arguments['-n'].split(',')]:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'chart.shp')
+            synthetic_shapefile(path, count, min(per_polygon, count))
+            t_multi, m_multi, g_multi = run(multipolygon_hull, path)
+            t_stream, m_stream, g_stream = run(streaming_hull, path)
+            assert g_multi == g_stream
+        print('{0:>8} vertices  MultiPolygon: {1:7.3f}s {2:7.1f} MB   StreamingHull: {3:7.3f}s {4:7.1f} MB   '
+              'speedup {5:.1f}x'.format(count, t_multi, m_multi / 1024, t_stream, m_stream / 1024, t_multi / t_stream))
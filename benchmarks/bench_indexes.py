@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark the indexes on the items table
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark the queries StackDB runs on the items table, with and without the indexes in ITEM_INDEXES
+
+Usage:
+  bench_indexes [-n COUNT] [-p PENDING]
+
+Options:
+  -n COUNT     number of charts [default: 500000]
+  -p PENDING   one chart in this many is waiting for exact geometry [default: 100]
+
+"""
+import os
+import sys
+import time
+import tempfile
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from stackdb import StackDB, ITEM_INDEXES  # noqa: E402
+from bench_stackdb import synthetic_charts  # noqa: E402
+
+
+def queries(db, source, region, year):
+    """ the queries to time, as a dict of name: function """
+    return {'getlast': lambda: db.getlast(source),
+            'known_names': lambda: len(db.known_names(source)),
+            'summary': lambda: db.summary()['Total Items'],
+            'get_stac_items year': lambda: len(db.get_stac_items(source, region, year)),
+            'count pending': lambda: db.count_items(exactgeo='False'),
+            'first pending chunk': lambda: len(list(zip(range(500), db.iter_items(exactgeo='False')))),
+            'all pending': lambda: len(list(db.iter_items(exactgeo='False')))}
+
+
+def timed(func, repeat=3):
+    """ best of repeat runs of func, in seconds, and its result """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best, result
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    count = int(arguments['-n'])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = StackDB(os.path.join(tmpdir, 'bench.sqlite'))
+        start = time.perf_counter()
+        db.add_items(synthetic_charts(count))
+        db.query('UPDATE items SET exactgeo = (rowid % ? != 0);', (int(arguments['-p']),))
+        db.conn.commit()
+        print('made {0} charts in {1:.1f}s'.format(count, time.perf_counter() - start))
+        row = db.query('SELECT source, region, epoch FROM items ORDER BY rowid LIMIT 1 OFFSET ?;', (count // 2,),
+                       fetch=True)[0]
+        tasks = queries(db, row[0], row[1], row[2].year)
+
+        for name in ITEM_INDEXES:
+            db.query('DROP INDEX {0};'.format(name))
+        without = {name: timed(func) for name, func in tasks.items()}
+
+        start = time.perf_counter()
+        db.create_tables()
+        print('made the indexes in {0:.1f}s'.format(time.perf_counter() - start))
+        indexed = {name: timed(func) for name, func in tasks.items()}
+
+        for name in tasks:
+            assert without[name][1] == indexed[name][1]
+            print('{0:>20}  without: {1:8.4f}s   indexed: {2:8.4f}s   speedup {3:6.1f}x'.format(
+                name, without[name][0], indexed[name][0], without[name][0] / indexed[name][0]))
+        db.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark parsing chart names
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark getting the source, region, date and format of charts from their names - the old string splitting and
+dateutil parsing against parse_name and parse_names
+
+Usage:
+  bench_names [-n COUNT] [-s SAMPLE]
+
+Options:
+  -n COUNT    number of names to parse [default: 1000000]
+  -s SAMPLE   number of names to parse the old way, which is much slower [default: 50000]
+
+"""
+import os
+import sys
+import time
+import datetime
+from dateutil.parser import parse
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from icechart import CIS_AOI, FORMATS, FMT_UNK, parse_name, parse_names  # noqa: E402
+
+NIC_QUERY = 'DownloadProduct?products=%2Fweekly%2F{0}%2F{1}%2Fshapefiles%2Fhemispheric&fName={2}'
+
+
+def synthetic_names(count):
+    """ count chart names in each of the styles used by the archives, for consecutive weeks from 1990 to 2020 """
+    day = datetime.datetime(1990, 1, 1)
+    names = []
+    for i in range(count):
+        week = day + datetime.timedelta(weeks=i // 6 % 1560)
+        kind = i % 6
+        if kind < 2:
+            aoi = 'a{0:02d}'.format(9 + i % 5)
+            ext = 'e00' if kind else 'zip'
+            names.append('rgc_{0}_{1:%Y%m%d}_CEXPR{2}.{3}'.format(aoi, week, CIS_AOI[aoi][:2].upper(), ext))
+        elif kind == 2:
+            names.append('cisarctic{0:%Y%m%d}.zip'.format(week))
+        elif kind == 3:
+            names.append('nic_arctic_{0:%Y%m%d}_pl_a.zip'.format(week))
+        else:
+            region = ('arctic', 'antarc')[kind - 4]
+            names.append(NIC_QUERY.format(region, week.year, '{0}{1:%y%m%d}.zip'.format(region, week)))
+    return names
+
+
+def dateutil_parse(fname):
+    """ the way names were parsed before parse_name, from IceChart.unpack_name """
+    fpart, ext = os.path.splitext(fname.lower())
+    if '=' in fpart:
+        fx = fpart.split('=')
+        fpart = fx[len(fx) - 1]
+    fmt = FORMATS.get(ext, FMT_UNK)
+    if 'rgc' == fpart[:3] or 'cis' == fpart[:3]:
+        if '_' in fpart:
+            cpts = fpart.split('_')
+            return {'source': 'CIS', 'region': CIS_AOI[cpts[1]],
+                    'epoch': datetime.datetime.strptime(cpts[2], "%Y%m%d"), 'format': fmt}
+        return {'source': 'CIS', 'region': 'arctic', 'epoch': datetime.datetime.strptime(fpart[-8:], "%Y%m%d"),
+                'format': fmt}
+    region = 'antarctic' if 'antarc' in fpart else 'arctic'
+    cpts = fpart.split('_')
+    if len(cpts) == 5:
+        epoch = datetime.datetime.strptime(cpts[2], "%Y%m%d")
+    else:
+        epoch = parse(fpart, fuzzy_with_tokens=True, yearfirst=True)[0]
+    return {'source': 'NIC', 'region': region, 'epoch': epoch, 'format': fmt}
+
+
+def rate(func, names):
+    start = time.perf_counter()
+    result = func(names)
+    return len(names) / (time.perf_counter() - start), result
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    names = synthetic_names(int(arguments['-n']))
+    sample = names[:int(arguments['-s'])]
+    r_old, old = rate(lambda names: [dateutil_parse(name) for name in names], sample)
+    r_one, one = rate(lambda names: [parse_name(name) for name in names], names)
+    r_batch, batch = rate(parse_names, names)
+    assert old == one[:len(sample)] and one == batch
+    print('{0} names   dateutil: {1:.0f} names/s   parse_name: {2:.0f} names/s   parse_names: {3:.0f} names/s   '
+          'speedup {4:.0f}x'.format(len(names), r_old, r_one, r_batch, r_batch / r_old))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark transforming chart outlines to lat/long
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark transforming chart outlines to lat/long - shapely.ops.transform a point at a time against outline_geometry
+
+Usage:
+  bench_outline [-n HULLS] [-v VERTICES]
+
+Options:
+  -n HULLS      number of outlines to transform [default: 2000]
+  -v VERTICES   points used to make each outline [default: 200]
+
+"""
+import os
+import sys
+import time
+import numpy as np
+import pyproj
+from docopt import docopt
+from shapely.geometry import MultiPoint, Point, mapping
+from shapely.ops import transform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from geometry import projections, outline_geometry  # noqa: E402
+
+
+def synthetic_outlines(count, vertices):
+    """ convex outlines in polar stereographic metres, half of them around the north pole """
+    rnd = np.random.default_rng(1)
+    outlines = []
+    for i in range(count):
+        centre = [0, 0] if i % 2 else rnd.uniform(-3e6, 3e6, 2)
+        pts = rnd.normal(scale=5e5, size=(vertices, 2)) + centre
+        outlines.append(MultiPoint(pts.tolist()).convex_hull)
+    return outlines
+
+
+def shapely_outline(outline, projection, crs_wkt):
+    """ the way outlines were transformed before outline_geometry """
+    to_wgs84 = projection.to_wgs84.transform
+    outlinepts_wgs84 = transform(to_wgs84, MultiPoint(list(outline.exterior.coords)))
+    outline_wgs84 = None
+    for pole, pole_p in ((90, projection.northpole), (-90, projection.southpole)):
+        if outline.contains(pole_p):
+            tpts = list(outlinepts_wgs84.geoms) + [Point(-179.9999, pole), Point(0, pole), Point(179.9999, pole)]
+            outline_wgs84 = MultiPoint(tpts).convex_hull
+            break
+    if outline_wgs84 is None:
+        outline_wgs84 = transform(to_wgs84, outline)
+    return {'crs': crs_wkt, 'pbbox': list(outline.bounds), 'bbox': list(outline_wgs84.bounds),
+            'pgeometry': mapping(outline), 'geometry': mapping(outline_wgs84)}
+
+
+def timed(func, outlines, projection, wkt):
+    start = time.perf_counter()
+    results = [func(outline, projection, wkt) for outline in outlines]
+    return time.perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    wkt = pyproj.CRS('EPSG:3413').to_wkt()
+    projection = projections.get(wkt)
+    outlines = synthetic_outlines(int(arguments['-n']), int(arguments['-v']))
+    vertices = sum(len(o.exterior.coords) for o in outlines)
+    t_shapely, r_shapely = timed(shapely_outline, outlines, projection, wkt)
+    t_numpy, r_numpy = timed(outline_geometry, outlines, projection, wkt)
+    assert r_shapely == r_numpy
+    print('{0} outlines, {1} vertices   shapely.ops.transform: {2:.3f}s   outline_geometry: {3:.3f}s   '
+          'speedup {4:.1f}x'.format(len(outlines), vertices, t_shapely, t_numpy, t_shapely / t_numpy))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark reading all of the items from the database
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark the time and peak memory used to read every item in the database - get_items and get_stac_items
+reading all of the rows at once, against iter_items and iter_stac_items reading them a chunk at a time
+
+Usage:
+  bench_scan [-n COUNTS] [-c CHUNK]
+
+Options:
+  -n COUNTS   comma separated list of chart counts [default: 10000,100000]
+  -c CHUNK    rows read at a time by the iter_ methods [default: 500]
+
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from icechart import IceChart  # noqa: E402
+from stackdb import StackDB  # noqa: E402
+from bench_stackdb import synthetic_charts  # noqa: E402
+
+
+def scan(rows):
+    """ the kind of work update_geometry and make_collection do with each row, without the downloads """
+    size = 0
+    for row in rows:
+        chart = IceChart.from_row(row) if type(row) is not str else None
+        size += len(chart.to_json() if chart else row)
+    return size
+
+
+def measured(func):
+    """ returns the seconds taken by func, and the peak memory it used in a second, traced, run """
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    assert func() == result
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def report(task, count, listed, streamed):
+    print('{0:>7} {1:>16}  list: {2:6.2f}s {3:8.1f} MB   iter: {4:6.2f}s {5:8.1f} MB'.format(
+        count, task, listed[0], listed[1] / 1e6, streamed[0], streamed[1] / 1e6))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    chunk = int(arguments['-c'])
+    for count in [int(n) for n in arguments['-n'].split(',')]:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = StackDB(os.path.join(tmpdir, 'bench.sqlite'))
+            db.add_items(synthetic_charts(count))
+
+            listed = measured(lambda: scan(db.get_items()))
+            streamed = measured(lambda: scan(db.iter_items(chunk=chunk)))
+            assert listed[2] == streamed[2]
+            report('items', count, listed, streamed)
+
+            listed = measured(lambda: scan(row[0] for row in db.get_stac_items()))
+            streamed = measured(lambda: scan(db.iter_stac_items(chunk=chunk)))
+            assert listed[2] == streamed[2]
+            report('stac items', count, listed, streamed)
+            db.close()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Benchmark StackDB per-row and batched inserts
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+"""Benchmark StackDB inserts
+
+Usage:
+  bench_stackdb [-n COUNTS] [-b BATCH]
+
+Options:
+  -n COUNTS   comma separated list of chart counts [default: 10000,100000]
+  -b BATCH    batch size for add_items [default: 500]
+
+"""
+import os
+import sys
+import time
+import datetime
+import tempfile
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from icechart import IceChart, CIS_AOI  # noqa: E402
+from stackdb import StackDB  # noqa: E402
+
+
+def synthetic_charts(count):
+    """ make count unique CIS charts, cycling through the regions on consecutive days """
+    day = datetime.datetime(1900, 1, 1)
+    aois = list(CIS_AOI.keys())
+    charts = []
+    for i in range(count):
+        aoi = aois[i % len(aois)]
+        name = 'rgc_{0}_{1}_CEXPRXX'.format(aoi, (day + datetime.timedelta(days=i // len(aois))).strftime('%Y%m%d'))
+        charts.append(IceChart.from_name(name, 'https://example.com/' + name + '.zip'))
+    return charts
+
+
+def timed(func, charts):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = StackDB(os.path.join(tmpdir, 'bench.sqlite'))
+        start = time.perf_counter()
+        func(db, charts)
+        elapsed = time.perf_counter() - start
+        assert db.summary()['Total Items'] == len(charts)
+        db.close()
+    return elapsed
+
+
+def per_row(db, charts):
+    for chart in charts:
+        db.add_item(chart)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    batch_size = int(arguments['-b'])
+    for count in [int(n) for n in arguments['-n'].split(',')]:
+        charts = synthetic_charts(count)
+        t_row = timed(per_row, charts)
+        t_batch = timed(lambda db, c: db.add_items(c, batch_size=batch_size), charts)
+        print('{0:>8} charts  add_item: {1:10.0f} rows/s   add_items: {2:10.0f} rows/s   speedup {3:.1f}x'.format(
+            count, count / t_row, count / t_batch, t_row / t_batch))
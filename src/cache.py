@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Local caches for downloaded ice chart files
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+import os
+import json
+import hashlib
+import tempfile
+import requests
+
+# environment variables used to configure the default download cache, so worker processes share the same cache
+CACHE_DIR_ENV = 'CATSEAICE_CACHE'
+CACHE_SIZE_ENV = 'CATSEAICE_CACHE_MB'
+DEFAULT_CACHE_MB = 10240
+# how long (seconds) a cached response that can still change is used before it is checked again
+RESPONSE_TTL = 6 * 60 * 60
+CHUNK_SIZE = 1024 * 1024
+# seconds to wait for a server to connect, or to send the next part of a response
+TIMEOUT = 60
+# eviction removes files until the cache is this fraction of max_bytes, so it doesn't run again on the next download
+EVICT_TO = 0.9
+
+
+def _key(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _atomic_write(path: str, data: bytes):
+    """ write a file so that readers see either the old or the new contents, never a partial file """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+class DownloadCache:
+    """ an on-disk cache of downloaded files
+    files are stored by the hash of their content, with an index from each href to its file and the ETag and
+    Last-Modified headers the server sent.  Cached files are revalidated with a conditional request, so an
+    unchanged file is never downloaded twice.  When the cache grows past max_bytes the least recently used files
+    are removed """
+
+    def __init__(self, root: str, max_bytes: int = DEFAULT_CACHE_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blobdir = os.path.join(root, 'blobs')
+        self.indexdir = os.path.join(root, 'index')
+        os.makedirs(self.blobdir, exist_ok=True)
+        os.makedirs(self.indexdir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        # the size of the files in the cache as of the last evict, and those stored since, see evict
+        self.total = None
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blobdir, digest)
+
+    def lookup(self, href: str):
+        """ return the index entry for href, or None if it is not cached """
+        try:
+            with open(os.path.join(self.indexdir, _key(href) + '.json')) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(self.blob_path(entry['sha256'])):
+            return None
+        return entry
+
+    def fetch(self, href: str, session=requests):
+        """ return the path of a local copy of href, downloading it if needed, or None if it cannot be had
+        the path must be treated as read only """
+        entry = self.lookup(href)
+        if entry and not entry.get('etag') and not entry.get('last_modified'):
+            # nothing to revalidate with - archived charts don't change, so trust the copy we have
+            path = self._hit(entry)
+            if path:
+                return path
+            entry = None
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            r = session.get(href, headers=headers, stream=True, timeout=TIMEOUT)
+        except requests.RequestException:
+            # serve a stale copy rather than nothing
+            return self._hit(entry) if entry else None
+        with r:
+            if entry and r.status_code == 304:
+                path = self._hit(entry)
+                if path:
+                    return path
+                # removed since we looked, perhaps by another process sharing the cache, download it again
+                return self.fetch(href, session)
+            if r.status_code != 200:
+                return None
+            path, size = self._store(href, r)
+        self.misses += 1
+        if self.total is not None:
+            self.total += size
+        if self.total is None or self.total > self.max_bytes:
+            self.evict(keep=path)
+        return path
+
+    def _hit(self, entry: dict):
+        """ the path of a cached file that was used, or None if it has been removed """
+        path = self.blob_path(entry['sha256'])
+        try:
+            # the modification time of a file records when it was last used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self.hits += 1
+        return path
+
+    def _store(self, href: str, r) -> (str, int):
+        """ save the body of response r under the hash of its content, and index it by href
+        returns the path and size of the file """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmpname = tempfile.mkstemp(dir=self.blobdir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            path = self.blob_path(digest.hexdigest())
+            os.replace(tmpname, path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        entry = {'href': href, 'sha256': digest.hexdigest(), 'size': size,
+                 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+        _atomic_write(os.path.join(self.indexdir, _key(href) + '.json'), json.dumps(entry).encode('utf-8'))
+        return path, size
+
+    def evict(self, keep: str = None):
+        """ remove the least recently used files until the cache is no bigger than EVICT_TO of max_bytes,
+        except keep, the file that was just stored. fetch keeps a running total of the size of the cache, and only
+        looks through all of the files when that is past max_bytes (or it has no total yet) """
+        blobs = []
+        total = 0
+        with os.scandir(self.blobdir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                blobs.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        blobs.sort()
+        if total > self.max_bytes:
+            for mtime, size, path in blobs:
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+        self.total = total
+
+    def stats(self) -> dict:
+        """ return a dict of statistics for the cache """
+        files = [e for e in os.scandir(self.blobdir) if not e.name.startswith('.tmp')]
+        return {'Hits': self.hits, 'Misses': self.misses, 'Files': len(files),
+                'Bytes': sum(e.stat().st_size for e in files)}
+
+
+class MemoryResponseCache:
+    """ keeps the text of web responses, such as search results, in memory
+    entries are dicts with the response text, its ETag and Last-Modified headers, the time it was stored, and whether
+    it is permanent.  Entries that are not permanent are fresh for ttl seconds, after that they are revalidated
+    other stores only need to provide the same get and put methods """
+
+    def __init__(self, ttl: float = RESPONSE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def put(self, key: str, entry: dict):
+        self.entries[key] = entry
+
+
+class FileResponseCache(MemoryResponseCache):
+    """ keeps the text of web responses in a folder, so they can be reused by later runs """
+
+    def __init__(self, root: str, ttl: float = RESPONSE_TTL):
+        super().__init__(ttl)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, key: str):
+        try:
+            with open(os.path.join(self.root, key + '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, entry: dict):
+        _atomic_write(os.path.join(self.root, key + '.json'), json.dumps(entry).encode('utf-8'))
+
+
+def response_key(url: str, payload: dict) -> str:
+    """ the cache key for a form submission """
+    return _key(url + '?' + json.dumps(payload, sort_keys=True))
+
+
+_download_cache = None
+
+
+def get_download_cache():
+    """ return the cache configured by the CATSEAICE_CACHE environment variable, or None if it is not set """
+    global _download_cache
+    root = os.environ.get(CACHE_DIR_ENV)
+    if not root:
+        return None
+    if _download_cache is None or _download_cache.root != root:
+        size = int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_MB))
+        _download_cache = DownloadCache(root, size * 1024 * 1024)
+    return _download_cache
+
+
+def get_response_cache():
+    """ return a cache for web responses in the folder named by the CATSEAICE_CACHE environment variable,
+    or None if it is not set """
+    root = os.environ.get(CACHE_DIR_ENV)
+    if not root:
+        return None
+    return FileResponseCache(os.path.join(root, 'responses'))
@@ -31,7 +31,7 @@
 """Create STAC Catalogs of Ice Charts
 
 Usage:
-  catseaice fill [-A | -S YYYY-MM-DD] [-e | -E] [-d DBNAME]
+  catseaice fill [-A | -S YYYY-MM-DD] [-e | -E] [-b] [-R] [-z] [-w WORKERS] [-c CACHEDIR] [-d DBNAME]
   catseaice report [-d DBNAME]
   catseaice write BASE_HREF [-t CTYPE] [-d DBNAME]
   catseaice (-h | --help)
@@ -45,6 +45,12 @@ Options:
   -A            Search for all available icecharts (otherwise just update the database)
   -e            Calculate exact geometry for all newly discovered charts  (not usually required)
   -E            Calculate exact geometry for each chart in the database (not usually required)
+  -b            With -e or -E, only read the bounding box from each chart (much faster, the geometry is the box),
+                and with -E the charts that already have a bounding box are skipped
+  -R            With -e or -E, reuse geometry from earlier runs without checking whether the charts have changed
+  -z            Compress the charts stored in the database (several times smaller), later runs keep compressing
+  -w WORKERS    number of worker processes used to calculate exact geometry, default is one per cpu
+  -c CACHEDIR   keep downloaded charts and search results in this folder so they are only downloaded once
   -d DBNAME     name of the database to use [default: icecharts.sqlite]
   BASE_HREF     root folder/url of output STAC catalog, default is the current directory [default: ...]
   -t CTYPE      STAC catalog type [default: SELF_CONTAINED]
@@ -53,81 +59,101 @@ Options:
 """
 
 import os
+import sys
+from functools import partial
 from docopt import docopt
-import json
 import datetime
 import pytz
 import pprint
 import pystac
-from icechart import IceChart
+from icechart import compute_geometry
 from stackdb import StackDB
-from scrapers import gogetcisdata, gogetnicdata
+from scrapers import gogetcisdata, gogetnicdata, KnownCharts, KNOWN_RUN
+from geoengine import process_geometry
+from pipeline import run_pipeline, DiscoveryError
 from utility import biggest_bbox
+from cache import CACHE_DIR_ENV
 
 DBNAME = 'icecharts.sqlite'
 STARTDATE = '1968-06-25'
 
 
-def fill_database(dbname=DBNAME, startdate=STARTDATE, update=True, exactgeo=False):
+def fill_database(dbname=DBNAME, startdate=STARTDATE, update=True, exactgeo=False, workers=None, mode='hull',
+                  revalidate=True, compress=False):
     """ create a database and fill it with all available ice charts from startdate to the present
-     if update is True, only search for data later than the latest date in the database """
+     if update is True, only search for data later than the latest date in the database
+     if exactgeo is True, compute the exact geometry of the new charts using workers processes
+     (mode is 'hull' for the chart outline, or 'bbox' for just the bounding box, see IceChart.exact_geometry)
+     geometry is kept in the database and only computed again for charts that have changed on the server,
+     or if revalidate is False it is reused without asking the server
+     if compress is True the database is compressed, see StackDB.compress
+     the NIC and CIS sites are searched at the same time, and charts are stored as they are found
+     raises DiscoveryError if a site could not be searched, once what was found on the others is stored """
     print("Using database {0}".format(os.path.abspath(dbname)))
     if update:
         print("Update from most recent records ")
     sdate = datetime.datetime.strptime(startdate, '%Y-%m-%d')
     db = StackDB(dbname)
-    if update:
-        lastdate = db.getlast('NIC')
-        if lastdate is not None:
-            nicfiles = gogetnicdata(startyear=lastdate.year, startmonth=lastdate.month, startday=lastdate.day+1)
-        else:
-            nicfiles = gogetnicdata(startyear=sdate.year, startmonth=sdate.month, startday=sdate.day)
-    else:
-        nicfiles = gogetnicdata(startyear=sdate.year, startmonth=sdate.month, startday=sdate.day)
-    print("Adding or Updating {0} NIC files".format(len(nicfiles)))
-    for nic in nicfiles:
-        chart = IceChart.from_name(nic[0], nic[1])
-        print(chart.epoch.isoformat())
-        if exactgeo:
-            chart.exact_geometry()
-        db.add_item(chart)
-    # commit the changes in case we get interrupted
-    db.conn.commit()
+    if compress:
+        db.compress()
+    starts = {}
+    known = {}
+    for source in ('NIC', 'CIS'):
+        lastdate = db.getlast(source) if update else None
+        starts[source] = lastdate + datetime.timedelta(days=1) if lastdate is not None else sdate
+        # skip charts we already have, and when updating stop searching once we only find those
+        known[source] = KnownCharts(db.known_names(source), stop_after=KNOWN_RUN if update else 0)
 
-    if update:
-        lastdate = db.getlast('CIS')
-        if lastdate is not None:
-            cisfiles = gogetcisdata(startyear=lastdate.year, startmonth=lastdate.month, startday=lastdate.day+1,
-                                    storefunc=db.add_item_from_name)
-        else:
-            cisfiles = gogetcisdata(startyear=sdate.year, startmonth=sdate.month, startday=sdate.day,
-                                    storefunc=db.add_item_from_name)
-    else:
-        cisfiles = gogetcisdata(startyear=sdate.year, startmonth=sdate.month, startday=sdate.day,
-                                storefunc=db.add_item_from_name)
-    print("Adding or Updating {0} CIS files".format(len(cisfiles)))
-    # for cis in cisfiles:
-    #     chart = IceChart.from_name(cis[0], cis[1])
-    #     print(chart.epoch.isoformat())
-    #     if exactgeo:
-    #         chart.exact_geometry()
-    #     db.add_item(chart)
+    sources = {'NIC': lambda store: gogetnicdata(startyear=starts['NIC'].year, startmonth=starts['NIC'].month,
+                                                 startday=starts['NIC'].day, storefunc=store, known=known['NIC']),
+               'CIS': lambda store: gogetcisdata(startyear=starts['CIS'].year, startmonth=starts['CIS'].month,
+                                                 startday=starts['CIS'].day, storefunc=store, known=known['CIS'])}
+    charts = []
+    # the batch is committed on exit in case we get interrupted
+    with db.batch() as batch:
+
+        def store(chart):
+            print(chart.name, chart.epoch.isoformat())
+            batch.add(chart)
+            if exactgeo:
+                charts.append(chart)
+
+        try:
+            stats = run_pipeline(sources, store)
+            failed = None
+        except DiscoveryError as e:
+            # the charts that were found are still stored, and their geometry computed
+            stats, failed = e.stats, e
+    print("Added or Updated {0} NIC files and {1} CIS files in {2:.1f}s".format(
+        stats['NIC'], stats['CIS'], stats['Seconds']))
+    print("Skipped {0} NIC files and {1} CIS files already in the database".format(
+        known['NIC'].skipped, known['CIS'].skipped))
+
+    if exactgeo:
+        with db.batch() as batch:
+            process_geometry(charts, batch.add, workers=workers, geofunc=partial(compute_geometry, mode=mode),
+                             geocache=db.geometry_cache(mode, batch), revalidate=revalidate)
 
     db.close()
+    if failed:
+        raise failed
 
 
-def update_geometry(dbname, source='Any', region='Any', epoch1='Any', epoch2='Any'):
-    """ download and analyze the source files to get accurate geometry """
+def update_geometry(dbname, source='Any', region='Any', epoch1='Any', epoch2='Any', workers=None, mode='hull',
+                    revalidate=True):
+    """ download and analyze the source files to get accurate geometry, mode and revalidate are as for fill_database """
     db = StackDB(dbname)
-    rows = db.get_items(source=source, region=region, epoch1=epoch1, epoch2=epoch2, exactgeo='False')
-    print("Getting exact geometry for {0} records".format(len(rows)))
-    for row in rows:
-        r = dict(row)
-        print(f"{r['name']}")
-        r['stac'] = pystac.Item.from_dict(json.loads(r['stac']))
-        chart = IceChart(dict(r))
-        chart.exact_geometry()
-        db.add_item(chart)
+    # the outline replaces a bounding box, but there's no point reading a bounding box again
+    selected = dict(source=source, region=region, epoch1=epoch1, epoch2=epoch2,
+                    exactgeo='None' if mode == 'bbox' else 'False')
+    print("Getting exact geometry for {0} records".format(db.count_items(**selected)))
+
+    # the items are read a chunk at a time as they are needed, and their stored STAC items are only parsed
+    # for the charts that get new geometry
+    charts = db.iter_items(**selected, charts=True)
+    with db.batch() as batch:
+        process_geometry(charts, batch.add, workers=workers, geofunc=partial(compute_geometry, mode=mode),
+                         geocache=db.geometry_cache(mode, batch), revalidate=revalidate)
     db.close()
 
 
@@ -142,10 +168,6 @@ def make_collection(dbs, source='NIC', region='arctic', year='All', root_href=''
         print('Please specify a database or database name')
         return
 
-    cis = db.get_stac_items(source=source, region=region, year=year)
-    if len(cis) < 1:
-        print('No data found for source {0}, region {1}, year {2}'.format(source, region, year))
-        return
     stacs = []
     spatial_extent = []
     mindate = datetime.datetime.now()
@@ -153,13 +175,15 @@ def make_collection(dbs, source='NIC', region='arctic', year='All', root_href=''
     # make the timestamp bounds offset aware so we can do comparisons
     mindate = mindate.replace(tzinfo=pytz.UTC)
     maxdate = maxdate.replace(tzinfo=pytz.UTC)
-    for cs in cis:
-        stac = pystac.stac_object_from_dict(json.loads(cs[0]))
+    for stac in db.iter_stac_items(source=source, region=region, year=year, decode=True):
         stacs.append(stac)
 
         mindate = stac.datetime if stac.datetime < mindate else mindate
         maxdate = stac.datetime if stac.datetime > maxdate else maxdate
         spatial_extent = biggest_bbox(spatial_extent, stac.bbox)
+    if len(stacs) < 1:
+        print('No data found for source {0}, region {1}, year {2}'.format(source, region, year))
+        return
 
     extent = pystac.Extent(spatial=pystac.pystac.SpatialExtent(bboxes=[spatial_extent]),
                            temporal=pystac.TemporalExtent([[mindate, maxdate]]))
@@ -175,38 +199,41 @@ def make_collection(dbs, source='NIC', region='arctic', year='All', root_href=''
 def save_catalog(dbname=DBNAME, catalog_type='SELF_CONTAINED', root_href=''):
     """ make a STAC catalog for all the data in the database, with collections organized by source, region, and year """
     db = StackDB(dbname)
-    summary = db.summary()
-
-    if summary['Total Items'] < 1:
-        print('No data to save')
-        db.close()
-        return
 
     # if we don't get a root reference, assume we will use the current directory
     if root_href == '':
         root_href = os.getcwd()
 
-    # the master catalog
-    catalog = pystac.Catalog('icecharts', 'Weekly Ice Charts from NIC and CIS', catalog_type=catalog_type)
-    for source in summary['Sources']:
-        print(source)
-        sroot_href = '/'.join([root_href, source])
-        srccat = pystac.Catalog(source + '-icecharts', 'Weekly icecharts from ' + source, catalog_type=catalog_type)
-        for region in summary[source + ' Regions']:
-            print(region)
-            rsroot_href = '/'.join([sroot_href, region])
-            rgncat = pystac.Catalog('-'.join([source, region, 'icecharts']).strip(), 'Weekly icecharts for ' + region,
-                                    catalog_type=catalog_type)
-            for yr in range(summary['{0} {1} Date Range'.format(source, region)][0],
-                            summary['{0} {1} Date Range'.format(source, region)][1]+1):
-                print(yr)
-                yrsroot_href = '/'.join([rsroot_href, str(yr)])
-                collid = ''.join([source, region, str(yr), 'icecharts']).strip()
-                coll = make_collection(db, source, region, str(yr), yrsroot_href, collid, 'Icecharts from ' + source)
-                if coll:
-                    rgncat.add_child(coll, title=collid)
-            srccat.add_child(rgncat)
-        catalog.add_child(srccat)
+    # the catalog is made from a snapshot of the database, so a fill running at the same time doesn't change it
+    with db.snapshot():
+        summary = db.summary()
+
+        # the master catalog
+        catalog = pystac.Catalog('icecharts', 'Weekly Ice Charts from NIC and CIS', catalog_type=catalog_type)
+        for source in summary['Sources']:
+            print(source)
+            sroot_href = '/'.join([root_href, source])
+            srccat = pystac.Catalog(source + '-icecharts', 'Weekly icecharts from ' + source, catalog_type=catalog_type)
+            for region in summary[source + ' Regions']:
+                print(region)
+                rsroot_href = '/'.join([sroot_href, region])
+                rgncat = pystac.Catalog('-'.join([source, region, 'icecharts']).strip(), 'Weekly icecharts for ' + region,
+                                        catalog_type=catalog_type)
+                for yr in range(summary['{0} {1} Date Range'.format(source, region)][0],
+                                summary['{0} {1} Date Range'.format(source, region)][1]+1):
+                    print(yr)
+                    yrsroot_href = '/'.join([rsroot_href, str(yr)])
+                    collid = ''.join([source, region, str(yr), 'icecharts']).strip()
+                    coll = make_collection(db, source, region, str(yr), yrsroot_href, collid, 'Icecharts from ' + source)
+                    if coll:
+                        rgncat.add_child(coll, title=collid)
+                srccat.add_child(rgncat)
+            catalog.add_child(srccat)
+
+    if summary['Total Items'] < 1:
+        print('No data to save')
+        db.close()
+        return
 
     catalog.normalize_and_save(root_href, catalog_type=catalog_type)
     db.close()
@@ -223,14 +250,27 @@ if __name__ == '__main__':
         quit()
 
     if arguments['fill']:
+        nworkers = int(arguments['-w']) if arguments['-w'] else None
+        mode = 'bbox' if arguments['-b'] else 'hull'
+        revalidate = not arguments['-R']
+        if arguments['-c']:
+            # set in the environment so the worker processes use the same cache
+            os.environ[CACHE_DIR_ENV] = arguments['-c']
         if arguments['-E']:
-            update_geometry(dbname=arguments['-d'])
-        if arguments['-S']:
-            fill_database(dbname=arguments['-d'], startdate=(arguments['-S']), update=False,
-                          exactgeo=(arguments['-e'] | arguments['-E']))
-        else:
-            fill_database(dbname=arguments['-d'], update=(not arguments['-A']),
-                          exactgeo=(arguments['-e'] | arguments['-E']))
+            update_geometry(dbname=arguments['-d'], workers=nworkers, mode=mode, revalidate=revalidate)
+        try:
+            if arguments['-S']:
+                fill_database(dbname=arguments['-d'], startdate=(arguments['-S']), update=False,
+                              exactgeo=(arguments['-e'] | arguments['-E']), workers=nworkers, mode=mode,
+                              revalidate=revalidate, compress=arguments['-z'])
+            else:
+                fill_database(dbname=arguments['-d'], update=(not arguments['-A']),
+                              exactgeo=(arguments['-e'] | arguments['-E']), workers=nworkers, mode=mode,
+                              revalidate=revalidate, compress=arguments['-z'])
+        except DiscoveryError as e:
+            # so a fill run from cron is seen to have failed
+            print(e)
+            sys.exit(1)
 
     if arguments['write']:
         if arguments['BASE_HREF'] is None:
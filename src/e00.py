@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Streaming reader for ArcInfo export (E00) files
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+import re
+import numpy as np
+from geometry import StreamingHull, projections, outline_geometry
+
+# the width of a number in single and double precision sections
+FIELD_WIDTH = {2: 14, 3: 21}
+# the start of the sections we read, everything else is skipped
+SECTION = re.compile(r'^(ARC|LAB|PRJ|EOS)(?:  (\d))?\s*$')
+
+# ArcInfo spheroid and unit names as proj parameters
+SPHEROIDS = {'CLARKE1866': '+ellps=clrk66', 'CLARKE1880': '+ellps=clrk80', 'GRS1980': '+ellps=GRS80',
+             'GRS80': '+ellps=GRS80', 'WGS84': '+ellps=WGS84', 'WGS72': '+ellps=WGS72', 'BESSEL': '+ellps=bessel',
+             'INTERNATIONAL1909': '+ellps=intl', 'INTERNATIONAL': '+ellps=intl', 'KRASOVSKY': '+ellps=krass',
+             'SPHERE': '+R=6370997'}
+DATUMS = {'NAD83': '+datum=NAD83', 'NAD27': '+datum=NAD27', 'WGS84': '+datum=WGS84'}
+DATUM_SPHEROIDS = {'NAD83': 'GRS1980', 'NAD27': 'CLARKE1866', 'WGS84': 'WGS84', 'WGS72': 'WGS72'}
+UNITS = {'METERS': '+units=m', 'FEET': '+units=us-ft'}
+# proj parameters in the order ArcInfo lists them, for each projection
+PROJ_PARAMETERS = {'LAMBERT': ('+proj=lcc', ('lat_1', 'lat_2', 'lon_0', 'lat_0', 'x_0', 'y_0')),
+                   'ALBERS': ('+proj=aea', ('lat_1', 'lat_2', 'lon_0', 'lat_0', 'x_0', 'y_0')),
+                   'POLAR': ('+proj=stere', ('lon_0', 'lat_ts', 'x_0', 'y_0')),
+                   'STEREOGRAPHIC': ('+proj=stere', ('lon_0', 'lat_0', 'x_0', 'y_0')),
+                   'TRANSVERSE': ('+proj=tmerc', ('k_0', 'lon_0', 'lat_0', 'x_0', 'y_0')),
+                   'GEOGRAPHIC': ('+proj=longlat', ())}
+
+
+class E00Error(ValueError):
+    """ an E00 file that can't be read """
+
+
+class E00Reader:
+    """ read the arcs, label points and projection of an ArcInfo export file a line at a time
+    the coordinates go straight into a StreamingHull, so memory use does not depend on the size of the file """
+
+    def __init__(self, hull: StreamingHull = None):
+        self.hull = hull if hull is not None else StreamingHull()
+        self.prj = []
+        self.arcs = 0
+        self.labels = 0
+
+    def read(self, lines):
+        """ read an iterable of lines (str), returns self """
+        lines = iter(lines)
+        first = next(lines, '')
+        if not first.startswith('EXP'):
+            raise E00Error('Not an E00 file')
+        if first.split()[1:2] != ['0']:
+            raise E00Error('Compressed E00 files are not supported')
+        for line in lines:
+            match = SECTION.match(line)
+            if match is None:
+                continue
+            section, precision = match.group(1), int(match.group(2) or 2)
+            if section == 'EOS':
+                break
+            if precision not in FIELD_WIDTH:
+                raise E00Error('Unknown precision in {0}'.format(line.strip()))
+            if section == 'ARC':
+                self._arcs(lines, FIELD_WIDTH[precision])
+            elif section == 'LAB':
+                self._labels(lines, FIELD_WIDTH[precision])
+            else:
+                self._prj(lines)
+        return self
+
+    @staticmethod
+    def _numbers(line, width):
+        """ split a line of fixed width numbers, they are not always separated by spaces """
+        line = line.rstrip('\r\n')
+        return [float(line[i:i + width]) for i in range(0, len(line) - width + 1, width)]
+
+    def _arcs(self, lines, width):
+        """ each arc is a line of 7 numbers ending with the number of vertices, then the vertices """
+        for line in lines:
+            header = line.split()
+            if not header:
+                continue
+            if len(header) < 7:
+                raise E00Error('Bad arc header {0}'.format(line.strip()))
+            if header[0] == '-1':
+                return
+            count = int(header[6])
+            coords = []
+            while len(coords) < 2 * count:
+                coords.extend(self._numbers(next(lines), width))
+            self.hull.add(np.array(coords[:2 * count]).reshape(count, 2))
+            self.arcs += 1
+        raise E00Error('Unexpected end of file in ARC section')
+
+    def _labels(self, lines, width):
+        """ each label is a line with its ids and position, then its bounding box on one or two lines """
+        for line in lines:
+            if not line.strip():
+                continue
+            if line.split()[:1] == ['-1']:
+                return
+            # coverage id and polygon id are 10 characters each
+            self.hull.add([self._numbers(line[20:], width)[:2]])
+            next(lines)
+            if width == FIELD_WIDTH[3]:
+                next(lines)
+            self.labels += 1
+        raise E00Error('Unexpected end of file in LAB section')
+
+    def _prj(self, lines):
+        for line in lines:
+            if line.startswith('EOP'):
+                return
+            self.prj.append(line.rstrip('\r\n'))
+        raise E00Error('Unexpected end of file in PRJ section')
+
+    def proj_string(self) -> str:
+        """ the projection as a proj string """
+        return prj_to_proj(self.prj)
+
+
+def _parameter(text):
+    """ an ArcInfo projection parameter, either a plain number or degrees minutes seconds """
+    values = text.split('/*')[0].split()
+    if len(values) == 3:
+        degrees, minutes, seconds = (float(v) for v in values)
+        sign = -1 if values[0].startswith('-') else 1
+        return sign * (abs(degrees) + minutes / 60 + seconds / 3600)
+    return float(values[0])
+
+
+def prj_to_proj(prj: list) -> str:
+    """ convert the lines of an ArcInfo PRJ section to a proj string """
+    keys = {}
+    parameters = []
+    in_parameters = False
+    for line in prj:
+        # each line of the original .prj file is followed by a ~
+        if line.strip() == '~':
+            continue
+        if in_parameters:
+            if line.split('/*')[0].strip():
+                parameters.append(_parameter(line))
+            continue
+        words = line.split()
+        if not words:
+            continue
+        if words[0].lower() == 'parameters':
+            in_parameters = True
+            continue
+        keys[words[0].lower()] = words[1].upper() if len(words) > 1 else ''
+
+    projection = keys.get('projection')
+    if projection == 'UTM':
+        zone = int(keys.get('zone', '0'))
+        proj = ['+proj=utm', '+zone={0}'.format(abs(zone))] + (['+south'] if zone < 0 else [])
+    elif projection in PROJ_PARAMETERS:
+        proj = [PROJ_PARAMETERS[projection][0]]
+        names = PROJ_PARAMETERS[projection][1]
+        if len(parameters) < len(names) - 2:
+            raise E00Error('Not enough parameters for {0} projection'.format(projection))
+        proj += ['+{0}={1!r}'.format(n, v) for n, v in zip(names, parameters)]
+        if projection == 'POLAR':
+            proj.append('+lat_0={0}'.format(90 if parameters[1] >= 0 else -90))
+    else:
+        raise E00Error('Unsupported projection {0}'.format(projection))
+
+    spheroid = keys.get('spheroid') or DATUM_SPHEROIDS.get(keys.get('datum'), 'WGS84')
+    if keys.get('datum') in DATUMS:
+        proj.append(DATUMS[keys['datum']])
+    elif spheroid in SPHEROIDS:
+        proj.append(SPHEROIDS[spheroid])
+    else:
+        raise E00Error('Unsupported spheroid {0}'.format(spheroid))
+    if projection != 'GEOGRAPHIC':
+        proj.append(UNITS.get(keys.get('units'), '+units=m'))
+    return ' '.join(proj + ['+no_defs'])
+
+
+def e00_geometry(lines) -> dict:
+    """ read an E00 file from an iterable of lines and get its bounding box and outline geometry
+    returns the same dict as utility.extract_bbox_shape """
+    reader = E00Reader().read(lines)
+    if reader.hull.points == 0:
+        raise E00Error('No arcs or label points found')
+    if not reader.prj:
+        raise E00Error('No projection found')
+    projection = projections.get(reader.proj_string())
+    return outline_geometry(reader.hull.outline(), projection, projection.wkt)
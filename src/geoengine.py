@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Compute exact geometry for many ice charts in parallel
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable
+from icechart import IceChart, compute_geometry, cached_geometry
+from cache import get_download_cache
+from utility import transfer
+from geometry import projections
+
+# how many charts each worker may have queued up at once, this bounds memory use when the input is large
+INFLIGHT_PER_WORKER = 2
+# how often (in charts) to print a progress report
+REPORT_EVERY = 100
+
+
+def _counters():
+    """ the download counters for this process """
+    counts = dict(transfer)
+    cache = get_download_cache()
+    counts['Cache Hits'], counts['Cache Misses'] = (cache.hits, cache.misses) if cache else (0, 0)
+    counts['Projection Hits'], counts['Projection Misses'] = projections.hits, projections.misses
+    return counts
+
+
+def _chart_geometry(geofunc, name, href, fmt, cached=None, validate=False):
+    """ run in a worker process - trap any error so one bad chart does not take down the whole run
+    if validate is True the validator of the chart is looked up so the geometry can be cached, and cached
+    (a (validator, geometry) tuple or None) is used instead of geofunc if the chart has not changed
+    returns the geometry, an error message, how much each counter changed for the chart, and the validator """
+    before = _counters()
+    validator, hit = None, False
+    try:
+        if validate:
+            geo, validator, hit = cached_geometry(name, href, fmt, cached, geofunc)
+        else:
+            geo = geofunc(name, href, fmt)
+        err = None
+    except Exception as e:
+        geo, err = None, '{0}: {1}'.format(type(e).__name__, e)
+    after = _counters()
+    counts = {k: after[k] - before[k] for k in after}
+    counts['Geometry Hits'], counts['Geometry Misses'] = (int(hit), int(not hit)) if validate else (0, 0)
+    return geo, err, counts, validator
+
+
+def process_geometry(charts: Iterable[IceChart], storefunc: Callable[[IceChart], None], workers: int = None,
+                     max_inflight: int = None, geofunc=compute_geometry, geocache=None, revalidate: bool = True) -> dict:
+    """ compute the exact geometry for a collection of charts using a pool of worker processes
+    downloading and analyzing happens in the workers, the results are applied and passed to storefunc
+    in this process only, so storefunc is the single writer to the database.
+    if geocache (a stackdb.GeometryCache) is given, charts that have not changed since their geometry was cached
+    are not downloaded, and new geometry is added to it. with revalidate False, cached geometry is used without
+    asking the server whether the chart has changed, so no requests are made for those charts at all.
+    charts whose geometry could not be computed are not passed to storefunc.
+    if workers is 0 everything runs in this process, if None one worker per cpu is used
+    returns a dict of statistics for the run """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_inflight is None:
+        max_inflight = max(workers, 1) * INFLIGHT_PER_WORKER
+
+    stats = {'Charts': 0, 'Updated': 0, 'Failed': 0, 'Cache Hits': 0, 'Cache Misses': 0, 'Bytes Read': 0,
+             'Bytes Saved': 0, 'Projection Hits': 0, 'Projection Misses': 0, 'Geometry Hits': 0, 'Geometry Misses': 0}
+    start = time.time()
+
+    def finish(chart, result):
+        geo, err, counts, validator = result
+        stats['Charts'] += 1
+        for key, count in counts.items():
+            stats[key] += count
+        if err:
+            stats['Failed'] += 1
+            print('Exact geometry failed for {0} - {1}'.format(chart.name, err))
+        elif geo:
+            if geocache is not None and validator and counts.get('Geometry Misses'):
+                geocache.put(chart.href, validator, geo)
+            chart.set_geometry(geo)
+            storefunc(chart)
+            stats['Updated'] += 1
+        if stats['Charts'] % REPORT_EVERY == 0:
+            print('Exact geometry for {0} charts, {1:.2f} charts/s'.format(
+                stats['Charts'], stats['Charts'] / (time.time() - start)))
+
+    def todo():
+        """ the charts that need a worker, with their cached geometry
+        charts whose cached geometry can be used without asking the server are finished here """
+        for chart in charts:
+            cached = geocache.get(chart.href) if geocache is not None else None
+            if cached is not None and not revalidate:
+                finish(chart, (cached[1], None, {'Geometry Hits': 1}, cached[0]))
+            else:
+                yield chart, cached
+
+    validate = geocache is not None
+    if workers < 1:
+        for chart, cached in todo():
+            finish(chart, _chart_geometry(geofunc, chart.name, chart.href, chart.format, cached, validate))
+    else:
+        pending = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chart, cached in todo():
+                while len(pending) >= max_inflight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        finish(pending.pop(fut), _result(fut))
+                fut = pool.submit(_chart_geometry, geofunc, chart.name, chart.href, chart.format, cached, validate)
+                pending[fut] = chart
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    finish(pending.pop(fut), _result(fut))
+
+    stats['Seconds'] = time.time() - start
+    stats['Charts/s'] = stats['Charts'] / stats['Seconds'] if stats['Seconds'] > 0 else 0.0
+    print('Exact geometry: {0} charts, {1} updated, {2} failed in {3:.1f}s ({4:.2f} charts/s)'.format(
+        stats['Charts'], stats['Updated'], stats['Failed'], stats['Seconds'], stats['Charts/s']))
+    if stats['Cache Hits'] or stats['Cache Misses']:
+        print('Download cache: {0} hits, {1} misses'.format(stats['Cache Hits'], stats['Cache Misses']))
+    if stats['Bytes Saved']:
+        print('Downloaded {0:.1f} MB, range requests saved {1:.1f} MB ({2:.0f} kB per chart)'.format(
+            stats['Bytes Read'] / 1e6, stats['Bytes Saved'] / 1e6, stats['Bytes Saved'] / 1e3 / stats['Charts']))
+    if stats['Geometry Hits'] or stats['Geometry Misses']:
+        print('Geometry cache: {0} reused, {1} computed'.format(stats['Geometry Hits'], stats['Geometry Misses']))
+    if stats['Projection Misses']:
+        print('Projections: {0} reused, {1} set up'.format(stats['Projection Hits'], stats['Projection Misses']))
+    return stats
+
+
+def _result(fut):
+    """ get the result of a finished future, treating a crashed worker like any other failure """
+    try:
+        return fut.result()
+    except Exception as e:
+        return None, '{0}: {1}'.format(type(e).__name__, e), {}, None
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Geometry helpers for computing chart outlines
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+import re
+import struct
+import numpy as np
+import pyproj
+from shapely.geometry import MultiPoint, Point, Polygon, box, mapping
+from shapely.ops import transform
+
+# points added at a pole when an outline covers it, so its lat/long outline reaches right across the pole
+POLE_LONGITUDES = (-179.9999, 0, 179.9999)
+# points along each edge of a bounding box when it is transformed, the edges are curves in lat/long
+EXTENT_POINTS = 50
+# the first 100 bytes of a .shp file, see the ESRI Shapefile Technical Description
+SHP_HEADER_SIZE = 100
+SHP_FILE_CODE = 9994
+# coordinates are buffered until there are this many, then reduced to the points that could be on the hull
+HULL_CHUNK = 65536
+
+
+def _octagon(pts):
+    """ the extreme points of pts in eight directions 45 degrees apart, in counter-clockwise order """
+    x, y = pts[:, 0], pts[:, 1]
+    idx = [np.argmax(x), np.argmax(x + y), np.argmax(y), np.argmax(y - x),
+           np.argmin(x), np.argmin(x + y), np.argmin(y), np.argmax(x - y)]
+    octagon = []
+    for i in idx:
+        if not octagon or (pts[i] != octagon[-1]).any():
+            octagon.append(pts[i])
+    if len(octagon) > 1 and (octagon[0] == octagon[-1]).all():
+        octagon.pop()
+    return octagon
+
+
+def _chain(points):
+    """ one half of a monotone chain hull, points must be sorted - collinear points are kept """
+    chain = []
+    for p in points:
+        while len(chain) >= 2 and ((chain[-1][0] - chain[-2][0]) * (p[1] - chain[-2][1]) -
+                                   (chain[-1][1] - chain[-2][1]) * (p[0] - chain[-2][0])) < 0:
+            chain.pop()
+        chain.append(p)
+    return chain
+
+
+def hull_points(pts: np.ndarray) -> np.ndarray:
+    """ the points of an (n, 2) array that could be vertices of its convex hull, in counter-clockwise order
+    points inside the octagon of extreme points are thrown away first (Akl-Toussaint), the rest go through
+    Andrew's monotone chain """
+    if len(pts) > 8:
+        octagon = _octagon(pts)
+        if len(octagon) > 2:
+            inside = np.ones(len(pts), dtype=bool)
+            for a, b in zip(octagon, octagon[1:] + octagon[:1]):
+                inside &= (b[0] - a[0]) * (pts[:, 1] - a[1]) - (b[1] - a[1]) * (pts[:, 0] - a[0]) > 0
+            pts = pts[~inside]
+    # sorts by x then y as well
+    pts = np.unique(pts, axis=0)
+    if len(pts) < 3:
+        return pts
+    points = pts.tolist()
+    lower = _chain(points)
+    upper = _chain(points[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+
+class StreamingHull:
+    """ the convex hull of a stream of coordinates
+    only the points that could be on the hull are kept between chunks, so memory use doesn't grow with the input """
+
+    def __init__(self, chunk: int = HULL_CHUNK):
+        self.chunk = chunk
+        self.candidates = np.empty((0, 2))
+        self.points = 0
+        self._pending = []
+        self._npending = 0
+
+    def add(self, coords):
+        """ add a sequence of (x, y) or (x, y, z) coordinates """
+        pts = np.asarray(coords, dtype=float)
+        if pts.size == 0:
+            return
+        pts = pts.reshape(len(pts), -1)[:, :2]
+        self._pending.append(pts)
+        self._npending += len(pts)
+        self.points += len(pts)
+        if self._npending >= self.chunk:
+            self._reduce()
+
+    def add_geometry(self, geometry):
+        """ add a GeoJSON-like Polygon or MultiPolygon, only the outer rings can be on the hull """
+        if geometry is None:
+            return
+        if geometry['type'] == 'Polygon':
+            self.add(geometry['coordinates'][0])
+        elif geometry['type'] == 'MultiPolygon':
+            for polygon in geometry['coordinates']:
+                self.add(polygon[0])
+        else:
+            raise ValueError('Unsupported geometry type {0}'.format(geometry['type']))
+
+    def _reduce(self):
+        if self._pending:
+            self.candidates = hull_points(np.vstack([self.candidates] + self._pending))
+            self._pending = []
+            self._npending = 0
+
+    def outline(self):
+        """ the convex hull as a shapely geometry, the same as shapely's convex_hull of all the points added """
+        self._reduce()
+        return MultiPoint(self.candidates.tolist()).convex_hull
+
+
+class Projection:
+    """ the transformations between a chart coordinate system and lat/long, and the poles in chart coordinates """
+
+    def __init__(self, crs):
+        wgs84 = pyproj.CRS('EPSG:4326')
+        self.crs = pyproj.CRS(crs)
+        self.wkt = self.crs.to_wkt()
+        self.to_wgs84 = pyproj.Transformer.from_crs(self.crs, wgs84, always_xy=True)
+        self.from_wgs84 = pyproj.Transformer.from_crs(wgs84, self.crs, always_xy=True)
+        self.northpole = transform(self.from_wgs84.transform, Point([0, 90]))
+        self.southpole = transform(self.from_wgs84.transform, Point([0, -90]))
+
+
+class ProjectionCache:
+    """ Projections keyed by the WKT of the chart coordinate system
+    setting up a projection is far slower than using it, and nearly all charts share a handful of coordinate systems.
+    each process has its own cache, worker processes forked after it is warmed up start with a copy """
+
+    def __init__(self):
+        self.projections = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(wkt: str) -> str:
+        return re.sub(r'\s+', ' ', wkt).strip()
+
+    def get(self, wkt: str, crs=None) -> Projection:
+        """ the projection for a coordinate system given as WKT
+        if crs is given (anything pyproj.CRS accepts) it is used to build the projection instead of the WKT """
+        # charts from the same source have exactly the same WKT, so try that before normalising it
+        projection = self.projections.get(wkt)
+        if projection is None:
+            key = self.key(wkt)
+            projection = self.projections.get(key)
+            if projection is None:
+                self.misses += 1
+                projection = Projection(crs if crs is not None else wkt)
+                self.projections[key] = projection
+                self.projections[wkt] = projection
+                return projection
+            self.projections[wkt] = projection
+        self.hits += 1
+        return projection
+
+
+# the cache for this process
+projections = ProjectionCache()
+
+
+def outline_geometry(outline: Polygon, projection: Projection, crs_wkt: str) -> dict:
+    """ transform a chart outline to lat/long, returns a dict containing the CRS of the original dataset,
+    the bounding box and geometry as GeoJSON in both projected and latlong coordinates
+    all the vertices are transformed in one call, working on arrays rather than shapely points """
+    xs, ys = np.asarray(outline.exterior.coords).T
+    lons, lats = projection.to_wgs84.transform(xs, ys)
+    # we treat the data differently if it covers one of the poles
+    pole = 90 if outline.contains(projection.northpole) else -90 if outline.contains(projection.southpole) else None
+    if pole is not None:
+        # add a few points at the pole, and take the convex hull of the lot
+        lons = np.concatenate([lons, POLE_LONGITUDES])
+        lats = np.concatenate([lats, [pole] * len(POLE_LONGITUDES)])
+        outline_wgs84 = MultiPoint(np.column_stack([lons, lats]).tolist()).convex_hull
+    else:
+        # if the pole isn't enclosed, we should be able to just transform the outline to lat/long
+        outline_wgs84 = Polygon(np.column_stack([lons, lats]))
+    # the bounds of a hull are the bounds of its points
+    return {'crs': crs_wkt,
+            'pbbox': list(outline.bounds),
+            'bbox': [float(lons.min()), float(lats.min()), float(lons.max()), float(lats.max())],
+            'pgeometry': mapping(outline),
+            'geometry': mapping(outline_wgs84)}
+
+
+def shp_header_bbox(header: bytes) -> list:
+    """ the bounding box of all the shapes in a shapefile, from the header of its .shp file """
+    if len(header) < SHP_HEADER_SIZE or struct.unpack('>i', header[:4])[0] != SHP_FILE_CODE:
+        raise ValueError('Not a shapefile header')
+    return list(struct.unpack('<4d', header[36:68]))
+
+
+def extent_geometry(pbbox: list, projection: Projection, crs_wkt: str, points: int = EXTENT_POINTS) -> dict:
+    """ transform a bounding box in chart coordinates to lat/long, giving the same dict as outline_geometry with
+    the box as the geometry. the edges are densified so the lat/long box covers their curves, and a box around a pole
+    reaches right across it. the dict is marked as not exact, since the box is bigger than the chart outline """
+    xmin, ymin, xmax, ymax = pbbox
+    step = np.linspace(0, 1, points, endpoint=False)
+    xs = np.concatenate([xmin + (xmax - xmin) * step, np.full(points, xmax), xmax - (xmax - xmin) * step,
+                         np.full(points, xmin)])
+    ys = np.concatenate([np.full(points, ymin), ymin + (ymax - ymin) * step, np.full(points, ymax),
+                         ymax - (ymax - ymin) * step])
+    result = outline_geometry(Polygon(np.column_stack([xs, ys])), projection, crs_wkt)
+    result['pbbox'] = list(pbbox)
+    result['pgeometry'] = mapping(box(*pbbox))
+    result['exact'] = False
+    return result
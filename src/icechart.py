@@ -29,11 +29,14 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 import os
+import re
+import json
 from datetime import datetime
 from dateutil.parser import parse
 import pystac
+from pystac.utils import datetime_to_str
 import stac_templates
-from utility import get_zipshape_bbox
+from utility import get_zipshape_bbox, get_zipshape_extent, get_e00_bbox, content_validator, download_validators
 
 CIS_AOI = {'a09': 'Hudson Bay',
            'a10': 'Western Arctic',
@@ -53,13 +56,109 @@ FMT_E00 = 'ESRI E00'
 FMT_SHP = 'ESRI SHAPEFILE'
 FMT_UNK = 'UNKNOWN'
 
+FORMATS = {'.e00': FMT_E00, '.zip': FMT_SHP}
+MEDIA_TYPES = {FMT_SHP: 'x-gis/x-shapefile', FMT_E00: 'application/x-ogc-avce00'}
+
+# the known kinds of chart names (lower case, without the extension) for each source, tried in order
+# the date group is YYYYMMDD, or YYMMDD for the NIC weekly charts
+NAME_PATTERNS = {
+    'CIS': (re.compile(r'(?:rgc|cis)_(?P<aoi>a\d\d)_(?P<date>\d{8})(?:_|$)'),   # rgc_a09_20201214_cexprhb
+            re.compile(r'(?:rgc|cis)[^_]*?(?P<date>\d{8})$')),                   # cisarctic20180712
+    'NIC': (re.compile(r'[^_]+_[^_]+_(?P<date>\d{8})_[^_]+_[^_]+$'),             # nic_arctic_20040301_pl_a
+            re.compile(r'(?:arctic|antarc)(?P<date>\d{6})(?:_|$)')),             # arctic180830, antarc070810_polygon
+}
+
+
+class FrozenArray(tuple):
+    """ a read only array of a STAC template that can be shared by all the items made from it
+    deepcopy (which pystac uses in to_dict) returns the array itself rather than copying every coordinate """
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _freeze(obj):
+    """ a copy of a json-like object with FrozenArrays in place of lists, so its arrays can be shared safely """
+    if isinstance(obj, dict):
+        return {key: _freeze(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return FrozenArray(_freeze(value) for value in obj)
+    return obj
+
+
+class StacTemplate:
+    """ the parts of a STAC item that are the same for every chart of a region, prepared once from a stac_templates
+    dict. items made from it share the (read only) coordinate arrays, but get their own properties and geometry
+    dicts, so setting a value on one item never changes another """
+
+    def __init__(self, plate: dict, region: str):
+        self.geometry = _freeze(plate['geometry'])
+        self.bbox = tuple(plate['bbox'])
+        self.properties = _freeze(dict(plate['properties'], region=region))
+        self.stac_extensions = tuple(plate['stac_extensions'])
+        # properties that are dicts themselves (proj:geometry) need their own copy too
+        self.nested = tuple(key for key, value in self.properties.items() if isinstance(value, dict))
+        # the JSON text of an item for each format, split where the id, datetime and href go
+        self.parts = {}
+
+    def item(self, name: str, epoch: datetime) -> pystac.Item:
+        """ a new STAC item for a chart """
+        properties = dict(self.properties)
+        for key in self.nested:
+            properties[key] = dict(properties[key])
+        return pystac.Item(id=name,
+                           geometry=dict(self.geometry),
+                           bbox=list(self.bbox),
+                           datetime=epoch,
+                           properties=properties,
+                           stac_extensions=list(self.stac_extensions))
+
+    def json(self, name: str, epoch: datetime, href: str, fmt: str) -> str:
+        """ the JSON text pystac writes for item(name, epoch) with a data asset, without making the item """
+        parts = self.parts.get(fmt)
+        if parts is None:
+            parts = self.parts[fmt] = self._split(fmt)
+        return ''.join((parts[0], json.dumps(name), parts[1], json.dumps(datetime_to_str(epoch)), parts[2],
+                        json.dumps(href), parts[3]))
+
+    def _split(self, fmt: str) -> tuple:
+        """ write an item with markers for the id, datetime and href, and split the text around them """
+        item = self.item('', datetime(2000, 1, 1))
+        item.add_asset(key='data', asset=pystac.Asset(href='', media_type=MEDIA_TYPES.get(fmt, 'text/plain')))
+        d = item.to_dict()
+        marks = ['\x00id', '\x00datetime', '\x00href']
+        d['id'], d['properties']['datetime'], d['assets']['data']['href'] = marks
+        text, parts = json.dumps(d), []
+        for mark in marks:
+            head, text = text.split(json.dumps(mark))
+            parts.append(head)
+        return tuple(parts) + (text,)
+
+
+# the template for each source and region, built once when the module is loaded
+STAC_TEMPLATES = {('NIC', 'arctic'): StacTemplate(stac_templates.NIC_ARCTIC_STAC, 'arctic'),
+                  ('NIC', 'antarctic'): StacTemplate(stac_templates.NIC_ANTARCTIC_STAC, 'antarctic'),
+                  ('CIS', 'arctic'): StacTemplate(stac_templates.CIS_ARCTIC_STAC, 'arctic')}
+STAC_TEMPLATES.update({('CIS', region): StacTemplate(plate, region) for region, plate in CIS_STAC.items()})
+
+
+# the fields of an IceChart, which are also the columns of the items table
+CHART_FIELDS = ('name', 'href', 'source', 'region', 'epoch', 'format', 'stac', 'exactgeo')
+# the values of exactgeo: no geometry has been read from the file, the chart outline, or just its bounding box
+GEO_NONE = 0
+GEO_EXACT = 1
+GEO_BBOX = 2
+
 
 class IceChart:
     """ An ice chart, which is a GIS file published by an Ice Service describing locations and characteristics of the
-    sea ice regime for a specific point in time """
+    sea ice regime for a specific point in time
+    the STAC item is only made when it is used, from the stored JSON text or the template for the region """
+
+    __slots__ = ('name', 'href', 'source', 'region', 'epoch', 'format', 'exactgeo', '_stac', '_json')
 
     def __init__(self, thedict: dict):
-        """ create a new instance from a dict """
+        """ create a new instance from a dict, the stac can be a pystac.Item, its JSON text, or None """
         self.name = thedict['name']
         self.href = thedict['href']
         self.source = thedict['source']
@@ -72,12 +171,50 @@ class IceChart:
     @classmethod
     def from_name(cls, name: str, href: str):
         thedict = {'name': name, 'href': href, 'source': None, 'region': None, 'epoch': None, 'format': None,
-                   'stac': None, 'exactgeo': False}
+                   'stac': None, 'exactgeo': GEO_NONE}
         myself = cls(thedict)
         myself.unpack_name()
-        myself.tostac()
         return myself
 
+    @classmethod
+    def from_row(cls, row):
+        """ create a new instance from a row of the items table, the STAC item is only parsed if it is used """
+        return cls({key: row[key] for key in CHART_FIELDS})
+
+    @property
+    def __dict__(self) -> dict:
+        """ the fields as a dict, as used to create an instance """
+        return {'name': self.name, 'href': self.href, 'source': self.source, 'region': self.region,
+                'epoch': self.epoch, 'format': self.format, 'stac': self._stac if self._stac else self._json,
+                'exactgeo': self.exactgeo}
+
+    @property
+    def stac(self) -> pystac.Item:
+        """ the STAC item for the chart """
+        if self._stac is None:
+            if self._json is not None:
+                self._stac = pystac.Item.from_dict(json.loads(self._json))
+            else:
+                self.tostac()
+            # the item may be changed now, so the JSON it was made from is out of date
+            self._json = None
+        return self._stac
+
+    @stac.setter
+    def stac(self, stac):
+        if isinstance(stac, str):
+            self._stac, self._json = None, stac
+        else:
+            self._stac, self._json = stac, None
+
+    def to_json(self) -> str:
+        """ the STAC item as JSON text, pystac is only used if the item has been made """
+        if self._stac is not None:
+            return json.dumps(self._stac.to_dict())
+        if self._json is not None:
+            return self._json
+        return self.template().json(self.name, self.epoch, self.href, self.format)
+
     def unpack_name(self):
         """
         Given an icechart name extract the region, data type, and epoch info from the file name
@@ -90,89 +227,138 @@ class IceChart:
         - CIS shapefiles:  rgc_a09_20201214_CEXPRHB.zip
         - combined CIS files with the format cisarctic20180712.zip
         """
-        fname = os.path.basename(self.href).lower()
+        fname = os.path.basename(self.href)
         if len(fname):
-            fpart, ext = os.path.splitext(fname)
-            # if the href includes query code, assume the file name is at the end
-            if '=' in fpart:
-                fx = fpart.split('=')
-                fpart = fx[len(fx) - 1]
-            # figure out the file format from the extension
-            if '.e00' == ext:
-                self.format = FMT_E00
-            elif '.zip' == ext:
-                self.format = FMT_SHP
-            else:
-                self.format = FMT_UNK
-
-            # figure out source from the beginning of the file name
-            if 'rgc' == fpart[:3] or 'cis' == fpart[:3]:
-                self.source = 'CIS'
-                if '_' in fpart:
-                    cpts = fpart.split('_')
-                    self.epoch = datetime.strptime(cpts[2], "%Y%m%d")
-                    self.region = CIS_AOI[cpts[1]]
-                else:
-                    self.region = 'arctic'
-                    self.epoch = datetime.strptime(fpart[-8:], "%Y%m%d")
-            else:
-                # if not CIS then NIC -- this will need more logic to support other sources
-                self.source = 'NIC'
-                if 'antarc' in fpart:
-                    self.region = 'antarctic'
-                else:
-                    self.region = 'arctic'
-
-                if '_' in fpart:
-                    # deal with some bogus file names here
-                    cpts = fpart.split('_')
-                    if len(cpts) == 5:
-                        self.epoch = datetime.strptime(cpts[2], "%Y%m%d")
-                    else:
-                        self.epoch = parse(fpart, fuzzy_with_tokens=True, yearfirst=True)[0]
-                else:
-                    self.epoch = parse(fpart, fuzzy_with_tokens=True, yearfirst=True)[0]
+            parsed = parse_name(fname)
+            self.source = parsed['source']
+            self.region = parsed['region']
+            self.epoch = parsed['epoch']
+            self.format = parsed['format']
 
-    def tostac(self):
-        """ create a STAC item structure with whatever info we have """
+    def template(self) -> StacTemplate:
+        """ the STAC template for the source and region of the chart """
         if self.source == 'NIC':
-            if self.region == 'arctic':
-                bplate = stac_templates.NIC_ARCTIC_STAC
-            else:
-                bplate = stac_templates.NIC_ANTARCTIC_STAC
-        else:  # if not NIC then CIS
-            bplate = CIS_STAC[self.region]
-
-        self.stac = pystac.Item(id=self.name,
-                                geometry=bplate['geometry'],
-                                bbox=bplate['bbox'],
-                                datetime=self.epoch,
-                                properties=bplate['properties'],
-                                stac_extensions=bplate['stac_extensions'])
-
-        self.stac.properties['region'] = self.region
-        if self.format == FMT_SHP:
-            self.stac.add_asset(key='data', asset=pystac.Asset(href=self.href, media_type='x-gis/x-shapefile'))
-        elif self.format == FMT_E00:
-            self.stac.add_asset(key='data', asset=pystac.Asset(href=self.href, media_type='application/x-ogc-avce00'))
-        else:
-            self.stac.add_asset(key='data', asset=pystac.Asset(href=self.href, media_type='text/plain'))
+            return STAC_TEMPLATES['NIC', 'arctic' if self.region == 'arctic' else 'antarctic']
+        # if not NIC then CIS
+        return STAC_TEMPLATES['CIS', self.region]
 
-    def exact_geometry(self):
-        """ load the file and extract the bounding box and geometry """
-        if self.format != FMT_SHP:
-            print('Only shapefiles supported for this operation')
-            return
+    def tostac(self):
+        """ create a STAC item structure with whatever info we have """
+        self.stac = self.template().item(self.name, self.epoch)
+        self.stac.add_asset(key='data', asset=pystac.Asset(href=self.href,
+                                                           media_type=MEDIA_TYPES.get(self.format, 'text/plain')))
 
-        if '_pl_a' in self.name or '_ll_a' in self.name:
-            print('Prototype files not supported for this operation')
+    def exact_geometry(self, mode: str = 'hull', geocache=None):
+        """ load the file and extract the bounding box and geometry
+        if mode is 'bbox' only the bounding box is read from the file, which is much faster, and the geometry is set
+        to the box - the chart is then marked GEO_BBOX rather than GEO_EXACT.
+        if geocache (a stackdb.GeometryCache) is given, the file is only read if it has changed since its geometry
+        was cached """
+        if geocache is None:
+            self.set_geometry(compute_geometry(self.name, self.href, self.format, mode))
             return
+        geo, validator, hit = cached_geometry(self.name, self.href, self.format, geocache.get(self.href),
+                                              lambda name, href, fmt: compute_geometry(name, href, fmt, mode))
+        if geo and validator and not hit:
+            geocache.put(self.href, validator, geo)
+        self.set_geometry(geo)
 
-        geo = get_zipshape_bbox(self.href)
+    def set_geometry(self, geo: dict):
+        """ update the STAC item with a geometry dict as returned by compute_geometry """
         if geo:
             self.stac.properties['proj:wkt2'] = geo['crs']
             self.stac.bbox = geo['bbox']
             self.stac.geometry = geo['geometry']
             self.stac.properties['proj:bbox'] = geo['pbbox']
             self.stac.properties['proj:geometry'] = geo['pgeometry']
-            self.exactgeo = True
+            self.exactgeo = GEO_EXACT if geo.get('exact', True) else GEO_BBOX
+
+
+def _name_date(text: str) -> datetime:
+    """ the date of a chart from the YYYYMMDD or YYMMDD in its name """
+    if len(text) == 6:
+        # two digit years are taken to be 1969 to 2068, like strptime does
+        text = ('19' if text[:2] >= '69' else '20') + text
+    return datetime(int(text[:4]), int(text[4:6]), int(text[6:]))
+
+
+def parse_name(fname: str, dates: dict = None) -> dict:
+    """ return a dict of the source, region, epoch and format of a chart from its file name, or the end of its href
+    the names are matched against NAME_PATTERNS, NIC names that don't match any of them fall back to finding a date
+    anywhere in the name, which is much slower.  dates is an optional dict to keep the dates already parsed in """
+    fpart, ext = os.path.splitext(fname.lower())
+    # if the href includes query code, assume the file name is at the end
+    fpart = fpart.rpartition('=')[2]
+    source = 'CIS' if fpart[:3] in ('rgc', 'cis') else 'NIC'
+    for pattern in NAME_PATTERNS[source]:
+        match = pattern.match(fpart)
+        if match:
+            break
+    else:
+        if source == 'CIS':
+            raise ValueError('Can not get the region and date from the chart name {0}'.format(fname))
+        # this will need more logic to support other sources
+        match = None
+
+    if match is None:
+        epoch = parse(fpart, fuzzy_with_tokens=True, yearfirst=True)[0]
+    elif dates is None:
+        epoch = _name_date(match['date'])
+    else:
+        epoch = dates.get(match['date'])
+        if epoch is None:
+            epoch = dates[match['date']] = _name_date(match['date'])
+
+    if source == 'CIS':
+        aoi = match.groupdict().get('aoi')
+        region = CIS_AOI[aoi] if aoi else 'arctic'
+    else:
+        region = 'antarctic' if 'antarc' in fpart else 'arctic'
+    return {'source': source, 'region': region, 'epoch': epoch, 'format': FORMATS.get(ext, FMT_UNK)}
+
+
+def parse_names(fnames) -> list:
+    """ parse_name for each of a list of file names, sharing the parsed dates between the names """
+    dates = {}
+    return [parse_name(fname, dates) for fname in fnames]
+
+
+def compute_geometry(name: str, href: str, fmt: str, mode: str = 'hull'):
+    """ download a chart and return a dict with its exact geometry, or None if the chart is not supported
+    mode is 'hull' for the outline of the chart, or 'bbox' for just its bounding box (see IceChart.exact_geometry),
+    E00 charts are always read in full
+    this is a plain function rather than a method so it can be shipped to a worker process """
+    if fmt == FMT_E00:
+        # there is no header to read the bounding box from, so E00 charts always get the outline
+        return get_e00_bbox(href)
+
+    if fmt != FMT_SHP:
+        print('Only shapefiles and E00 files supported for this operation')
+        return
+
+    if '_pl_a' in name or '_ll_a' in name:
+        print('Prototype files not supported for this operation')
+        return
+
+    if mode == 'bbox':
+        return get_zipshape_extent(href)
+    return get_zipshape_bbox(href)
+
+
+def cached_geometry(name: str, href: str, fmt: str, cached=None, geofunc=compute_geometry):
+    """ like compute_geometry, but if cached - a (validator, geometry) tuple from a GeometryCache - matches the
+    current validator of the chart its geometry is returned instead of downloading the chart again
+    returns the geometry, the validator (None if the server doesn't give one) and True if the cache was used """
+    if cached is None:
+        # nothing to check, so rather than asking the server first the validator is taken from the download
+        download_validators.pop(href, None)
+        geo = geofunc(name, href, fmt)
+        validator = download_validators.pop(href, None)
+        if geo and validator is None:
+            # not downloaded by utility, so ask after all
+            validator = content_validator(href)
+        return geo, validator, False
+    validator = content_validator(href)
+    if validator is not None and validator == cached[0]:
+        return cached[1], validator, True
+    return geofunc(name, href, fmt), validator, False
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Pipeline for discovering, building and storing ice charts concurrently
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+import time
+import queue
+import threading
+from typing import Callable, Dict
+from icechart import IceChart
+
+# maximum number of links or charts waiting between stages, this keeps a fast stage from running away
+QUEUE_SIZE = 1000
+
+# marks the end of the output of a stage
+DONE = None
+
+
+class DiscoveryError(Exception):
+    """ raised by run_pipeline when a discovery function failed, after the charts that were found have been stored
+    errors maps each source that failed to its exception, and stats is the dict run_pipeline would have returned """
+
+    def __init__(self, errors: dict, stats: dict):
+        super().__init__('Discovery failed for {0}'.format(', '.join(
+            '{0} - {1}: {2}'.format(source, type(e).__name__, e) for source, e in errors.items())))
+        self.errors = errors
+        self.stats = stats
+
+
+class _Stopped(Exception):
+    """ raised by a discovery stage's storefunc once the pipeline has been stopped """
+
+
+def _discover(source: str, findfunc: Callable, links: queue.Queue, stats: dict, stop: threading.Event):
+    """ run a discovery function, passing each link it finds to the next stage """
+
+    def emit(name: str, href: str):
+        if stop.is_set():
+            raise _Stopped()
+        stats[source] += 1
+        links.put((name, href))
+
+    try:
+        findfunc(emit)
+    except _Stopped:
+        pass
+    except Exception as e:
+        stats['Errors'][source] = e
+        print('Discovery failed for {0} - {1}: {2}'.format(source, type(e).__name__, e))
+    finally:
+        links.put(DONE)
+
+
+def _parse(nsources: int, links: queue.Queue, charts: queue.Queue, parsefunc: Callable, stats: dict,
+           stop: threading.Event):
+    """ turn links into IceChart objects until every discovery stage is done, once stopped the links are dropped """
+    remaining = nsources
+    while remaining:
+        link = links.get()
+        if link is DONE:
+            remaining -= 1
+            continue
+        if stop.is_set():
+            continue
+        try:
+            charts.put(parsefunc(link[0], link[1]))
+        except Exception as e:
+            stats['Failed'] += 1
+            print('Could not make a chart from {0} - {1}: {2}'.format(link[1], type(e).__name__, e))
+    charts.put(DONE)
+
+
+def run_pipeline(sources: Dict[str, Callable], storefunc: Callable[[IceChart], None],
+                 parsefunc: Callable[[str, str], IceChart] = IceChart.from_name, queue_size: int = QUEUE_SIZE) -> dict:
+    """ discover, build and store ice charts with all the stages running at the same time
+    sources maps a source name to a discovery function, which is called with a storefunc(name, href) to report
+    each chart it finds - each source runs in its own thread.  The links are turned into charts by parsefunc in a
+    second stage, and the charts are passed to storefunc in the calling thread, so storefunc can safely write to
+    a database opened in this thread.
+    returns a dict with the number of links found for each source and the number of charts stored.
+    if a discovery function fails the others carry on, and DiscoveryError is raised once everything found is stored.
+    if storefunc raises the other stages are stopped, and its exception is raised once they have finished """
+    links = queue.Queue(maxsize=queue_size)
+    charts = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    stats = dict.fromkeys(sources, 0)
+    stats.update({'Stored': 0, 'Failed': 0, 'Errors': {}})
+    start = time.time()
+
+    threads = [threading.Thread(target=_discover, args=(source, findfunc, links, stats, stop), daemon=True)
+               for source, findfunc in sources.items()]
+    threads.append(threading.Thread(target=_parse, args=(len(sources), links, charts, parsefunc, stats, stop),
+                                    daemon=True))
+    for thread in threads:
+        thread.start()
+
+    # the writer stage
+    try:
+        while True:
+            chart = charts.get()
+            if chart is DONE:
+                break
+            storefunc(chart)
+            stats['Stored'] += 1
+    except BaseException:
+        stop.set()
+        # the other stages may be waiting for room in the queues, read until they are done
+        while charts.get() is not DONE:
+            pass
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    stats['Seconds'] = time.time() - start
+    if stats['Errors']:
+        raise DiscoveryError(stats['Errors'], stats)
+    return stats
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Read members of zip files on a web server with HTTP range requests
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+import io
+import re
+import zipfile
+import requests
+from cache import TIMEOUT
+
+# the tail of the file fetched when it is opened - this holds the zip directory of an archive of a few files
+TAIL_SIZE = 8 * 1024
+# the smallest range worth a request, also the biggest gap between members that is fetched rather than skipped
+READAHEAD = 16 * 1024
+# the parts of a shapefile needed for its geometry, the attributes (.dbf) are not needed
+SHAPE_MEMBERS = ('.shp', '.shx', '.prj')
+
+
+class RangeNotSupported(Exception):
+    """ the server did not answer a Range request with the partial content asked for, or the file changed while it
+    was being read """
+
+
+class RemoteFile(io.RawIOBase):
+    """ a read-only, seekable file on a web server that is read with HTTP range requests
+    everything fetched is kept, so reading the same part twice only costs one request """
+
+    def __init__(self, href, session=None, verify=True, tail=TAIL_SIZE, readahead=READAHEAD):
+        super().__init__()
+        self.href = href
+        self.session = session if session is not None else requests
+        self.verify = verify
+        self.readahead = readahead
+        self.pos = 0
+        self.bytes_read = 0
+        self.requests = 0
+        # a list of (offset, data) of the parts of the file we have
+        self.spans = []
+        # the ETag or Last-Modified of the file when it was opened, later requests are only answered with part of the
+        # file if it still has this, so parts of different versions of a file can't get mixed up
+        self.validator = None
+        # the headers of the first response
+        self.headers = None
+        self.size = None
+        start, data, self.size = self._get('bytes=-{0}'.format(tail))
+        self._add(start, data)
+
+    @property
+    def bytes_saved(self):
+        return max(self.size - self.bytes_read, 0)
+
+    def _get(self, byterange):
+        """ make a range request, returns the offset, the data and the size of the whole file """
+        headers = {'Range': byterange}
+        if self.validator:
+            headers['If-Range'] = self.validator
+        r = self.session.get(self.href, headers=headers, verify=self.verify, stream=True, timeout=TIMEOUT)
+        try:
+            if r.status_code != 200:
+                r.raise_for_status()
+            match = re.match(r'bytes (\d+)-(\d+)/(\d+)', r.headers.get('Content-Range', ''))
+            # close without reading the body, so a full response is not downloaded
+            if (self.validator and r.status_code == 200) or (match and self.size not in (None, int(match.group(3)))):
+                raise RangeNotSupported('{0} changed while it was being read'.format(self.href))
+            if r.status_code != 206 or not match:
+                raise RangeNotSupported('{0} does not support range requests'.format(self.href))
+            if self.size is None:
+                self.headers = r.headers
+                etag = r.headers.get('ETag')
+                # If-Range needs a strong ETag
+                self.validator = etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified')
+            data = r.content
+        finally:
+            r.close()
+        self.requests += 1
+        self.bytes_read += len(data)
+        return int(match.group(1)), data, int(match.group(3))
+
+    def _cached(self, start, end):
+        """ return the data from start to end if we already have it, otherwise None """
+        for offset, data in self.spans:
+            if offset <= start and end <= offset + len(data):
+                return data[start - offset:end - offset]
+        return None
+
+    def _add(self, start, data):
+        """ keep some data, joining it to any spans it touches so reads across them can be served """
+        end = start + len(data)
+        keep = []
+        for offset, span in self.spans:
+            if offset + len(span) < start or end < offset:
+                keep.append((offset, span))
+                continue
+            if offset < start:
+                data = span[:start - offset] + data
+                start = offset
+            if offset + len(span) > end:
+                data = data + span[end - offset:]
+                end = offset + len(span)
+        keep.append((start, data))
+        self.spans = keep
+
+    def fetch(self, start, end):
+        """ make sure we have the bytes from start to end, only requesting the parts we don't have yet """
+        end = min(end, self.size)
+        for offset, span in sorted(self.spans):
+            if offset <= start < offset + len(span):
+                start = offset + len(span)
+            if offset < end <= offset + len(span):
+                end = offset
+        if start < end:
+            offset, data, _ = self._get('bytes={0}-{1}'.format(start, end - 1))
+            self._add(offset, data)
+
+    def prefetch(self, ranges):
+        """ fetch a list of (start, end) ranges, joining up the ones that are close together """
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start - merged[-1][1] <= self.readahead:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        for start, end in merged:
+            self.fetch(start, end)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        end = min(self.pos + n, self.size)
+        if end <= self.pos:
+            return b''
+        data = self._cached(self.pos, end)
+        if data is None:
+            self.fetch(self.pos, max(end, self.pos + self.readahead))
+            data = self._cached(self.pos, end)
+            if data is None:
+                raise RangeNotSupported('{0} sent less than was asked for'.format(self.href))
+        self.pos = end
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def read_shapefile(href, suffixes=SHAPE_MEMBERS, session=None, verify=True):
+    """ read the first shapefile in a remote zip file, fetching only the members with the given suffixes
+    returns the name of the .shp member, a zip file (as bytes) holding just those members, and the RemoteFile
+    so the caller can see how much was read - the name and data are None if there is no shapefile.
+    raises RangeNotSupported if the server can't do range requests, or zipfile.BadZipFile if the archive is corrupt """
+    remote = RemoteFile(href, session=session, verify=verify)
+    with zipfile.ZipFile(remote) as zipfl:
+        shpfiles = [s for s in zipfl.namelist() if s.endswith('.shp')]
+        if len(shpfiles) < 1:
+            return None, None, remote
+        stem = shpfiles[0][:-4]
+        members = [i for i in zipfl.infolist() if i.filename[:-4] == stem and i.filename[-4:].lower() in suffixes]
+        # fetch all the members up front, allowing a little for local headers that differ from the directory
+        remote.prefetch([(i.header_offset, i.header_offset + 30 + len(i.filename.encode()) + len(i.extra) +
+                          i.compress_size + 64) for i in members])
+        buf = io.BytesIO()
+        # no need to compress again, the result only lives in memory
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as out:
+            for info in members:
+                # reading checks the CRC
+                out.writestr(info.filename, zipfl.read(info))
+    return shpfiles[0], buf.getvalue(), remote
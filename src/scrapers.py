@@ -31,16 +31,24 @@
 
 import os
 import datetime
+import re
 from typing import Callable
-from utility import parse_htmlform_files
+from urllib.parse import urljoin, urlparse
+import requests
+from bs4 import BeautifulSoup
+from utility import parse_htmlform_files, extract_form_fields
+from cache import get_response_cache
 import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import Select, WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import StaleElementReferenceException, NoSuchElementException
+from selenium.common.exceptions import StaleElementReferenceException, NoSuchElementException, WebDriverException
 
 # first available data from CIS appears to be 1968-06-25
 STARTYEAR = 1968
@@ -54,62 +62,259 @@ nic_basesite_new = 'https://usicecenter.gov/Products/DisplaySearchResults'
 nic_ra = 'https://usicecenter.gov/Products/ArchiveSearch?table=WeeklyArctic&product=Arctic%20Weekly%20Shapefile&linkChange=arc-two'
 nic_antarctic_new = 'https://usicecenter.gov/Products/ArchiveSearch?table=WeeklyAntarctic&product=Antarctic%20Weekly%20Shapefile&linkChange=ant-two'
 nic_form = 'weekly_products.html'
+# NIC search results for dates older than this many days are not expected to change
+NIC_SETTLED_DAYS = 60
 
 # define some constants for accessing the CIS website
 cis_searchpage = "https://iceweb1.cis.ec.gc.ca/Archive/page1.xhtml?lang=en"
 cis_searchbase = "https://iceweb1.cis.ec.gc.ca/Archive/page1.xhtml"
 CIS_YEARS_TO_QUERY = 5
+# number of browsers used to search the CIS site at the same time
+CIS_BROWSERS = 1
+# stop searching after finding this many charts in a row that are already catalogued
+KNOWN_RUN = 50
 
 
-def gogetnicdata(site: str = 'New', startyear: int = STARTYEAR, startmonth: int = STARTMONTH, startday: int = STARTDAY):
+def gogetnicdata(site: str = 'New', startyear: int = STARTYEAR, startmonth: int = STARTMONTH, startday: int = STARTDAY,
+                 storefunc: Callable[[str, str], None] = None, known: 'KnownCharts' = None, cache=None):
     """ new and improved web scraping for NIC shapefiles
-    returns a list of available files from the old NIC icechart server """
+    returns a list of available files from the old NIC icechart server
+    if storefunc is given it is called with the name and link of each file as soon as its search completes
+    files in known are left out, see KnownCharts
+    search results are kept in cache (see cache.MemoryResponseCache), by default the cache set up by the
+    CATSEAICE_CACHE environment variable is used if there is one """
     # query the website for Arctic datasets between the given start date and today
     td = datetime.date.today()
     ts = datetime.date(startyear, startmonth, startday)
     target_files = []
+    if cache is None:
+        cache = get_response_cache()
+
+    def collect(files):
+        # strip off the file extension from the name column of the results
+        links = [(os.path.splitext(targ[0])[0], targ[1]) for targ in files]
+        for name, lnk in (links if known is None else known.new(links)):
+            if storefunc:
+                storefunc(name, lnk)
+            target_files.append([name, lnk])
+
     if site == 'New':  # use the new (Dec 2020) site
         # ssn = requests.session()
         # baseurl = 'https://usicecenter.gov/Products/ArchiveSearch'
         # qry = {'table': 'WeeklyArctic', 'product': 'Arctic%20Weekly%20Shapefile', 'linkChange': 'arc-two'}
         # frm = ssn.get(baseurl, params=qry)
         # fmr.url
-        # first search the arctic (zip files only as far as I can tell)
-        payload = {'searchText': 'WeeklyArctic', 'searchProduct': 'Arctic Weekly Shapefile',
-                   'startDate': ts.strftime("%m/%d/%Y"), 'endDate': td.strftime("%m/%d/%Y")}
-        target_files.extend(parse_htmlform_files(nic_basesite_new, '', payload, 'zip', VERIFY))
-        # now search for antarctic files
-        payload = {'searchText': 'WeeklyAntarctic', 'searchProduct': 'Antarctic Weekly Shapefile',
-                   'startDate': ts.strftime("%m/%d/%Y"), 'endDate': td.strftime("%m/%d/%Y")}
-        target_files.extend(parse_htmlform_files(nic_basesite_new, '', payload, 'zip', VERIFY))
+        # first search the arctic (zip files only as far as I can tell), then the antarctic
+        # the results for the years that are over are searched separately, so they can be cached for good
+        for product in (('WeeklyArctic', 'Arctic Weekly Shapefile'), ('WeeklyAntarctic', 'Antarctic Weekly Shapefile')):
+            for ws, we in search_windows(ts, td):
+                payload = {'searchText': product[0], 'searchProduct': product[1],
+                           'startDate': ws.strftime("%m/%d/%Y"), 'endDate': we.strftime("%m/%d/%Y")}
+                settled = we < td - datetime.timedelta(days=NIC_SETTLED_DAYS)
+                collect(parse_htmlform_files(nic_basesite_new, '', payload, 'zip', VERIFY, cache, settled))
     else:
         # first search for Arctic E00 files
         payload = {'oldarea': 'Arctic', 'oldformat': 'E00', 'year0': str(ts.year), 'month0': ts.strftime("%b"),
                    'day0': str(ts.day).zfill(2), 'year1': str(td.year), 'month1': td.strftime("%b"),
                    'day1': str(td.day).zfill(2), 'area': 'Arctic', 'format': 'E00', 'subareas': 'Hemispheric'}
 
-        target_files.extend(parse_htmlform_files(nic_basesite, nic_form, payload, 'e00', VERIFY))
+        collect(parse_htmlform_files(nic_basesite, nic_form, payload, 'e00', VERIFY, cache))
         # Now search for Arctic shapefiles
         payload['oldformat'] = 'Shapefiles'
         payload['format'] = 'Shapefiles'
-        target_files.extend(parse_htmlform_files(nic_basesite, nic_form, payload, 'zip', VERIFY))
+        collect(parse_htmlform_files(nic_basesite, nic_form, payload, 'zip', VERIFY, cache))
 
         # now do the antarctic - shapes
         payload['oldarea'] = 'Antarctic'
         payload['area'] = 'Antarctic'
-        target_files.extend(parse_htmlform_files(nic_basesite, nic_form, payload, 'zip', VERIFY))
+        collect(parse_htmlform_files(nic_basesite, nic_form, payload, 'zip', VERIFY, cache))
         # finally antarctic E00
         payload['oldformat'] = 'E00'
         payload['format'] = 'E00'
-        target_files.extend(parse_htmlform_files(nic_basesite, nic_form, payload, 'e00', VERIFY))
-
-    # strip off the file extension from the name column of the results
-    for targ in target_files:
-        targ[0] = os.path.splitext(targ[0])[0]
+        collect(parse_htmlform_files(nic_basesite, nic_form, payload, 'e00', VERIFY, cache))
 
     return target_files
 
 
+class KnownCharts:
+    """ the names of charts that are already catalogued, used to skip them during a search
+    a search stops early once stop_after known charts have been found in a row, 0 means never stop """
+
+    def __init__(self, names=(), stop_after: int = KNOWN_RUN):
+        self.names = names if isinstance(names, (set, frozenset)) else set(names)
+        self.stop_after = stop_after
+        self.skipped = 0
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def new(self, links):
+        """ yield the (name, link) pairs from links that are not known """
+        run = 0
+        for name, lnk in links:
+            if name in self.names:
+                self.skipped += 1
+                run += 1
+                if self.stop_after and run >= self.stop_after:
+                    print('Stopping search after {0} charts in a row that are already catalogued'.format(run))
+                    return
+                continue
+            run = 0
+            yield name, lnk
+
+
+def search_windows(start: datetime.date, end: datetime.date, settled_days: int = NIC_SETTLED_DAYS):
+    """ split the dates from start to end into at most two searches, yielding the first and last date of each: the
+    years that were over settled_days before end, whose results don't change and can be cached for good, and the rest
+    which are searched again each time """
+    boundary = datetime.date((end - datetime.timedelta(days=settled_days)).year, 1, 1)
+    if start < boundary:
+        yield start, min(boundary - datetime.timedelta(days=1), end)
+        start = boundary
+    if start <= end:
+        yield start, end
+
+
+def valid_startdate(startyear: int, startmonth: int, startday: int):
+    """ replace any out of range parts of a CIS search start date with the earliest date """
+    if startyear < STARTYEAR:
+        startyear = STARTYEAR
+    if startmonth < 1 or startmonth > 12:
+        startmonth = STARTMONTH
+    if startday < 1 or startday > 31:
+        startday = STARTDAY
+    return startyear, startmonth, startday
+
+
+class CISSearchError(Exception):
+    """ the CIS search pages did not look like we expected """
+
+
+class CISArchiveClient:
+    """ search the CIS archive with plain HTTP requests by replaying the JSF search form, rather than driving a
+    browser.  Every data file link on each page of results is collected, and the "Next" link is followed by posting
+    the form back with its current view state """
+
+    # the ids of the form elements that select e00 and shapefile data, and the search button
+    DATA_TYPE_IDS = ('j_id_26:5:j_id_28', 'j_id_2b')
+    SUBMIT_ID = 'submitBtnId'
+    ITEMS_PER_PAGE = '200'
+    MAX_PAGES = 1000
+
+    def __init__(self, searchpage: str = cis_searchpage, session: requests.Session = None, pool_size: int = 4):
+        self.searchpage = searchpage
+        self.session = session or requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def search(self, startyear: int = STARTYEAR, startmonth: int = STARTMONTH, startday: int = STARTDAY,
+               yearstoquery: int = CIS_YEARS_TO_QUERY, storefunc: Callable[[str, str], None] = None,
+               known: 'KnownCharts' = None):
+        """ retrieve a list of e00 and zip data from the CIS site, see query_cis_form """
+        startyear, startmonth, startday = valid_startdate(startyear, startmonth, startday)
+        r = self.session.get(self.searchpage, verify=VERIFY)
+        r.raise_for_status()
+        soup = BeautifulSoup(r.text, 'html.parser')
+        submit = soup.find(id=self.SUBMIT_ID)
+        form = submit.find_parent('form') if submit else None
+        if form is None:
+            raise CISSearchError('Search form not found on {0}'.format(self.searchpage))
+
+        values = {self.SUBMIT_ID: submit.get('value', ''), 'itemsperpage': self.ITEMS_PER_PAGE,
+                  'fromYear': str(startyear), 'fromMonth': '{:02d}'.format(startmonth),
+                  'fromDay': '{:02d}'.format(startday)}
+        endyear = startyear + yearstoquery
+        # the form sets the end date to today unless we ask for an earlier year
+        if endyear < datetime.date.today().year:
+            values.update({'toYear': str(endyear), 'toMonth': '{:02d}'.format(startmonth),
+                           'toDay': '{:02d}'.format(startday)})
+        for elid in self.DATA_TYPE_IDS:
+            values[elid] = 'on'
+        payload = self.form_payload(form, values)
+        r = self.session.post(urljoin(r.url, form.get('action', '')), data=payload, verify=VERIFY)
+
+        target_files = []
+        links = self.result_links(r)
+        for name, lnk in (links if known is None else known.new(links)):
+            if storefunc:
+                storefunc(name, lnk)
+            target_files.append([name, lnk])
+
+        print('Got {0} results'.format(len(target_files)))
+        return target_files
+
+    def result_links(self, r):
+        """ yield the name and link of each data file in the search results, starting with response r
+        the next page is only requested once all the links on the current page have been used """
+        seen = set()
+        for _ in range(self.MAX_PAGES):
+            r.raise_for_status()
+            soup = BeautifulSoup(r.text, 'html.parser')
+            newlinks = 0
+            for lnk in self.data_links(soup, r.url):
+                if lnk in seen:
+                    continue
+                seen.add(lnk)
+                newlinks += 1
+                yield os.path.splitext(os.path.basename(urlparse(lnk).path))[0], lnk
+            if not newlinks:
+                return
+            r = self.next_page(soup, r.url)
+            if r is None:
+                return
+
+    @staticmethod
+    def form_payload(form, values: dict) -> dict:
+        """ the fields a browser would post for form, with the elements named by id in values set """
+        fields = extract_form_fields(form)
+        # unchecked checkboxes are not sent, and a group of checkboxes sends all of the checked values
+        checked = {}
+        for box in form.find_all('input', type='checkbox'):
+            if box.has_attr('name'):
+                if box.has_attr('checked'):
+                    checked.setdefault(box['name'], []).append(box.get('value', 'on'))
+                elif fields.get(box['name']) == '':
+                    del fields[box['name']]
+        fields.update({name: values if len(values) > 1 else values[0] for name, values in checked.items()})
+        for elid, value in values.items():
+            element = form.find(id=elid)
+            if element is None or not element.has_attr('name'):
+                raise CISSearchError('Form element {0} not found'.format(elid))
+            if element.get('type') == 'checkbox':
+                value = element.get('value', value)
+            fields[element['name']] = value
+        return fields
+
+    @staticmethod
+    def data_links(soup, pageurl: str) -> list:
+        """ all the links to e00 or zip files on a page """
+        links = []
+        for anchor in soup.find_all('a', href=True):
+            lnk = urljoin(pageurl, anchor['href'])
+            if os.path.splitext(urlparse(lnk).path)[1].lower() in ('.e00', '.zip'):
+                links.append(lnk)
+        return links
+
+    def next_page(self, soup, pageurl: str):
+        """ follow the Next link, returns None on the last page """
+        anchor = soup.find('a', string=re.compile(r'^\s*Next\s*$'))
+        if anchor is None:
+            return None
+        href = anchor.get('href', '#')
+        if href != '#' and not href.startswith('javascript'):
+            return self.session.get(urljoin(pageurl, href), verify=VERIFY)
+        # a JSF command link, which submits its form with the id of the link that was clicked
+        form = anchor.find_parent('form')
+        if form is None or not anchor.has_attr('id'):
+            raise CISSearchError('Cannot follow the Next link on {0}'.format(pageurl))
+        fields = self.form_payload(form, {})
+        formid = form.get('id', form.get('name', ''))
+        fields[formid + ':_idcl'] = anchor['id']
+        fields[anchor['id']] = anchor['id']
+        return self.session.post(urljoin(pageurl, form.get('action', '')), data=fields, verify=VERIFY)
+
+
 # helper functions for working with selenium
 # ref:  http://www.obeythetestinggoat.com/how-to-get-selenium-to-wait-for-page-load-after-a-click.html
 def wait_for(condition_function):
@@ -140,8 +345,125 @@ class wait_for_page_load(object):
         wait_for(self.page_has_loaded)
 
 
+def make_browser():
+    """ start a headless Firefox, the geckodriver must be installed in the path """
+    options = Options()
+    options.headless = True
+    try:
+        return webdriver.Firefox(options=options)
+    except WebDriverException as e:
+        # neither is in the Docker image, which can only search the CIS site with plain HTTP requests
+        raise WebDriverException('Could not start a browser to search the CIS site, Firefox and geckodriver must be '
+                                 'installed - {0}'.format(e.msg))
+
+
+class BrowserPool:
+    """ a pool of headless browser sessions that are reused for CIS searches, rather than starting a new
+    browser for every query.  Browsers are started as they are needed, up to size of them """
+
+    def __init__(self, size: int = CIS_BROWSERS, factory: Callable = make_browser):
+        self.size = max(size, 1)
+        self.factory = factory
+        self.idle = queue.Queue()
+        self.browsers = []
+        # the number of browsers being started, each has a place in the pool kept for it
+        self.starting = 0
+        self.lock = threading.Lock()
+
+    def reset(self, driver):
+        """ return a browser to a fresh search page, dropping the cookies so the site starts a new session """
+        driver.delete_all_cookies()
+        driver.get(cis_searchpage)
+
+    def acquire(self):
+        """ get an idle browser, starting a new one if they are all busy and the pool is not full """
+        while True:
+            with self.lock:
+                start = self.idle.empty() and len(self.browsers) + self.starting < self.size
+                if start:
+                    self.starting += 1
+            if start:
+                # starting a browser takes a while, so the pool isn't locked meanwhile
+                try:
+                    driver = self.factory()
+                except BaseException:
+                    with self.lock:
+                        self.starting -= 1
+                    raise
+                with self.lock:
+                    self.starting -= 1
+                    self.browsers.append(driver)
+                return driver
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    @contextmanager
+    def session(self):
+        """ borrow a browser that is ready to search, waiting for one if they are all busy """
+        driver = self.acquire()
+        healthy = True
+        try:
+            self.reset(driver)
+            yield driver
+        except WebDriverException:
+            # the browser itself has failed, so don't hand it out again
+            healthy = False
+            raise
+        finally:
+            if healthy:
+                self.idle.put(driver)
+            else:
+                self.discard(driver)
+
+    def discard(self, driver):
+        """ shut down a browser and remove it from the pool """
+        with self.lock:
+            if driver in self.browsers:
+                self.browsers.remove(driver)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+    def close(self):
+        """ shut down all the browsers """
+        for driver in list(self.browsers):
+            self.discard(driver)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+
+def browse_results(driver):
+    """ step through the search results in a browser, yielding the name and link of each data file """
+    # with wait_for_page_load(driver):
+    driver.find_element_by_partial_link_text('Weekly Regional Ice Data').click()
+    last = None
+    while True:
+        # this is the part that fails eventually - need to figure out how to wait (or skip?)
+        # the problem is that both find_element_by_partial_link_text calls fail with NoSuchElementException
+        lnkel = driver.find_element_by_xpath('/html/body/main/form[2]/p[1]/a')
+        lnk = lnkel.get_attribute('href')
+        print(lnk)
+        if lnk == last:
+            return
+        last = lnk
+        yield os.path.splitext(os.path.basename(lnk))[0], lnk
+        with wait_for_page_load(driver):
+            driver.find_element_by_link_text('Next').click()
+        WebDriverWait(driver, 10).until(EC.staleness_of(lnkel))
+
+
 def query_cis_form(startyear: int = STARTYEAR, startmonth: int = STARTMONTH, startday: int = STARTDAY,
-                   yearstoquery: int = CIS_YEARS_TO_QUERY, storefunc: Callable[[str, str], None] = None):
+                   yearstoquery: int = CIS_YEARS_TO_QUERY, storefunc: Callable[[str, str], None] = None,
+                   pool: 'BrowserPool' = None, known: 'KnownCharts' = None):
     """ retrieve a list of e00 and zip data from the CIS site
     Old data (from ??? to 01-2020) comes as an E00 file named like this: rgc_a10_20200106_CEXPRWA.e00
     new data (since 01-2020 comes as a zip file named like this:  rgc_a10_20200330_CEXPRWA.zip
@@ -150,122 +472,150 @@ def query_cis_form(startyear: int = STARTYEAR, startmonth: int = STARTMONTH, sta
     New attempt using Selenium to access the search form - note that the geckodriver must be installed in the path
     or this will fail
     https://github.com/mozilla/geckodriver/releases
+
+    The browser is borrowed from pool, if no pool is given a browser is started just for this query.
+    Charts in known are skipped, see KnownCharts
     """
-    # make sure the calling parameters are valid and convert to strings
-    if startyear < STARTYEAR:
-        startyear = STARTYEAR
-    if startmonth < 1 or startmonth > 12:
-        startmonth = STARTMONTH
-    if startday < 1 or startday > 31:
-        startday = STARTDAY
+    if pool is None:
+        with BrowserPool() as pool:
+            return query_cis_form(startyear, startmonth, startday, yearstoquery, storefunc, pool, known)
 
+    # make sure the calling parameters are valid and convert to strings
+    startyear, startmonth, startday = valid_startdate(startyear, startmonth, startday)
     s_year = str(startyear)
     endyear = startyear + yearstoquery
     e_year = str(endyear)
     s_month = "{:02d}".format(startmonth)
     s_day = "{:02d}".format(startday)
 
-    # get the search page and fill in the form
+    # borrow a browser that is already on the search page and fill in the form
     target_files = []
-    try:
-        options = Options()
-        options.headless = True
-        driver = webdriver.Firefox(options=options)
-        driver.get(cis_searchpage)
-
-        # select e00 and shp files
-        WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.ID, 'j_id_26:5:j_id_28')))
-        driver.find_element_by_id("j_id_26:5:j_id_28").click()
-        WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.ID, 'j_id_2b')))
-        driver.find_element_by_id("j_id_2b").click()
-
-        # select all regions
-        # driver.implicitly_wait(1)  # seconds
-        # driver.find_element_by_id("selRgnSelId:0").click()
-        # driver.implicitly_wait(1)  # seconds
-        # driver.find_element_by_id("selRgnSelId:0").click()
-        # driver.implicitly_wait(1)  # seconds
-        # driver.find_element_by_id("j_id_2g").click()
-
-        # set items per page to 200
-        WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'itemsperpage')))
-        select = Select(driver.find_element_by_id('itemsperpage'))
-        select.select_by_value('200')
-
-        # set the start dates (earliest)
-        WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'fromYear')))
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, 'option[value="1968"]')))
-        select = Select(driver.find_element_by_id('fromYear'))
-        select.select_by_value(s_year)
-        WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'fromMonth')))
-        select = Select(driver.find_element_by_id('fromMonth'))
-        select.select_by_value(s_month)
-        WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'fromDay')))
-        select = Select(driver.find_element_by_id('fromDay'))
-        select.select_by_value(s_day)
-
-        # normally the form will set the end date to the current date,
-        # we will only change it if our end year is a previous year
-        if endyear < datetime.date.today().year:
-            # set the end dates (latest)
-            WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'toYear')))
+    with pool.session() as driver:
+        try:
+            # select e00 and shp files
+            WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.ID, 'j_id_26:5:j_id_28')))
+            driver.find_element_by_id("j_id_26:5:j_id_28").click()
+            WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.ID, 'j_id_2b')))
+            driver.find_element_by_id("j_id_2b").click()
+
+            # select all regions
+            # driver.implicitly_wait(1)  # seconds
+            # driver.find_element_by_id("selRgnSelId:0").click()
+            # driver.implicitly_wait(1)  # seconds
+            # driver.find_element_by_id("selRgnSelId:0").click()
+            # driver.implicitly_wait(1)  # seconds
+            # driver.find_element_by_id("j_id_2g").click()
+
+            # set items per page to 200
+            WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'itemsperpage')))
+            select = Select(driver.find_element_by_id('itemsperpage'))
+            select.select_by_value('200')
+
+            # set the start dates (earliest)
+            WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'fromYear')))
             WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, 'option[value="1969"]')))
-            select = Select(driver.find_element_by_id('toYear'))
-            select.select_by_value(e_year)
-            WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'toMonth')))
-            select = Select(driver.find_element_by_id('toMonth'))
+                EC.presence_of_element_located((By.CSS_SELECTOR, 'option[value="1968"]')))
+            select = Select(driver.find_element_by_id('fromYear'))
+            select.select_by_value(s_year)
+            WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'fromMonth')))
+            select = Select(driver.find_element_by_id('fromMonth'))
             select.select_by_value(s_month)
-            WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'toDay')))
-            select = Select(driver.find_element_by_id('toDay'))
+            WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'fromDay')))
+            select = Select(driver.find_element_by_id('fromDay'))
             select.select_by_value(s_day)
 
-        # assuming the form is filled out, click the submit button
-        WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.ID, 'submitBtnId')))
-        driver.find_element_by_id("submitBtnId").click()
-        # assuming we get a search result (what if it fails?) click on the first result,
-        # then click next until the results stop changing
-        WebDriverWait(driver, 20).until(
-            EC.visibility_of_element_located((By.PARTIAL_LINK_TEXT, 'Weekly Regional Ice Data')))
-        # with wait_for_page_load(driver):
-        driver.find_element_by_partial_link_text('Weekly Regional Ice Data').click()
-        while True:
-            # this is the part that fails eventually - need to figure out how to wait (or skip?)
-            # the problem is that both find_element_by_partial_link_text calls fail with NoSuchElementException
-            lnkel = driver.find_element_by_xpath('/html/body/main/form[2]/p[1]/a')
-            lnk = lnkel.get_attribute('href')
-            print(lnk)
-            if len(target_files):
-                if target_files[-1][1] == lnk:
-                    break
-            if storefunc:
-                storefunc(os.path.splitext(os.path.basename(lnk))[0], lnk)
-            target_files.append([os.path.splitext(os.path.basename(lnk))[0], lnk])
-            with wait_for_page_load(driver):
-                driver.find_element_by_link_text('Next').click()
-            WebDriverWait(driver, 10).until(EC.staleness_of(lnkel))
-    except StaleElementReferenceException:
-        print("Get CIS Data:  Stale reference exception from Selenium - failing gracefully but you need to try again")
-    except NoSuchElementException:
-        print("Get CIS Data:  No such element exception from Selenium - failing gracefully but you need to try again")
-    finally:
-        # driver.close()  # make sure the geckodriver instance is not left hanging around
-        driver.quit()   # this might be redundant
+            # normally the form will set the end date to the current date,
+            # we will only change it if our end year is a previous year
+            if endyear < datetime.date.today().year:
+                # set the end dates (latest)
+                WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'toYear')))
+                WebDriverWait(driver, 10).until(
+                    EC.presence_of_element_located((By.CSS_SELECTOR, 'option[value="1969"]')))
+                select = Select(driver.find_element_by_id('toYear'))
+                select.select_by_value(e_year)
+                WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'toMonth')))
+                select = Select(driver.find_element_by_id('toMonth'))
+                select.select_by_value(s_month)
+                WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.ID, 'toDay')))
+                select = Select(driver.find_element_by_id('toDay'))
+                select.select_by_value(s_day)
+
+            # assuming the form is filled out, click the submit button
+            WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.ID, 'submitBtnId')))
+            driver.find_element_by_id("submitBtnId").click()
+            # assuming we get a search result (what if it fails?) click on the first result,
+            # then click next until the results stop changing
+            WebDriverWait(driver, 20).until(
+                EC.visibility_of_element_located((By.PARTIAL_LINK_TEXT, 'Weekly Regional Ice Data')))
+            links = browse_results(driver)
+            for name, lnk in (links if known is None else known.new(links)):
+                if storefunc:
+                    storefunc(name, lnk)
+                target_files.append([name, lnk])
+        except StaleElementReferenceException:
+            print("Get CIS Data:  Stale reference exception from Selenium - failing gracefully but you need to try again")
+        except NoSuchElementException:
+            print("Get CIS Data:  No such element exception from Selenium - failing gracefully but you need to try again")
 
     print('Got {0} results'.format(len(target_files)))
     return target_files
 
 
+def store_once(storefunc: Callable[[str, str], None]) -> Callable[[str, str], None]:
+    """ a storefunc that passes each chart on to storefunc only the first time it is found, so when a search that
+    failed part way through is repeated the charts it found before failing aren't stored twice """
+    stored = set()
+
+    def store(name: str, lnk: str):
+        if name not in stored:
+            stored.add(name)
+            storefunc(name, lnk)
+    return store
+
+
 def gogetcisdata(startyear: int = STARTYEAR, startmonth: int = STARTMONTH, startday: int = STARTDAY,
-                 storefunc: Callable[[str, str], None] = None):
-    """ manage getting CIS data, uses multiple sessions to avoid throttling """
+                 storefunc: Callable[[str, str], None] = None, browsers: int = CIS_BROWSERS, method: str = 'http',
+                 known: 'KnownCharts' = None):
+    """ manage getting CIS data, uses multiple sessions to avoid throttling
+    by default the site is searched with plain HTTP requests, and a browser is only used for a search window if that
+    fails - set method to 'selenium' to always use the browser, which needs Firefox and geckodriver.
+    Charts in known are skipped, see KnownCharts
+    the browser searches share a pool of browsers, if browsers is more than one the searches run at the same time """
     thisyear = datetime.date.today().year
     if thisyear == startyear:
-        return query_cis_form(startyear, startmonth, startday, storefunc=storefunc)
+        years = [startyear]
+    else:
+        years = range(startyear, thisyear, CIS_YEARS_TO_QUERY)
 
     target_files = []
-    for yr in range(startyear, thisyear, CIS_YEARS_TO_QUERY):
-        target_files.extend(query_cis_form(yr, startmonth, startday, CIS_YEARS_TO_QUERY, storefunc=storefunc))
+    if storefunc is not None:
+        storefunc = store_once(storefunc)
+    # browsers are only started when they are needed
+    with BrowserPool(browsers) as pool:
+        if method == 'http':
+            client = CISArchiveClient()
+            for yr in years:
+                try:
+                    files = client.search(yr, startmonth, startday, CIS_YEARS_TO_QUERY, storefunc=storefunc,
+                                          known=known)
+                except (requests.RequestException, CISSearchError) as e:
+                    print('Get CIS Data:  HTTP search failed ({0}) - trying again with a browser'.format(e))
+                    files = query_cis_form(yr, startmonth, startday, CIS_YEARS_TO_QUERY, storefunc=storefunc, pool=pool,
+                                           known=known)
+                target_files.extend(files)
+        elif pool.size < 2:
+            for yr in years:
+                target_files.extend(query_cis_form(yr, startmonth, startday, CIS_YEARS_TO_QUERY, storefunc=storefunc,
+                                                   pool=pool, known=known))
+        else:
+            # storefunc is only called from this thread, in the order of the searches
+            with ThreadPoolExecutor(max_workers=pool.size) as executor:
+                searches = [executor.submit(query_cis_form, yr, startmonth, startday, CIS_YEARS_TO_QUERY, pool=pool,
+                                            known=known) for yr in years]
+                for search in searches:
+                    for name, lnk in search.result():
+                        if storefunc:
+                            storefunc(name, lnk)
+                        target_files.append([name, lnk])
 
     return target_files
@@ -29,18 +29,319 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 import datetime
+import calendar
+import hashlib
 import sqlite3
 import json
-from icechart import IceChart
+import zlib
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable
+import pystac
+from icechart import IceChart, STAC_TEMPLATES, FMT_SHP, GEO_NONE, GEO_EXACT
+
+# number of rows written per transaction by add_items and BatchWriter
+BATCH_SIZE = 500
+# number of rows read at a time by iter_items and iter_stac_items
+FETCH_SIZE = 500
+
+ITEM_COLUMNS = 'name, href, source, region, epoch, format, stac, exactgeo'
+
+# indexes for the ways the items table is searched, getlast uses the UNIQUE(source, epoch, region) index
+ITEM_INDEXES = {
+    # iter_items, get_stac_items for all years, and the counts and date ranges in summary
+    'items_source_region_epoch': 'items (source, region, epoch)',
+    # get_stac_items and iter_stac_items for a year
+    'items_source_region_year': 'items (source, region, year, epoch)',
+    # the charts still waiting for exact geometry, for update_geometry
+    'items_pending': 'items (source, region, epoch) WHERE exactgeo != {0}'.format(GEO_EXACT),
+    # known_names, read every time the database is filled
+    'items_source_name': 'items (source, name)',
+}
+
+# set on every connection. with the database in WAL mode (see StackDB.open) readers and the writer don't block each
+# other, and synchronous NORMAL only risks losing the last commits on a power failure, never corrupting the database
+PRAGMAS = {
+    'synchronous': 'NORMAL',
+    # in KiB when negative, 64MB
+    'cache_size': -65536,
+    # read the database through memory mapped I/O, up to 256MB of it
+    'mmap_size': 268435456,
+}
+# seconds a connection waits for another one (or another process) to finish writing before giving up
+BUSY_TIMEOUT = 60.0
+# put on the writer queue to stop the writer thread
+DONE = None
+
+# the largest preset dictionary made for compressing the stored STAC items, see StackDB.compress
+ZDICT_SIZE = 16384
+
+# the geometry and CRS of each item are stored once in the geometries and crs tables, which are written first,
+# and the rest of the item in items.stac. the stac_items view puts them back together.
+# deflate compresses the stored text if the database is compressed
+STAC_SPLIT = """json_replace({0}, '$.geometry', NULL, '$.properties."proj:geometry"', NULL, """ \
+             """'$.properties."proj:wkt2"', NULL)"""
+
+SHARED_INSERTS = ('INSERT OR IGNORE INTO geometries (hash, geometry) SELECT sha1(value), deflate(value) FROM ('
+                  "SELECT json_extract(?1, '$.geometry') AS value "
+                  """UNION ALL SELECT json_extract(?1, '$.properties."proj:geometry"')) WHERE value IS NOT NULL;""",
+                  'INSERT OR IGNORE INTO crs (hash, wkt) SELECT sha1(value), value FROM ('
+                  """SELECT json_extract(?1, '$.properties."proj:wkt2"') AS value) WHERE value IS NOT NULL;""")
+
+ITEM_INSERT = 'INSERT OR REPLACE INTO items (name, href, source, region, epoch, format, stac, exactgeo, ' \
+              'geometry_id, pgeometry_id, crs_id) VALUES(?1, ?2, ?3, ?4, ?5, ?6, ' \
+              'deflate(' + STAC_SPLIT.format('?7') + '), ?8, ' \
+              "(SELECT id FROM geometries WHERE hash = sha1(json_extract(?7, '$.geometry'))), " \
+              """(SELECT id FROM geometries WHERE hash = sha1(json_extract(?7, '$.properties."proj:geometry"'))), """ \
+              """(SELECT id FROM crs WHERE hash = sha1(json_extract(?7, '$.properties."proj:wkt2"'))));"""
+
+GEOMETRY_INSERT = 'INSERT OR REPLACE INTO geometry_cache (href, validator, exact, geometry) VALUES(?,?,?,?);'
+
+# epochs are stored as whole seconds since 1970 (UTC) in columns declared as unixepoch, and read back as datetimes
+UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+sqlite3.register_converter('unixepoch', lambda value: UNIX_EPOCH + datetime.timedelta(seconds=int(value)))
+# the year of an epoch in SQL
+EPOCH_YEAR = "CAST(strftime('%Y', {0}, 'unixepoch') AS INTEGER)"
+
+
+def epoch_seconds(epoch) -> int:
+    """ the seconds since 1970 stored for a datetime, or a date string such as 2020-01-31 or 2020-01-31 12:00:00 """
+    if isinstance(epoch, str):
+        epoch = datetime.datetime.fromisoformat(epoch)
+    if isinstance(epoch, datetime.datetime):
+        return calendar.timegm(epoch.utctimetuple())
+    return int(epoch)
+
+
+def sha1(text: str) -> bytes:
+    """ the hash the shared geometry and CRS text is found by, used as an SQL function """
+    return hashlib.sha1(text.encode()).digest() if text is not None else None
+
+
+def item_row(item: IceChart) -> tuple:
+    """ the column values used to store an IceChart in the items table """
+    return (item.name, item.href, item.source, item.region, epoch_seconds(item.epoch), item.format, item.to_json(),
+            item.exactgeo,)
+
+
+def geometry_row(href: str, validator: str, geo: dict) -> tuple:
+    """ the column values used to store a geometry dict from compute_geometry in the geometry_cache table """
+    return href, validator, geo.get('exact', True), json.dumps(geo)
+
+
+def write_rows(rows: list, georows: list, cursor):
+    """ write item_row and geometry_row rows, the shared geometry and CRS before the items that refer to them """
+    cursor.executemany(GEOMETRY_INSERT, georows)
+    for sql in SHARED_INSERTS:
+        cursor.executemany(sql, ((row[6],) for row in rows))
+    cursor.executemany(ITEM_INSERT, rows)
+
+
+def _create_tables(cursor):
+    """ schema version 1, the tables from before the version was kept, some of which older databases already have """
+    cursor.execute('CREATE TABLE IF NOT EXISTS items ('
+                   'name TEXT NOT NULL,'
+                   'href TEXT NOT NULL,'
+                   'source TEXT NOT NULL,'
+                   'region TEXT NOT NULL,'
+                   'epoch timestamp NOT NULL,'
+                   'format TEXT NOT NULL,'
+                   'stac TEXT NOT NULL, '
+                   'exactgeo INTEGER NOT NULL,'
+                   'UNIQUE(source, epoch, region));')
+    cursor.execute('CREATE TABLE IF NOT EXISTS geometry_cache ('
+                   'href TEXT PRIMARY KEY,'
+                   'validator TEXT NOT NULL,'
+                   'exact INTEGER NOT NULL,'
+                   'geometry TEXT NOT NULL);')
+
+
+def _integer_epochs(cursor):
+    """ schema version 2, epochs in seconds rather than text, and the year of each epoch in a generated column """
+    cursor.execute('ALTER TABLE items RENAME TO items_v1;')
+    cursor.execute('CREATE TABLE items ('
+                   'name TEXT NOT NULL,'
+                   'href TEXT NOT NULL,'
+                   'source TEXT NOT NULL,'
+                   'region TEXT NOT NULL,'
+                   'epoch unixepoch NOT NULL,'
+                   'format TEXT NOT NULL,'
+                   'stac TEXT NOT NULL, '
+                   'exactgeo INTEGER NOT NULL,'
+                   'year INTEGER GENERATED ALWAYS AS ({0}) VIRTUAL,'
+                   'UNIQUE(source, epoch, region));'.format(EPOCH_YEAR.format('epoch')))
+    cursor.execute('INSERT INTO items (name, href, source, region, epoch, format, stac, exactgeo) '
+                   "SELECT name, href, source, region, CAST(strftime('%s', epoch) AS INTEGER), format, stac, exactgeo "
+                   'FROM items_v1;')
+    cursor.execute('DROP TABLE items_v1;')
+
+
+def _shared_geometry(cursor):
+    """ schema version 3, the geometry and CRS of the items in tables of their own, so the charts that have their
+    region's outline share a single copy of it """
+    cursor.execute('CREATE TABLE geometries (id INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE, geometry TEXT NOT NULL);')
+    cursor.execute('CREATE TABLE crs (id INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE, wkt TEXT NOT NULL);')
+    cursor.execute('ALTER TABLE items ADD COLUMN geometry_id INTEGER REFERENCES geometries (id);')
+    cursor.execute('ALTER TABLE items ADD COLUMN pgeometry_id INTEGER REFERENCES geometries (id);')
+    cursor.execute('ALTER TABLE items ADD COLUMN crs_id INTEGER REFERENCES crs (id);')
+    cursor.execute('INSERT OR IGNORE INTO geometries (hash, geometry) SELECT sha1(value), value FROM ('
+                   "SELECT json_extract(stac, '$.geometry') AS value FROM items "
+                   """UNION ALL SELECT json_extract(stac, '$.properties."proj:geometry"') FROM items) """
+                   'WHERE value IS NOT NULL;')
+    cursor.execute('INSERT OR IGNORE INTO crs (hash, wkt) SELECT sha1(value), value FROM ('
+                   """SELECT json_extract(stac, '$.properties."proj:wkt2"') AS value FROM items) WHERE value IS NOT NULL;""")
+    cursor.execute('UPDATE items SET '
+                   "geometry_id = (SELECT id FROM geometries WHERE hash = sha1(json_extract(stac, '$.geometry'))), "
+                   'pgeometry_id = (SELECT id FROM geometries WHERE '
+                   """hash = sha1(json_extract(stac, '$.properties."proj:geometry"'))), """
+                   """crs_id = (SELECT id FROM crs WHERE hash = sha1(json_extract(stac, '$.properties."proj:wkt2"'))), """
+                   """stac = json_replace(stac, '$.geometry', NULL, '$.properties."proj:geometry"', NULL, """
+                   """'$.properties."proj:wkt2"', NULL);""")
+    cursor.execute('CREATE VIEW stac_items AS SELECT name, href, source, region, epoch, format, '
+                   """json_replace(stac, '$.geometry', json(g.geometry), '$.properties."proj:geometry"', json(p.geometry), """
+                   """'$.properties."proj:wkt2"', c.wkt) AS stac, exactgeo, year FROM items """
+                   'LEFT JOIN geometries AS g ON g.id = geometry_id LEFT JOIN geometries AS p ON p.id = pgeometry_id '
+                   'LEFT JOIN crs AS c ON c.id = crs_id;')
+
+
+def _compression(cursor):
+    """ schema version 4, a table of settings such as the dictionary used to compress the items, and the stac_items
+    view decompressing them """
+    cursor.execute('CREATE TABLE settings (name TEXT PRIMARY KEY, value);')
+    cursor.execute('DROP VIEW stac_items;')
+    cursor.execute('CREATE VIEW stac_items AS SELECT name, href, source, region, epoch, format, '
+                   """json_replace(inflate(stac), '$.geometry', json(inflate(g.geometry)), """
+                   """'$.properties."proj:geometry"', json(inflate(p.geometry)), """
+                   """'$.properties."proj:wkt2"', c.wkt) AS stac, exactgeo, year FROM items """
+                   'LEFT JOIN geometries AS g ON g.id = geometry_id LEFT JOIN geometries AS p ON p.id = pgeometry_id '
+                   'LEFT JOIN crs AS c ON c.id = crs_id;')
+
+
+def _geometry_levels(cursor):
+    """ schema version 5, exactgeo is GEO_BBOX for the charts given only their bounding box, the items_pending index
+    is made again (after the migrations) to cover them as well as the charts with no geometry """
+    cursor.execute('DROP INDEX IF EXISTS items_pending;')
+
+
+# MIGRATIONS[n] updates a database from schema version n (PRAGMA user_version) to n + 1,
+# new databases are made by running all of them
+MIGRATIONS = (_create_tables, _integer_epochs, _shared_geometry, _compression, _geometry_levels)
+
+
+class BatchWriter:
+    """ buffer IceChart objects and write them to a StackDB with executemany, one transaction per batch
+    use as a context manager so the last partial batch is always written:
+        with db.batch() as batch:
+            batch.add(chart)
+    each batch is written by the database's writer thread while the next one is filled, a BatchWriter is meant to be
+    used by a single thread but each thread can have its own """
+
+    def __init__(self, db, batch_size: int = BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.rows = []
+        self.georows = []
+        self.count = 0
+        # the batch being written and its number of rows
+        self.pending = None
+
+    def add(self, item: IceChart):
+        """ queue an IceChart object, writing the batch when it is full """
+        self.rows.append(item_row(item))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_from_name(self, name: str, href: str):
+        """ queue an IceChart by name - can be used as a storefunc for the scrapers """
+        self.add(IceChart.from_name(name, href))
+
+    def add_geometry(self, href: str, validator: str, geo: dict):
+        """ queue a geometry cache entry, it is written in the same transaction as the items """
+        self.georows.append(geometry_row(href, validator, geo))
+
+    def flush(self):
+        """ write all the queued rows in a single transaction, once the previous batch has been written
+        an error writing a batch is raised here or on exit, and the whole batch is rolled back """
+        # if the previous batch failed this one stays queued, to be written by the next flush
+        self.wait()
+        rows, self.rows = self.rows, []
+        georows, self.georows = self.georows, []
+        if rows or georows:
+            self.pending = self.db.submit(partial(write_rows, rows, georows), wait=False), len(rows)
+
+    def wait(self):
+        """ wait for the batch being written to be committed """
+        if self.pending is not None:
+            (future, count), self.pending = self.pending, None
+            future.result()
+            self.count += count
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # keep the work done so far even if we are interrupted
+        if exc_type is None:
+            self.flush()
+            self.wait()
+            return
+        # but let the reason we were interrupted through, rather than an error from writing the batches
+        for write in (self.wait, self.flush, self.wait):
+            try:
+                write()
+            except Exception as e:
+                print('Error writing batch after {0}: {1}'.format(exc_type.__name__, e))
+
+
+class GeometryCache:
+    """ geometry computed for charts, kept in the geometry_cache table of a StackDB so it is only computed again
+    when the file changes. each entry is stored with the validator (ETag or size) the file had when it was read.
+    if mode is 'hull' only exact geometry is returned, for 'bbox' any entry will do.
+    if a BatchWriter is given new entries are written with its batches, otherwise they are committed at once """
+
+    def __init__(self, db, mode: str = 'hull', batch: BatchWriter = None):
+        self.db = db
+        self.mode = mode
+        self.batch = batch
+
+    def get(self, href: str):
+        """ return the (validator, geometry) of href, or None if there is no suitable entry """
+        rows = self.db.query('SELECT validator, geometry FROM geometry_cache WHERE href = ? AND (exact OR ?);',
+                             (href, self.mode == 'bbox'), fetch=True)
+        if not rows:
+            return None
+        return rows[0][0], json.loads(rows[0][1])
+
+    def put(self, href: str, validator: str, geo: dict):
+        """ store the geometry of href """
+        if self.batch is not None:
+            self.batch.add_geometry(href, validator, geo)
+        else:
+            self.db.submit(partial(write_rows, [], [geometry_row(href, validator, geo)]))
 
 
 class StackDB:
-    """ a database (sqlite3) for storing IceChart objects """
+    """ a database (sqlite3) for storing IceChart objects
+    each thread reads through a connection of its own, and all the writes are made one at a time by a writer thread
+    (see submit), so a StackDB can be shared by threads. use snapshot to read a consistent view of the database while
+    it is being written, by this or another process """
 
     def __init__(self, name=':memory:'):
 
-        self.conn = None
-        self.cursor = None
+        self.name = None
+        # the calling thread's connection and cursor, see conn
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.RLock()
+        # jobs for the writer thread, which is started by the first write
+        self._writes = queue.Queue()
+        self._writer = None
+        # the preset dictionary the items are compressed with, or None if they are not
+        self.zdict = None
 
         if name:
             self.open(name)
@@ -49,20 +350,69 @@ class StackDB:
 
     def open(self, name):
 
+        self.name = name
         try:
-            self.conn = sqlite3.connect(name, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-            self.conn.row_factory = sqlite3.Row
-            self.cursor = self.conn.cursor()
+            if not self.memory:
+                # kept by the database file, so other programs reading it get the same
+                self.conn.execute('PRAGMA journal_mode = WAL;')
 
         except sqlite3.Error as e:
             print("Error connecting to database! {0}".format(e))
 
-    def close(self):
+    @property
+    def memory(self) -> bool:
+        """ True for an in-memory database, which has a single connection shared by all threads and is written by
+        the thread writing to it rather than a writer thread """
+        return self.name == ':memory:'
+
+    def _connect(self) -> sqlite3.Connection:
+        """ a new connection to the database, set up to read and write items """
+        # each connection is only used by one thread (or all of them for an in-memory database, but the writes are
+        # serialized), and close closes them from whichever thread calls it
+        conn = sqlite3.connect(self.name, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        conn.row_factory = sqlite3.Row
+        # needed to add items, and (inflate) to read them
+        conn.create_function('sha1', 1, sha1, deterministic=True)
+        conn.create_function('deflate', 1, self.deflate)
+        conn.create_function('inflate', 1, self.inflate)
+        for pragma, value in PRAGMAS.items():
+            conn.execute('PRAGMA {0} = {1};'.format(pragma, value))
+        self._connections.append(conn)
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """ the calling thread's connection to the database, made the first time it is used """
+        if self.name is None:
+            return None
+        if getattr(self._local, 'conn', None) is None:
+            with self._lock:
+                if self.memory and self._connections:
+                    self._local.conn = self._connections[0]
+                else:
+                    self._local.conn = self._connect()
+            self._local.cursor = self._local.conn.cursor()
+        return self._local.conn
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """ the calling thread's cursor """
+        return self._local.cursor if self.conn is not None else None
 
-        if self.conn:
-            self.conn.commit()
-            self.cursor.close()
-            self.conn.close()
+    def close(self):
+        """ finish writing, and close the connections of all the threads """
+        if self._writer is not None:
+            self._writes.put(DONE)
+            self._writer.join()
+            self._writer = None
+        with self._lock:
+            for conn in self._connections:
+                conn.commit()
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+        self.name = None
 
     def __enter__(self):
 
@@ -72,6 +422,66 @@ class StackDB:
 
         self.close()
 
+    def submit(self, job: Callable, wait: bool = True) -> Future:
+        """ run job(cursor) in a transaction of its own, committed when it returns or rolled back if it raises.
+        all the writes are made one at a time by a single writer thread, in the order they are submitted, so threads
+        writing at the same time never wait on each other's locks. returns a Future for the job's result, if wait is
+        True the job has finished and any error it raised is raised here """
+        future = Future()
+        if self.memory:
+            with self._lock:
+                self._run(job, future)
+        else:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name='StackDB writer', daemon=True)
+                    self._writer.start()
+            self._writes.put((job, future))
+        if wait:
+            future.result()
+        return future
+
+    def _write_loop(self):
+        """ the writer thread, runs the jobs given to submit until close stops it """
+        while True:
+            job = self._writes.get()
+            if job is DONE:
+                return
+            self._run(*job)
+
+    def _run(self, job: Callable, future: Future):
+        """ run a job for submit with this thread's connection """
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            with self.conn:
+                result = job(self.cursor)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    @contextmanager
+    def snapshot(self):
+        """ a context in which the calling thread reads the database as it was when it started, even if it is written
+        to meanwhile, such as by a fill while a catalog is written. snapshots are for reading, as anything written
+        through this thread's connection is rolled back at the end of one.
+            with db.snapshot():
+                summary = db.summary()
+        """
+        conn = self.conn
+        if conn.in_transaction:
+            # already in a snapshot
+            yield self
+            return
+        conn.execute('BEGIN;')
+        try:
+            # the snapshot is taken by the first read
+            conn.execute('PRAGMA schema_version;').fetchone()
+            yield self
+        finally:
+            conn.rollback()
+
     def get(self, table, columns, limit=None):
 
         query = "SELECT {0} from {1};".format(columns, table)
@@ -84,12 +494,16 @@ class StackDB:
 
     def getlast(self, source='NIC'):
         """ returns the datetime of the oldest record for the selected source """
-        sql = 'SELECT max(epoch) FROM items WHERE source = ?;'
-        res = self.query(sql, (source,), fetch=True)[0][0]
-        if res is not None:
-            return datetime.datetime.strptime(res, "%Y-%m-%d %H:%M:%S")
+        sql = 'SELECT max(epoch) AS "last [unixepoch]" FROM items WHERE source = ?;'
+        return self.query(sql, (source,), fetch=True)[0][0]
+
+    def known_names(self, source: str = 'Any') -> set:
+        """ return the set of the names of all the items, optionally for a single source """
+        if source == 'Any':
+            rows = self.query('SELECT name FROM items;', fetch=True)
         else:
-            return None
+            rows = self.query('SELECT name FROM items WHERE source = ?;', (source,), fetch=True)
+        return {row[0] for row in rows}
 
     def write(self, table, columns, data):
         query = "INSERT INTO {0} ({1}) VALUES ({2});".format(table, columns, data)
@@ -106,61 +520,145 @@ class StackDB:
     def summary(self):
         """ return a dict of summary statistics for the items table """
         ret = {}
-        # total items
-        sql = 'SELECT COUNT(*) FROM items;'
-        ret['Total Items'] = self.query(sql, fetch=True)[0][0]
-
-        # list of sources
-        ret['Sources'] = []
-        sql = 'SELECT source FROM items GROUP BY source;'
-        for x in self.query(sql, fetch=True):
-            ret['Sources'].append(x[0])
-
-        # count by source
-        sql = 'SELECT source, count(source), min(epoch), max(epoch) FROM items GROUP BY source;'
-        sct = self.query(sql, fetch=True)
-        for src in sct:
-            ret[src[0] + ' Count'] = src[1]
-            ret[src[0] + ' Date Range'] = [datetime.datetime.strptime(src[2], '%Y-%m-%d %H:%M:%S').year,
-                                           datetime.datetime.strptime(src[3], '%Y-%m-%d %H:%M:%S').year]
-
-        # count by region
-        for src in sct:
-            sql = 'SELECT region, count(region), min(epoch), max(epoch) FROM items WHERE source=? GROUP BY region;'
-            rct = self.query(sql, (src[0],), fetch=True)
-            ret[src[0] + ' Regions'] = []
-            for rgn in rct:
-                ret[src[0] + ' Regions'].append(rgn[0])
-                ret[' '.join((src[0], rgn[0], 'Count'))] = rgn[1]
-                ret[' '.join((src[0], rgn[0], 'Date Range'))] = [
-                    datetime.datetime.strptime(rgn[2], '%Y-%m-%d %H:%M:%S').year,
-                    datetime.datetime.strptime(rgn[3], '%Y-%m-%d %H:%M:%S').year]
+        # from a single snapshot, so the counts agree if items are being added
+        with self.snapshot():
+            # total items
+            sql = 'SELECT COUNT(*) FROM items;'
+            ret['Total Items'] = self.query(sql, fetch=True)[0][0]
+
+            # list of sources
+            ret['Sources'] = []
+            sql = 'SELECT source FROM items GROUP BY source;'
+            for x in self.query(sql, fetch=True):
+                ret['Sources'].append(x[0])
+
+            # count by source
+            # the years come from the first and last epochs, as these can be read from the items_source_region_epoch index
+            years = '{0}, {1}'.format(EPOCH_YEAR.format('min(epoch)'), EPOCH_YEAR.format('max(epoch)'))
+            sql = 'SELECT source, count(source), {0} FROM items GROUP BY source;'.format(years)
+            sct = self.query(sql, fetch=True)
+            for src in sct:
+                ret[src[0] + ' Count'] = src[1]
+                ret[src[0] + ' Date Range'] = [src[2], src[3]]
+
+            # count by region
+            for src in sct:
+                sql = 'SELECT region, count(region), {0} FROM items WHERE source=? GROUP BY region;'.format(years)
+                rct = self.query(sql, (src[0],), fetch=True)
+                ret[src[0] + ' Regions'] = []
+                for rgn in rct:
+                    ret[src[0] + ' Regions'].append(rgn[0])
+                    ret[' '.join((src[0], rgn[0], 'Count'))] = rgn[1]
+                    ret[' '.join((src[0], rgn[0], 'Date Range'))] = [rgn[2], rgn[3]]
         return ret
 
     def create_tables(self):
-        """ create table specifically for storing IceChart objects """
-        sql = 'CREATE TABLE IF NOT EXISTS items (' \
-              'name TEXT NOT NULL,' \
-              'href TEXT NOT NULL,' \
-              'source TEXT NOT NULL,' \
-              'region TEXT NOT NULL,' \
-              'epoch timestamp NOT NULL,' \
-              'format TEXT NOT NULL,' \
-              'stac TEXT NOT NULL, ' \
-              'exactgeo INTEGER NOT NULL,' \
-              'UNIQUE(source, epoch, region));'
-        self.query(sql)
+        """ create tables specifically for storing IceChart objects, and the geometry computed for them,
+        or update the tables of an existing database to the current schema version """
+        version = self.query('PRAGMA user_version;', fetch=True)[0][0]
+        if version > len(MIGRATIONS):
+            # its tables may not be what the queries here expect, so don't read or write them
+            self.close()
+            raise sqlite3.DatabaseError('Database schema version {0} is newer than this program knows ({1})'.format(
+                version, len(MIGRATIONS)))
+        updating = version < len(MIGRATIONS) and \
+            self.query("SELECT count(*) FROM sqlite_master WHERE name = 'items';", fetch=True)[0][0] > 0
+        if updating:
+            print('Updating database schema from version {0} to {1}'.format(version, len(MIGRATIONS)))
+        # each migration is committed with its version, so an interrupted update starts again where it stopped
+        for n in range(version, len(MIGRATIONS)):
+            self.cursor.execute('BEGIN;')
+            try:
+                MIGRATIONS[n](self.cursor)
+                self.cursor.execute('PRAGMA user_version = {0};'.format(n + 1))
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+        # this also adds any new indexes to databases made before them
+        for name, index in ITEM_INDEXES.items():
+            self.query('CREATE INDEX IF NOT EXISTS {0} ON {1};'.format(name, index))
+        if updating:
+            # give back the space the old layout used
+            self.conn.commit()
+            self.query('VACUUM;')
+        self._load_zdict()
+
+    def _load_zdict(self):
+        """ read the preset dictionary the items are compressed with from the settings table """
+        rows = self.query("SELECT value FROM settings WHERE name = 'zdict';", fetch=True)
+        self.zdict = rows[0][0] if rows else None
+
+    def deflate(self, text: str):
+        """ the text compressed with the database's preset dictionary, or the text itself if it is not compressed """
+        if self.zdict is None or text is None:
+            return text
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=self.zdict)
+        return compressor.compress(text.encode()) + compressor.flush()
+
+    def inflate(self, value) -> str:
+        """ the text of a value written by deflate """
+        if not isinstance(value, bytes):
+            return value
+        decompressor = zlib.decompressobj(-15, zdict=self.zdict)
+        return (decompressor.decompress(value) + decompressor.flush()).decode()
+
+    def compress(self, enable: bool = True):
+        """ compress the STAC items and geometry stored in the database, including any added later, or stop
+        compressing them if enable is False. they are compressed with zlib and a preset dictionary made from examples
+        of the items, which is kept in the settings table. only the queries that read stac from the stac_items view
+        decompress them, summary, getlast, count_items and known_names don't """
+        if enable == (self.zdict is not None):
+            return
+
+        def update(cursor):
+            if enable:
+                self.zdict = self._train_zdict()
+                cursor.execute("INSERT INTO settings (name, value) VALUES ('zdict', ?);", (self.zdict,))
+                cursor.execute("UPDATE items SET stac = deflate(stac) WHERE typeof(stac) = 'text';")
+                cursor.execute("UPDATE geometries SET geometry = deflate(geometry) WHERE typeof(geometry) = 'text';")
+            else:
+                cursor.execute("UPDATE items SET stac = inflate(stac) WHERE typeof(stac) = 'blob';")
+                cursor.execute("UPDATE geometries SET geometry = inflate(geometry) WHERE typeof(geometry) = 'blob';")
+                cursor.execute("DELETE FROM settings WHERE name = 'zdict';")
+
+        try:
+            self.submit(update)
+        finally:
+            self._load_zdict()
+        self.submit(lambda cursor: cursor.execute('VACUUM;'))
+
+    def _train_zdict(self) -> bytes:
+        """ a preset dictionary for compressing the stored items: an item made from each region's template, then the
+        latest item of each source, region and format in the database, as zlib finds the end of it quickest """
+        samples = [self.query('SELECT ' + STAC_SPLIT.format('?') + ';', (template.json(
+            'sample', datetime.datetime(2000, 1, 1), 'https://', FMT_SHP),), fetch=True)[0][0]
+            for template in STAC_TEMPLATES.values()]
+        latest = 'SELECT max(rowid) FROM items GROUP BY source, region, format'
+        samples += [row[0] for row in self.query('SELECT stac FROM items WHERE rowid IN ({0});'.format(latest), fetch=True)]
+        return ''.join(samples).encode()[-ZDICT_SIZE:]
 
     def add_item(self, item: IceChart):
         """ Add an IceChart object to the items table """
-        sql = 'INSERT OR REPLACE INTO items (name, href, source, region, epoch, format, stac, exactgeo)' \
-              ' VALUES(?,?,?,?,?,?,?,?);'
-        dt = (item.name, item.href, item.source, item.region, item.epoch, item.format, json.dumps(item.stac.to_dict()),
-              item.exactgeo,)
-        self.cursor.execute(sql, dt)
-        self.conn.commit()
+        self.submit(partial(write_rows, [item_row(item)], []))
         return
 
+    def add_items(self, items, batch_size: int = BATCH_SIZE) -> int:
+        """ Add an iterable of IceChart objects to the items table, committing once per batch
+        returns the number of rows written """
+        with self.batch(batch_size) as batch:
+            for item in items:
+                batch.add(item)
+        return batch.count
+
+    def batch(self, batch_size: int = BATCH_SIZE) -> BatchWriter:
+        """ return a BatchWriter context manager for adding many items to this database """
+        return BatchWriter(self, batch_size)
+
+    def geometry_cache(self, mode: str = 'hull', batch: BatchWriter = None) -> GeometryCache:
+        """ return a GeometryCache for this database, see GeometryCache for mode and batch """
+        return GeometryCache(self, mode, batch)
+
     def add_item_from_name(self, name: str, href: str):
         """ Add an IceChart by name to the items table"""
         chart = IceChart.from_name(name, href)
@@ -168,74 +666,96 @@ class StackDB:
         # self.conn.commit()
         return
 
-    # get a list of items
-    def get_items(self, source: str = 'Any', region: str = 'Any', epoch1: str = 'Any', epoch2: str = 'Any',
-                  exactgeo: str = 'Any') -> [IceChart]:
-        """ return an iterable list of IceChart objects """
-        sql = 'SELECT name, href, source, region, epoch, format, stac, exactgeo FROM ITEMS'
-        dt = []
-        w_cls = False
+    @staticmethod
+    def _where(source: str = 'Any', region: str = 'Any', epoch1: str = 'Any', epoch2: str = 'Any',
+               exactgeo: str = 'Any', year: str = 'All') -> (list, list):
+        """ the conditions and parameters used to select items, as for get_items and get_stac_items """
+        clauses, params = [], []
         if source != 'Any':
-            sql = sql + ' WHERE source=?'
-            w_cls = True
-            dt.append(source)
+            clauses.append('source=?')
+            params.append(source)
         if region != 'Any':
-            if w_cls:
-                sql = sql + ' AND region=?'
-            else:
-                sql = sql + ' WHERE region=?'
-            w_cls = True
-            dt.append(region)
+            clauses.append('region=?')
+            params.append(region)
         if epoch1 != 'Any':
-            if w_cls:
-                sql = sql + ' AND epoch'
-            else:
-                sql = sql + ' WHERE epoch'
-            dt.append(epoch1)
             if epoch2 != 'Any':
-                sql = sql + ' BETWEEN ? AND ?'
-                dt.append(epoch2)
+                clauses.append('epoch BETWEEN ? AND ?')
+                params.extend((epoch_seconds(epoch1), epoch_seconds(epoch2)))
             else:
-                sql = sql + '=?'
-        if exactgeo == 'False':
-            if w_cls:
-                sql = sql + ' AND NOT exactgeo'
-            else:
-                sql = sql + ' WHERE NOT exactgeo'
-            w_cls = True
+                clauses.append('epoch=?')
+                params.append(epoch_seconds(epoch1))
+        if year != 'All':
+            clauses.append('year=?')
+            params.append(int(year))
+        # 'False' is every chart without exact geometry, 'None' just those with no geometry read from the file,
+        # the clauses use literals so they match items_pending
+        if exactgeo in ('False', 'None'):
+            clauses.append('exactgeo != {0}'.format(GEO_EXACT))
+        if exactgeo == 'None':
+            clauses.append('exactgeo = {0}'.format(GEO_NONE))
         if exactgeo == 'True':
-            if w_cls:
-                sql = sql + ' AND exactgeo'
-            else:
-                sql = sql + ' WHERE exactgeo'
-            w_cls = True
+            clauses.append('exactgeo = {0}'.format(GEO_EXACT))
+        return clauses, params
+
+    # get a list of items
+    def get_items(self, source: str = 'Any', region: str = 'Any', epoch1: str = 'Any', epoch2: str = 'Any',
+                  exactgeo: str = 'Any') -> [IceChart]:
+        """ return an iterable list of IceChart objects """
+        clauses, dt = self._where(source, region, epoch1, epoch2, exactgeo)
+        sql = 'SELECT name, href, source, region, epoch, format, stac, exactgeo FROM stac_items'
+        if clauses:
+            sql = sql + ' WHERE ' + ' AND '.join(clauses)
         # sql = sql + ' ORDER BY source, region, epoch DESC;'
         print(sql, dt)
         return self.query(sql, dt, fetch=True)
 
+    def count_items(self, source: str = 'Any', region: str = 'Any', epoch1: str = 'Any', epoch2: str = 'Any',
+                    exactgeo: str = 'Any', year: str = 'All') -> int:
+        """ return the number of items that get_items or iter_items would return """
+        clauses, dt = self._where(source, region, epoch1, epoch2, exactgeo, year)
+        sql = 'SELECT COUNT(*) FROM items' + (' WHERE ' + ' AND '.join(clauses) if clauses else '') + ';'
+        return self.query(sql, dt, fetch=True)[0][0]
+
+    def iter_items(self, source: str = 'Any', region: str = 'Any', epoch1: str = 'Any', epoch2: str = 'Any',
+                   exactgeo: str = 'Any', year: str = 'All', columns: str = ITEM_COLUMNS, chunk: int = FETCH_SIZE,
+                   after: tuple = None, newest_first: bool = False, charts: bool = False):
+        """ iterate over the selected rows of the items table, ordered by source, region and epoch (or in reverse
+        if newest_first is True), without reading them all into memory.
+        the rows are fetched chunk at a time, and each chunk is a new query for the rows after the last one that was
+        read (keyset pagination), so the table can be written to between chunks.
+        after is a (source, region, epoch) to start after, such as the last row of an earlier run.
+        columns must include source, region and epoch.  if charts is True IceCharts are returned instead of rows,
+        their STAC items are only parsed if they are used """
+        clauses, params = self._where(source, region, epoch1, epoch2, exactgeo, year)
+        # each chunk is read straight from the items_source_region_epoch index (backwards if newest_first),
+        # rather than finding and sorting all of the remaining rows
+        if newest_first:
+            order = 'source DESC, region DESC, epoch DESC'
+            keyset = '(source, region, epoch) < (?, ?, ?)'
+        else:
+            order = 'source, region, epoch'
+            keyset = '(source, region, epoch) > (?, ?, ?)'
+        key = tuple(after) if after else None
+        while True:
+            where = clauses + [keyset] if key else clauses
+            sql = 'SELECT {0} FROM stac_items{1} ORDER BY {2} LIMIT ?;'.format(
+                columns, ' WHERE ' + ' AND '.join(where) if where else '', order)
+            keyvars = [key[0], key[1], epoch_seconds(key[2])] if key else []
+            cursor = self.conn.execute(sql, params + keyvars + [chunk])
+            rows = cursor.fetchmany(chunk)
+            cursor.close()
+            for row in rows:
+                yield IceChart.from_row(row) if charts else row
+            if len(rows) < chunk:
+                return
+            key = (rows[-1]['source'], rows[-1]['region'], rows[-1]['epoch'])
+
     def get_stac_items(self, source='Any', region='Any', year='All', limit=None):
         """ return a list of STAC objects """
-        sql = 'SELECT stac FROM items'
-        dt = []
-        w_cls = False
-        if source != "Any":
-            w_cls = True
-            sql = sql + ' WHERE source=?'
-            dt.append(source)
-        if region != 'Any':
-            if w_cls:
-                sql = sql + ' AND region=?'
-            else:
-                sql = sql + ' WHERE region=?'
-            w_cls = True
-            dt.append(region)
-        if year != 'All':
-            if w_cls:
-                sql = sql + ' AND epoch BETWEEN ? AND ?'
-            else:
-                sql = sql + ' WHERE epoch BETWEEN ? AND ?'
-            dt.append('{0}-01-01'.format(year))
-            dt.append('{0}-12-31'.format(year))
+        clauses, dt = self._where(source, region, year=year)
+        sql = 'SELECT stac FROM stac_items'
+        if clauses:
+            sql = sql + ' WHERE ' + ' AND '.join(clauses)
 
         sql = sql + ' ORDER BY source, region, epoch DESC'
         if limit:
@@ -248,6 +768,13 @@ class StackDB:
         # self.cursor.execute(sql, dt)
         # return self.cursor.fetchall()
 
+    def iter_stac_items(self, source='Any', region='Any', year='All', chunk: int = FETCH_SIZE, decode: bool = False):
+        """ iterate over the STAC JSON text of the selected items, newest first for each source and region as with
+        get_stac_items, reading chunk rows at a time. if decode is True pystac Items are returned instead of the text """
+        for row in self.iter_items(source, region, year=year, columns='source, region, epoch, stac', chunk=chunk,
+                                   newest_first=True):
+            yield pystac.Item.from_dict(json.loads(row['stac'])) if decode else row['stac']
+
     # get a record and return the column data as a dict or a STAC item (json)
 
     # return a collection
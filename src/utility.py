@@ -29,30 +29,48 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 import os
+import io
 import re
 from urllib.parse import urljoin
+import time
+import shutil
 import tempfile
 import zipfile
+import zlib
 from zipfile import BadZipFile
+from contextlib import contextmanager, closing
 import requests
 from bs4 import BeautifulSoup
 
-from shapely.geometry import shape, Point, Polygon, MultiPoint, MultiPolygon, mapping
-from shapely.ops import transform
 import fiona
-import pyproj
+from fiona.io import ZipMemoryFile
+from cache import get_download_cache, response_key, TIMEOUT
+from remotezip import read_shapefile, RemoteFile, RangeNotSupported, READAHEAD
+from geometry import StreamingHull, projections, outline_geometry, extent_geometry, shp_header_bbox, SHP_HEADER_SIZE
+from e00 import e00_geometry, E00Error
+
+# zipped charts up to this size are processed in memory, bigger ones are spooled to a temporary file
+ZIP_MEMORY_LIMIT = 64 * 1024 * 1024
+DOWNLOAD_CHUNK = 64 * 1024
+# bytes downloaded for exact geometry, and bytes not downloaded thanks to range requests, in this process
+transfer = {'Bytes Read': 0, 'Bytes Saved': 0}
+# the validator (see content_validator) of each file downloaded for its geometry in this process, taken from the
+# download itself so cached_geometry doesn't have to ask the server for it before the first download
+download_validators = {}
 
 
 def extract_form_fields(soup):
     """Turn a BeautifulSoup form in to a dict of fields and default values"""
     fields = {}
     for input_fld in soup.findAll('input'):
-        # ignore submit/image with no name attribute
-        if input_fld['type'] in ('submit', 'image') or not input_fld.has_attr('name'):
+        # inputs without a type are text fields
+        input_type = input_fld.get('type', 'text').lower()
+        # ignore buttons (they are only sent when clicked) and inputs with no name attribute
+        if input_type in ('submit', 'image', 'button', 'reset') or not input_fld.has_attr('name'):
             continue
 
         # single element name/value fields
-        if input_fld['type'] in ('text', 'hidden', 'password', 'submit', 'image'):
+        if input_type in ('text', 'hidden', 'password', 'search', 'number', 'email'):
             value = ''
             if input_fld.has_attr('value'):
                 value = input_fld['value']
@@ -60,7 +78,7 @@ def extract_form_fields(soup):
             continue
 
         # checkboxes and radios
-        if input_fld['type'] in ('checkbox', 'radio'):
+        if input_type in ('checkbox', 'radio'):
             value = ''
             if input_fld.has_attr('checked'):
                 if input_fld.has_attr('value'):
@@ -75,7 +93,7 @@ def extract_form_fields(soup):
 
             continue
 
-        assert False, 'input type %s not supported' % input_fld['type']
+        assert False, 'input type %s not supported' % input_type
 
     # textareas
     for textarea in soup.findAll('textarea'):
@@ -85,10 +103,10 @@ def extract_form_fields(soup):
     for select in soup.findAll('select'):
         value = ''
         options = select.findAll('option')
-        is_multiple = 'multiple' in select
+        is_multiple = select.has_attr('multiple')
         selected_options = [
             option for option in options
-            if 'selected' in option
+            if option.has_attr('selected')
         ]
 
         # If no select options, go with the first one
@@ -98,20 +116,56 @@ def extract_form_fields(soup):
         if not is_multiple:
             assert (len(selected_options) < 2)
             if len(selected_options) == 1:
-                value = selected_options[0]['value']
+                value = selected_options[0].get('value', selected_options[0].text)
         else:
-            value = [option['value'] for option in selected_options]
+            value = [option.get('value', option.text) for option in selected_options]
 
         fields[select['name']] = value
 
     return fields
 
 
-def parse_htmlform_files(baseurl, form, payload, suffix, verify=True):
-    """ post to an HTML form and parse the results for file links - returns a list of file names with links """
-    r = requests.post(urljoin(baseurl, form), data=payload, verify=verify)
+def post_form(url, payload, verify=True, cache=None, permanent=False):
+    """ post to an HTML form and return the text of the response
+    if a cache is given (see cache.MemoryResponseCache) the response is kept, and used again either forever, if
+    permanent is True, or until the cache ttl runs out - then it is revalidated with a conditional request """
+    if cache is None:
+        return requests.post(url, data=payload, verify=verify).text
+
+    key = response_key(url, payload)
+    entry = cache.get(key)
+    now = time.time()
+    if entry and (entry['permanent'] or now - entry['stored'] < cache.ttl):
+        return entry['text']
+
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        r = requests.post(url, data=payload, verify=verify, headers=headers)
+    except requests.RequestException:
+        if entry:
+            return entry['text']
+        raise
+    if entry and r.status_code == 304:
+        entry.update({'stored': now, 'permanent': permanent})
+        cache.put(key, entry)
+        return entry['text']
+    if r.status_code == 200:
+        cache.put(key, {'text': r.text, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+                        'stored': now, 'permanent': permanent})
+    return r.text
+
+
+def parse_htmlform_files(baseurl, form, payload, suffix, verify=True, cache=None, permanent=False):
+    """ post to an HTML form and parse the results for file links - returns a list of file names with links
+    see post_form for the use of cache and permanent """
+    text = post_form(urljoin(baseurl, form), payload, verify, cache, permanent)
     # parse the results and pull out all the links to requested files
-    soup = BeautifulSoup(r.text, 'html.parser')
+    soup = BeautifulSoup(text, 'html.parser')
     # loop through the available zip files and create a list for processing
     target_files = []
     for link in soup.find_all('a', text=re.compile(suffix)):
@@ -141,60 +195,40 @@ def extract_bbox_shape(shapefile: str, vfs: str = None):
     """ given a path to a shapefile, get the bounding box and outline geometry
     returns a dict containing the CRS of the original dataset, the bounding box and geometry as GeoJSON in both
     projected and latlong coordinates """
-    # define the lat/lon coordinate system and the poles
-    wgs84 = pyproj.CRS('EPSG:4326')
-    northpole = Point([0, 90])
-    southpole = Point([0, -90])
     # open the file, note the virtual file system options for fiona
     # https://fiona.readthedocs.io/en/latest/fiona.html?highlight=fiona.open#fiona.open
-    fin = fiona.open(shapefile, vfs=vfs)
-    orig_crs = fin.crs
-    crs_wk2 = fin.crs_wkt
-    # get a multipolygon feature from all the features in the shapefile
-    mpt = MultiPolygon([shape(poly['geometry']) for poly in fin])
-    fin.close()
-    # set up the coordinate tranformations and convert the poles
-    orig_proj = pyproj.CRS(orig_crs)
-    to_wgs84 = pyproj.Transformer.from_crs(orig_proj, wgs84, always_xy=True).transform
-    from_wgs84 = pyproj.Transformer.from_crs(wgs84, orig_proj, always_xy=True).transform
-    northpole_p = transform(from_wgs84, northpole)
-    southpole_p = transform(from_wgs84, southpole)
-    # compute the outline geometry of the multipolygon (this is all done in the projected coordinate system)
-    outline = mpt.convex_hull
-    # Now transform to WGS84, we will treat the data differently if it covers one of the poles
-    # first - convert the outline polygon to a multipoint object
-    outline_pts = MultiPoint(list(outline.exterior.coords))
-    # next transform to WGS84, this time using pyproj directly
-    outlinepts_wgs84 = transform(to_wgs84, outline_pts)
-    if outline.contains(northpole_p):
-        # a North polar outline
-        # add a few points at the pole
-        tpts = list(outlinepts_wgs84.geoms)
-        tpts.append(Point(-179.9999, 90))
-        tpts.append(Point(0, 90))
-        tpts.append(Point(179.9999, 90))
-        otlp_wgs84 = MultiPoint(tpts)
-        # now get the convex hull of the new collection of points
-        outline_wgs84 = otlp_wgs84.convex_hull
-    elif outline.contains(southpole_p):
-        # a South polar outline
-        # add a few points at the pole
-        tpts = list(outlinepts_wgs84.geoms)
-        tpts.append(Point(-179.9999, -90))
-        tpts.append(Point(0, -90))
-        tpts.append(Point(179.9999, -90))
-        otlp_wgs84 = MultiPoint(tpts)
-        # now get the convex hull of the new collection of points
-        outline_wgs84 = otlp_wgs84.convex_hull
-    else:
-        # if the pole isn't enclosed, we should be able to just transform the outline to lat/long
-        outline_wgs84 = transform(to_wgs84, outline)
+    with fiona.open(shapefile, vfs=vfs) as fin:
+        return extract_bbox_collection(fin, _read_prj(shapefile, vfs))
+
 
-    return {'crs': crs_wk2,
-            'pbbox': list(outline.bounds),
-            'bbox': list(outline_wgs84.bounds),
-            'pgeometry': mapping(outline),
-            'geometry': mapping(outline_wgs84)}
+def _read_prj(shapefile: str, vfs: str = None):
+    """ the text of the .prj file of a shapefile on disk, or in a zip file if vfs is 'zip:' and its path,
+    None if there isn't one """
+    if vfs is None:
+        prjname = shapefile[:-4] + '.prj'
+        if not os.path.exists(prjname):
+            return None
+        with open(prjname, encoding='latin-1') as f:
+            return f.read()
+    if vfs.startswith('zip:'):
+        # fiona takes zip:path or zip://path
+        zipname = vfs[6:] if vfs.startswith('zip://') else vfs[4:]
+        with zipfile.ZipFile(zipname) as zipfl:
+            return shapefile_prj(zipfl, shapefile)
+
+
+def extract_bbox_collection(fin, prj: str = None):
+    """ get the bounding box and outline geometry from an open fiona collection, see extract_bbox_shape
+    prj is the text of the shapefile's .prj file, the CRS is read from it rather than from fiona when it is given,
+    the same way get_zipshape_extent does, so both give the chart the same proj:wkt2 """
+    # the transformations and the poles in chart coordinates, most charts share a few coordinate systems
+    projection = projections.get(prj) if prj else projections.get(fin.crs_wkt, fin.crs)
+    # feed the features through a hull one at a time, rather than making one big multipolygon
+    hull = StreamingHull()
+    for feature in fin:
+        hull.add_geometry(feature['geometry'])
+    # the outline geometry of all the features (this is all done in the projected coordinate system)
+    return outline_geometry(hull.outline(), projection, projection.wkt)
 
 
 def test_url(href):
@@ -205,41 +239,295 @@ def test_url(href):
     return False
 
 
+def content_validator(href, session=requests):
+    """ return a string that changes when the file at href changes, or None if the server can't tell us
+    this is the ETag if there is one, otherwise the size (and modification time if given) of the file. only the
+    headers are read - servers that refuse HEAD requests get a GET that is closed before the body is downloaded """
+    try:
+        r = session.head(href, allow_redirects=True, timeout=TIMEOUT)
+        if r.status_code != 200:
+            with closing(session.get(href, stream=True, timeout=TIMEOUT)) as r:
+                pass
+    except requests.RequestException:
+        return None
+    if r.status_code != 200:
+        return None
+    return response_validator(r.headers)
+
+
+def response_validator(headers, size=None):
+    """ the validator content_validator gives for a file, from the headers of a response with the whole file,
+    or with part of it if the size of the whole file is given """
+    if headers.get('ETag'):
+        return 'etag:' + headers['ETag']
+    size = size if size is not None else headers.get('Content-Length')
+    if size:
+        return 'size:{0};modified:{1}'.format(size, headers.get('Last-Modified') or '')
+    return None
+
+
+def _cache_fetch(cache, href):
+    """ get a file from the download cache, see DownloadCache.fetch, keeping its validator """
+    path = cache.fetch(href)
+    entry = cache.lookup(href) if path else None
+    if entry:
+        download_validators[href] = response_validator({'ETag': entry.get('etag'),
+                                                        'Last-Modified': entry.get('last_modified')}, entry['size'])
+    return path
+
+
 def download_file(href, target):
-    """ download a file from href to target """
-    r = requests.get(href, stream=True)
+    """ download a file from href to target, using the download cache if one is configured """
+    cache = get_download_cache()
+    if cache:
+        cached = cache.fetch(href)
+        if cached:
+            shutil.copyfile(cached, target)
+            return target
+        return None
+    r = requests.get(href, stream=True, timeout=TIMEOUT)
     if r.status_code == 200:
         with open(target, 'wb') as f:
-            for chunk in r.iter_content(1024):
+            for chunk in r.iter_content(DOWNLOAD_CHUNK):
                 f.write(chunk)
         return target
     else:
         return None
 
 
-def get_zipshape_bbox(href):
-    """ download a zipped shapefile to a temporary folder and get its bounding box and shape """
-    with tempfile.TemporaryDirectory() as tmpdir:
-        zipfilename = os.path.join(tmpdir, 'temp.zip')
-        if download_file(href, zipfilename):
-            zipfl = zipfile.ZipFile(zipfilename)
-            try:
-                if zipfl.testzip():
-                    print(f"Corrupt zip file {href}")
-                    zipfl.close()
-                    return
-            except BadZipFile:
-                print(f"Corrupt zip file {href}")
-                return
-            filelist = zipfl.namelist()
-            zipfl.close()
-            shpfiles = [s for s in filelist if s.endswith('.shp')]
-            if len(shpfiles) > 0:
-                # only read the first shapefile if there are more than one??
-                return extract_bbox_shape(shpfiles[0], vfs='zip:' + zipfilename)
-            else:
+def download_bytes(href, limit=ZIP_MEMORY_LIMIT, spillfile=None):
+    """ download a file into memory and return its content
+    if it is bigger than limit bytes the download goes to spillfile instead and the path is returned, or if there is
+    no spillfile to a temporary file, which is returned open at the start and is deleted when it is closed
+    returns None if the download fails """
+    r = requests.get(href, stream=True, timeout=TIMEOUT)
+    if r.status_code != 200:
+        return None
+    download_validators[href] = response_validator(r.headers)
+    chunks = r.iter_content(DOWNLOAD_CHUNK)
+    buf = bytearray()
+    # don't bother buffering if the server tells us the file is too big
+    if int(r.headers.get('Content-Length', 0)) <= limit:
+        for chunk in chunks:
+            buf += chunk
+            if len(buf) > limit:
+                break
+        else:
+            transfer['Bytes Read'] += len(buf)
+            return bytes(buf)
+    if spillfile is None:
+        f = tempfile.TemporaryFile()
+        try:
+            _spill(f, buf, chunks)
+        except BaseException:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+    with open(spillfile, 'wb') as f:
+        _spill(f, buf, chunks)
+    return spillfile
+
+
+def _spill(f, buf, chunks):
+    """ write what download_bytes has read so far and the rest of the download to a file """
+    f.write(buf)
+    for chunk in chunks:
+        f.write(chunk)
+    transfer['Bytes Read'] += f.tell()
+
+
+def open_zip(source, href=''):
+    """ open a zip file given either its path or its content as bytes, and check the CRC of every member
+    returns a ZipFile, or None if the archive is corrupt """
+    try:
+        zipfl = zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source)
+        if zipfl.testzip() is None:
+            return zipfl
+        zipfl.close()
+    except (BadZipFile, zlib.error):
+        pass
+    print(f"Corrupt zip file {href}")
+    return None
+
+
+def get_zipshape_bbox(href, memory_limit=ZIP_MEMORY_LIMIT, ranged=True):
+    """ download a zipped shapefile and get its bounding box and shape
+    if ranged is True and the server supports range requests, only the parts of the shapefile needed for the geometry
+    are downloaded. otherwise files up to memory_limit bytes are read into memory, bigger ones go to a temporary folder.
+    if there is a download cache the file is read from there instead """
+    cache = get_download_cache()
+    if ranged and not cache:
+        try:
+            shpfile, source, remote = read_shapefile(href)
+        except RangeNotSupported:
+            pass
+        except (BadZipFile, zlib.error):
+            print(f"Corrupt zip file {href}")
+            return
+        except requests.RequestException:
+            print('Failed to download file {0}'.format(href))
+            return
+        else:
+            transfer['Bytes Read'] += remote.bytes_read
+            transfer['Bytes Saved'] += remote.bytes_saved
+            download_validators[href] = response_validator(remote.headers, remote.size)
+            if shpfile is None:
                 print('No shapefiles found in archive {0}'.format(href))
                 return
+            return _zipbytes_bbox(source, shpfile)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if cache:
+            source = _cache_fetch(cache, href)
         else:
+            source = download_bytes(href, memory_limit, os.path.join(tmpdir, 'temp.zip'))
+        if not source:
             print('Failed to download file {0}'.format(href))
             return
+        zipfl = open_zip(source, href)
+        if zipfl is None:
+            return
+        shpfiles = [s for s in zipfl.namelist() if s.endswith('.shp')]
+        zipfl.close()
+        if len(shpfiles) < 1:
+            print('No shapefiles found in archive {0}'.format(href))
+            return
+        # only read the first shapefile if there are more than one??
+        if isinstance(source, bytes):
+            return _zipbytes_bbox(source, shpfiles[0])
+        return extract_bbox_shape(shpfiles[0], vfs='zip:' + source)
+
+
+def _zipbytes_bbox(source, shpfile):
+    """ get the bounding box and shape of a shapefile in a zip file held in memory """
+    with zipfile.ZipFile(io.BytesIO(source)) as zipfl:
+        prj = shapefile_prj(zipfl, shpfile)
+    with ZipMemoryFile(source) as zmem:
+        with zmem.open(shpfile) as fin:
+            return extract_bbox_collection(fin, prj)
+
+
+def shapefile_header(zipfl):
+    """ the header of the first .shp file in an open ZipFile and the text of its .prj file
+    only the start of the .shp file is decompressed. returns None if there is no shapefile or projection file """
+    names = zipfl.namelist()
+    shpfiles = [s for s in names if s.endswith('.shp')]
+    if len(shpfiles) < 1:
+        return None
+    prj = shapefile_prj(zipfl, shpfiles[0])
+    if prj is None:
+        return None
+    with zipfl.open(shpfiles[0]) as shp:
+        header = shp.read(SHP_HEADER_SIZE)
+    return header, prj
+
+
+def shapefile_prj(zipfl, shpfile: str):
+    """ the text of the .prj file that goes with a .shp file in an open ZipFile, or None if there isn't one """
+    prjfiles = [s for s in zipfl.namelist() if s.lower() == shpfile[:-4].lower() + '.prj']
+    return zipfl.read(prjfiles[0]).decode('latin-1') if prjfiles else None
+
+
+@contextmanager
+def remote_zip(href, ranged=True, readahead=READAHEAD):
+    """ open a zip file on a web server as a ZipFile - from the download cache if there is one, otherwise with range
+    requests if ranged is True and the server supports them, otherwise it is downloaded (see download_bytes)
+    yields None if the file can't be downloaded """
+    cache = get_download_cache()
+    remote = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            source = None
+            if cache:
+                source = _cache_fetch(cache, href)
+            elif ranged:
+                try:
+                    source = remote = RemoteFile(href, readahead=readahead)
+                    download_validators[href] = response_validator(remote.headers, remote.size)
+                except RangeNotSupported:
+                    pass
+            if source is None and not cache:
+                source = download_bytes(href, ZIP_MEMORY_LIMIT, os.path.join(tmpdir, 'temp.zip'))
+            if not source:
+                yield None
+            else:
+                with zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source) as zipfl:
+                    yield zipfl
+        finally:
+            if remote:
+                transfer['Bytes Read'] += remote.bytes_read
+                transfer['Bytes Saved'] += remote.bytes_saved
+
+
+def get_zipshape_extent(href, ranged=True):
+    """ get the bounding box of a zipped shapefile from the header of the .shp file, without reading any shapes
+    returns the same dict as get_zipshape_bbox, with the box as the geometry.
+    if the file is in the download cache or the server supports range requests, only a few kB are read """
+    try:
+        # zipfile reads compressed data 4 kB at a time, there is no point fetching more for a header
+        with remote_zip(href, ranged, readahead=4096) as zipfl:
+            if zipfl is None:
+                print('Failed to download file {0}'.format(href))
+                return
+            header = shapefile_header(zipfl)
+    except RangeNotSupported:
+        # the file changed while it was being read, or the server sent less than was asked for, so download it
+        return get_zipshape_extent(href, ranged=False)
+    except (BadZipFile, zlib.error):
+        print(f"Corrupt zip file {href}")
+        return
+    except requests.RequestException:
+        print('Failed to download file {0}'.format(href))
+        return
+    if header is None:
+        print('No shapefile with a projection found in archive {0}'.format(href))
+        return
+    projection = projections.get(header[1])
+    return extent_geometry(shp_header_bbox(header[0]), projection, projection.wkt)
+
+
+def get_e00_bbox(href, ranged=True):
+    """ get the bounding box and shape of an E00 file, or the first E00 file in a zip file
+    the file is parsed as it downloads so it is never held in memory or written to disk - except for zip files on
+    servers that don't support range requests. compressed E00 files are not supported """
+    try:
+        if '.zip' in href.lower():
+            with remote_zip(href, ranged) as zipfl:
+                if zipfl is None:
+                    print('Failed to download file {0}'.format(href))
+                    return
+                e00files = [s for s in zipfl.namelist() if s.lower().endswith('.e00')]
+                if len(e00files) < 1:
+                    print('No E00 files found in archive {0}'.format(href))
+                    return
+                with zipfl.open(e00files[0]) as member:
+                    return e00_geometry(io.TextIOWrapper(member, encoding='latin-1'))
+        cache = get_download_cache()
+        if cache:
+            cached = _cache_fetch(cache, href)
+            if not cached:
+                print('Failed to download file {0}'.format(href))
+                return
+            with open(cached, encoding='latin-1') as f:
+                return e00_geometry(f)
+        with closing(requests.get(href, stream=True, timeout=TIMEOUT)) as r:
+            if r.status_code != 200:
+                print('Failed to download file {0}'.format(href))
+                return
+            download_validators[href] = response_validator(r.headers)
+            r.raw.decode_content = True
+            # keep the response open until we're done with it, so the line reader doesn't trip over it
+            r.raw.auto_close = False
+            result = e00_geometry(io.TextIOWrapper(r.raw, encoding='latin-1'))
+            transfer['Bytes Read'] += r.raw.tell()
+            return result
+    except E00Error as e:
+        print('Can not read E00 file {0} - {1}'.format(href, e))
+    except RangeNotSupported:
+        # the file changed while it was being read, or the server sent less than was asked for, so download it
+        return get_e00_bbox(href, ranged=False)
+    except (BadZipFile, zlib.error):
+        print(f"Corrupt zip file {href}")
+    except requests.RequestException:
+        print('Failed to download file {0}'.format(href))
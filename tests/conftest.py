@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Shared test fixtures
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import re
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ pass each request to the route registered for its path
+    a route is called with the handler and returns a tuple of (status, headers, body)
+    if the headers include Accept-Ranges: bytes, Range requests get the partial content """
+
+    def respond(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get('Content-Length', 0))
+        self.body = self.rfile.read(length) if length else b''
+        self.form = {k: v[0] for k, v in parse_qs(self.body.decode()).items()}
+        self.server.requests.append((self.command, self.path, dict(self.headers), self.form))
+        route = self.server.routes.get(path)
+        if route is None:
+            status, headers, body = 404, {}, b'not found'
+        else:
+            status, headers, body = route(self)
+        if isinstance(body, str):
+            body = body.encode()
+        if status == 200 and headers.get('Accept-Ranges') == 'bytes':
+            status, body = self.byterange(headers, body)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def byterange(self, headers, body):
+        """ answer a single Range request, for routes that say they accept them """
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if not match:
+            return 200, body
+        first, last = match.groups()
+        if first == '':
+            start, end = max(len(body) - int(last), 0), len(body)
+        else:
+            start, end = int(first), min(int(last) + 1 if last else len(body), len(body))
+        headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end - 1, len(body))
+        return 206, body[start:end]
+
+    do_GET = respond
+    do_POST = respond
+    do_HEAD = respond
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stubserver():
+    """ a local web server, add routes with server.routes[path] = func(request) -> (status, headers, body) """
+    server = HTTPServer(('127.0.0.1', 0), StubHandler)
+    server.routes = {}
+    server.requests = []
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def shapezip(tmp_path):
+    """ make zipped shapefiles, call it with a list of polygon rings and an EPSG code to get the zip file as bytes
+    each polygon can be given one of notes, which pad out the attributes like the egg codes of a real chart """
+    import io
+    import os
+    import zipfile
+    import fiona
+    from fiona.crs import from_epsg
+
+    def make(rings, epsg=3413, name='chart', notes=None):
+        folder = tmp_path / 'shp_{0}'.format(name)
+        folder.mkdir(exist_ok=True)
+        schema = {'geometry': 'Polygon', 'properties': {'id': 'int', 'note': 'str:254'}}
+        with fiona.open(str(folder / (name + '.shp')), 'w', driver='ESRI Shapefile', schema=schema,
+                        crs=from_epsg(epsg)) as out:
+            for i, ring in enumerate(rings):
+                out.write({'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+                           'properties': {'id': i, 'note': notes[i] if notes else ''}})
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for fname in sorted(os.listdir(str(folder))):
+                zout.write(str(folder / fname), fname)
+        return buf.getvalue()
+
+    return make
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Test download cache
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import os
+from src.cache import DownloadCache, CACHE_DIR_ENV
+# the cache used by utility
+from src.utility import download_file, get_download_cache
+
+
+def static_file(body, etag=None, last_modified=None):
+    """ a route serving body that answers conditional requests """
+    def route(request):
+        headers = {'Content-Type': 'application/zip'}
+        if etag:
+            headers['ETag'] = etag
+            if request.headers.get('If-None-Match') == etag:
+                return 304, headers, b''
+        if last_modified:
+            headers['Last-Modified'] = last_modified
+            if request.headers.get('If-Modified-Since') == last_modified:
+                return 304, headers, b''
+        return 200, headers, body
+    return route
+
+
+def test_fetch(stubserver, tmp_path):
+    stubserver.routes['/a.zip'] = static_file(b'a' * 100, etag='"v1"')
+    cache = DownloadCache(str(tmp_path))
+    path = cache.fetch(stubserver.url + '/a.zip')
+    with open(path, 'rb') as f:
+        assert f.read() == b'a' * 100
+    assert cache.fetch(stubserver.url + '/a.zip') == path
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert stubserver.requests[-1][2]['If-None-Match'] == '"v1"'
+
+    # a changed file is downloaded again
+    stubserver.routes['/a.zip'] = static_file(b'b' * 100, etag='"v2"')
+    newpath = cache.fetch(stubserver.url + '/a.zip')
+    assert newpath != path
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # identical content from another link shares the same file
+    stubserver.routes['/copy.zip'] = static_file(b'b' * 100, last_modified='Mon, 14 Dec 2020 00:00:00 GMT')
+    assert cache.fetch(stubserver.url + '/copy.zip') == newpath
+    assert cache.fetch(stubserver.url + '/copy.zip') == newpath
+    assert stubserver.requests[-1][2]['If-Modified-Since'] == 'Mon, 14 Dec 2020 00:00:00 GMT'
+    assert cache.stats()['Hits'] == 2
+
+    assert cache.fetch(stubserver.url + '/missing.zip') is None
+
+
+def test_no_validators(stubserver, tmp_path):
+    stubserver.routes['/a.zip'] = static_file(b'a' * 100)
+    cache = DownloadCache(str(tmp_path))
+    path = cache.fetch(stubserver.url + '/a.zip')
+    nrequests = len(stubserver.requests)
+    assert cache.fetch(stubserver.url + '/a.zip') == path
+    assert len(stubserver.requests) == nrequests
+
+
+def test_stale(stubserver, tmp_path):
+    stubserver.routes['/a.zip'] = static_file(b'a' * 100, etag='"v1"')
+    cache = DownloadCache(str(tmp_path))
+    href = stubserver.url + '/a.zip'
+    path = cache.fetch(href)
+    stubserver.shutdown()
+    stubserver.server_close()
+    assert cache.fetch(href) == path
+
+
+def test_evict(stubserver, tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=250)
+    paths = []
+    for i, name in enumerate(('a', 'b', 'c')):
+        stubserver.routes['/' + name] = static_file(name.encode() * 100, etag=name)
+        paths.append(cache.fetch(stubserver.url + '/' + name))
+        # make sure the access times are distinct
+        os.utime(paths[-1], (i, i))
+    # the least recently used file is gone
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(paths[1]) and os.path.exists(paths[2])
+    assert cache.stats()['Bytes'] == 200
+    # using a file keeps it in the cache
+    cache.fetch(stubserver.url + '/b')
+    stubserver.routes['/d'] = static_file(b'd' * 100, etag='d')
+    cache.fetch(stubserver.url + '/d')
+    assert os.path.exists(paths[1])
+    assert not os.path.exists(paths[2])
+
+
+def test_evict_new(stubserver, tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=250)
+    evicted = []
+    evict = cache.evict
+    cache.evict = lambda keep: evicted.append(keep) or evict(keep)
+    stubserver.routes['/a'] = static_file(b'a' * 100, etag='a')
+    path = cache.fetch(stubserver.url + '/a')
+    # the cache is only looked through once, to get its size, until it is full
+    stubserver.routes['/b'] = static_file(b'b' * 100, etag='b')
+    cache.fetch(stubserver.url + '/b')
+    assert evicted == [path]
+    # a file bigger than the whole cache is still kept until it has been used
+    stubserver.routes['/big'] = static_file(b'x' * 1000, etag='big')
+    big = cache.fetch(stubserver.url + '/big')
+    assert os.path.exists(big)
+    assert len(evicted) == 2
+    assert cache.stats()['Bytes'] == 1000
+
+
+def test_removed(stubserver, tmp_path):
+    href = stubserver.url + '/a.zip'
+    for etag in ('"v1"', None):
+        stubserver.routes['/a.zip'] = static_file(b'a' * 100, etag=etag)
+        cache = DownloadCache(str(tmp_path / str(etag)))
+        path = cache.fetch(href)
+        # removed by another process sharing the cache, the file is downloaded again
+        os.unlink(path)
+        assert cache.fetch(href) == path
+        assert os.path.exists(path)
+        assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_download_file(stubserver, tmp_path, monkeypatch):
+    stubserver.routes['/a.zip'] = static_file(b'a' * 100, etag='"v1"')
+    monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path / 'cache'))
+    for i in range(2):
+        target = str(tmp_path / 'a{0}.zip'.format(i))
+        assert download_file(stubserver.url + '/a.zip', target) == target
+        with open(target, 'rb') as f:
+            assert f.read() == b'a' * 100
+    assert (get_download_cache().hits, get_download_cache().misses) == (1, 1)
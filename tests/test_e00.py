@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Test reading E00 files
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import io
+import os
+import zipfile
+import pyproj
+import pytest
+from shapely.geometry import MultiPoint
+from src.cache import CACHE_DIR_ENV
+from src.e00 import E00Reader, E00Error, e00_geometry, prj_to_proj
+from src.utility import get_e00_bbox
+
+DATA = os.path.join(os.path.dirname(__file__), 'data', 'e00')
+GREATLAKES = os.path.join(DATA, 'rgc_a13_20001204_CEXPRGL.e00')
+
+POLAR_PRJ = ['Projection    POLAR', 'Units         METERS', 'Spheroid      WGS84', 'Parameters',
+             '-45  0  0.000 /* longitude of central meridian', ' 70  0  0.000 /* latitude of true scale',
+             '0.00000 /* false easting (meters)', '0.00000 /* false northing (meters)']
+POLAR_ARCS = [[(-1e6, -1e6), (1e6, -1e6), (1e6, 1e6)], [(1e6, 1e6), (-1e6, 1e6), (-1e6, -1e6)],
+              [(2e5, 3e5), (2.5e5, 3.5e5), (-1.5e6, 2e5)]]
+
+
+def e00_text(arcs, prj, precision=2, labels=()):
+    """ write an uncompressed E00 file with the ARC, LAB and PRJ sections, and a few we don't read """
+    fmt = '%14.7E' if precision == 2 else '%21.14E'
+    out = ['EXP  0 /DATA/CHART.E00', 'ARC  {0}'.format(precision)]
+    for i, arc in enumerate(arcs):
+        out.append('%10d%10d%10d%10d%10d%10d%10d' % (i + 1, i + 1, 1, 1, 0, 0, len(arc)))
+        flat = [c for p in arc for c in p]
+        step = 4 if precision == 2 else 2
+        for j in range(0, len(flat), step):
+            out.append(''.join(fmt % v for v in flat[j:j + step]))
+    out.append('%10d%10d%10d%10d%10d%10d%10d' % (-1, 0, 0, 0, 0, 0, 0))
+    out += ['CNT  {0}'.format(precision), '%10d' % -1 + fmt % 0 + fmt % 0, 'LAB  {0}'.format(precision)]
+    for i, (x, y) in enumerate(labels):
+        out.append('%10d%10d' % (i + 1, i + 2) + fmt % x + fmt % y)
+        out += [fmt * 4 % (x, y, x, y)] if precision == 2 else [fmt * 2 % (x, y)] * 2
+    out += ['%10d%10d' % (-1, 0) + fmt % 0 + fmt % 0, 'PRJ  2']
+    for line in prj:
+        out += [line, '~']
+    out += ['EOP', 'SIN  2', 'EOX', 'LOG  2', 'EOL', 'IFO  2', 'EOI', 'EOS']
+    return '\n'.join(out) + '\n'
+
+
+@pytest.mark.parametrize('precision', [2, 3])
+def test_reader(precision):
+    reader = E00Reader().read(e00_text(POLAR_ARCS, POLAR_PRJ, precision, labels=[(0, 3e6)]).splitlines())
+    assert (reader.arcs, reader.labels) == (3, 1)
+    assert reader.hull.points == 10
+    points = [p for arc in POLAR_ARCS for p in arc] + [(0, 3e6)]
+    assert reader.hull.outline().equals(MultiPoint(points).convex_hull)
+    assert reader.proj_string() == ('+proj=stere +lon_0=-45.0 +lat_ts=70.0 +x_0=0.0 +y_0=0.0 +lat_0=90 '
+                                    '+ellps=WGS84 +units=m +no_defs')
+
+
+def test_reader_errors():
+    with pytest.raises(E00Error):
+        E00Reader().read(['not an e00 file'])
+    with pytest.raises(E00Error, match='Compressed'):
+        E00Reader().read(['EXP  1 /DATA/CHART.E00', 'ARC  2'])
+    truncated = e00_text(POLAR_ARCS, POLAR_PRJ).splitlines()[:5]
+    with pytest.raises(E00Error):
+        E00Reader().read(truncated)
+    with pytest.raises(E00Error):
+        e00_geometry(e00_text([], POLAR_PRJ).splitlines())
+    with pytest.raises(E00Error):
+        e00_geometry(e00_text(POLAR_ARCS, []).splitlines())
+
+
+def test_prj_to_proj():
+    assert prj_to_proj(['Projection UTM', '~', 'Zone -21', '~', 'Datum NAD27', '~', 'Units METERS']) == \
+        '+proj=utm +zone=21 +south +datum=NAD27 +units=m +no_defs'
+    assert prj_to_proj(['Projection GEOGRAPHIC', 'Units DD', 'Spheroid CLARKE1866']) == \
+        '+proj=longlat +ellps=clrk66 +no_defs'
+    # degrees, minutes and seconds
+    lcc = prj_to_proj(['Projection LAMBERT', 'Spheroid GRS1980', 'Parameters', '49 30 0.000', '77 0 36.0',
+                       '-0 30 0.000', '40 0 0.000', '100.0', '-200.0'])
+    assert '+lat_1=49.5 +lat_2=77.01 +lon_0=-0.5 +lat_0=40.0 +x_0=100.0 +y_0=-200.0' in lcc
+    with pytest.raises(E00Error):
+        prj_to_proj(['Projection MERCATOR'])
+    with pytest.raises(E00Error):
+        prj_to_proj(['Projection LAMBERT', 'Parameters', '49 0 0'])
+
+
+def test_e00_geometry():
+    result = e00_geometry(e00_text(POLAR_ARCS, POLAR_PRJ).splitlines())
+    assert result['bbox'][3] == 90.0
+    assert result['pbbox'] == [-1.5e6, -1e6, 1e6, 1e6]
+    assert result['crs'].startswith('PROJCRS')
+
+
+def test_greatlakes():
+    """ a Lambert conformal chart with windows line endings and sections we skip """
+    with open(GREATLAKES, encoding='latin-1') as f:
+        result = e00_geometry(f)
+    lon0, lat0, lon1, lat1 = result['bbox']
+    assert -92.2 < lon0 < -92.0 and 41.3 < lat0 < 41.5 and -76.2 < lon1 < -76.0 and 48.9 < lat1 < 49.6
+    assert pyproj.CRS(result['crs']).datum.name == 'North American Datum 1983'
+
+
+def test_get_e00_bbox(stubserver, monkeypatch):
+    monkeypatch.delenv(CACHE_DIR_ENV, raising=False)
+    with open(GREATLAKES, 'rb') as f:
+        body = f.read()
+    expected = e00_geometry(io.TextIOWrapper(io.BytesIO(body), encoding='latin-1'))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zout:
+        zout.writestr('readme.txt', 'not this one')
+        zout.writestr('rgc_a13_20001204_CEXPRGL.e00', body)
+    stubserver.routes['/chart.e00'] = lambda request: (200, {}, body)
+    stubserver.routes['/chart.zip'] = lambda request: (200, {'Accept-Ranges': 'bytes'}, buf.getvalue())
+    stubserver.routes['/compressed.e00'] = lambda request: (200, {}, 'EXP  1 /DATA/CHART.E00\n')
+    assert get_e00_bbox(stubserver.url + '/chart.e00') == expected
+    assert get_e00_bbox(stubserver.url + '/chart.zip') == expected
+    assert get_e00_bbox(stubserver.url + '/chart.zip', ranged=False) == expected
+    assert get_e00_bbox(stubserver.url + '/compressed.e00') is None
+    assert get_e00_bbox(stubserver.url + '/missing.e00') is None
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Test parallel exact geometry engine
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from src.geoengine import process_geometry
+from src.icechart import IceChart, GEO_BBOX
+from src.stackdb import StackDB
+from src.cache import CACHE_DIR_ENV
+
+NIC_BASE = 'https://usicecenter.gov/File/DownloadProduct?products=%2Fweekly%2Farctic%2F2006%2Fshapefiles%2Fhemispheric'
+HREFS = [NIC_BASE + '&fName=arctic0608{0:02d}.zip'.format(d) for d in range(1, 29)]
+
+
+def fake_geometry(name, href, fmt):
+    """ stands in for compute_geometry so the tests don't need the network """
+    if name.endswith('13'):
+        raise ValueError('unlucky chart')
+    if name.endswith('07'):
+        return None
+    return {'crs': 'WKT', 'bbox': [-1, -1, 1, 1], 'pbbox': [-10, -10, 10, 10],
+            'geometry': {'type': 'Polygon', 'coordinates': [[[-1, -1], [1, -1], [1, 1], [-1, -1]]]},
+            'pgeometry': {'type': 'Polygon', 'coordinates': [[[-10, -10], [10, -10], [10, 10], [-10, -10]]]}}
+
+
+def charts():
+    for href in HREFS:
+        yield IceChart.from_name(href[-16:-4], href)
+
+
+def test_inline():
+    stored = []
+    stats = process_geometry(charts(), stored.append, workers=0, geofunc=fake_geometry)
+    assert stats['Charts'] == 28
+    assert stats['Failed'] == 1
+    assert stats['Updated'] == 26
+    assert len(stored) == 26
+    assert all(c.exactgeo for c in stored)
+    assert stored[0].stac.properties['proj:wkt2'] == 'WKT'
+    assert stored[0].stac.bbox == [-1, -1, 1, 1]
+
+
+def test_pool():
+    stored = []
+    stats = process_geometry(charts(), stored.append, workers=2, max_inflight=3, geofunc=fake_geometry)
+    assert stats['Charts'] == 28
+    assert stats['Failed'] == 1
+    assert stats['Updated'] == 26
+    assert sorted(c.name for c in stored) == sorted(c.name for c in charts()
+                                                    if not c.name.endswith(('07', '13')))
+    assert stats['Charts/s'] > 0
+
+
+def test_not_exact():
+    def bbox_only(name, href, fmt):
+        return dict(fake_geometry('chart', href, fmt), exact=False)
+    stored = []
+    process_geometry(charts(), stored.append, workers=0, geofunc=bbox_only)
+    assert len(stored) == 28
+    assert all(c.exactgeo == GEO_BBOX for c in stored)
+    assert stored[0].stac.bbox == [-1, -1, 1, 1]
+
+
+def test_geometry_cache(stubserver):
+    etags = {}
+    stubserver.routes.update({'/' + href[-16:]: lambda request: (200, {'ETag': etags.get(request.path, '"1"')}, b'')
+                              for href in HREFS})
+    served = [IceChart.from_name(href[-16:-4], stubserver.url + '/' + href[-16:]) for href in HREFS]
+    computed = []
+
+    def counted(name, href, fmt):
+        computed.append(name)
+        return fake_geometry(name, href, fmt)
+
+    db = StackDB()
+    with db.batch() as batch:
+        stats = process_geometry(served, batch.add, workers=0, geofunc=counted, geocache=db.geometry_cache(batch=batch))
+    assert stats['Geometry Misses'] == 28 and stats['Geometry Hits'] == 0
+    assert len(computed) == 28
+
+    # nothing has changed, so only the unsupported and failed charts are computed again
+    computed.clear()
+    stored = []
+    stats = process_geometry(served, stored.append, workers=0, geofunc=counted, geocache=db.geometry_cache())
+    assert stats['Geometry Hits'] == 26
+    assert sorted(computed) == ['arctic060807', 'arctic060813']
+    assert len(stored) == 26 and stored[0].stac.bbox == [-1, -1, 1, 1]
+
+    # a chart with a new ETag is computed again
+    etags['/arctic060801.zip'] = '"2"'
+    stats = process_geometry(served, stored.append, workers=2, geofunc=fake_geometry, geocache=db.geometry_cache())
+    assert stats['Geometry Hits'] == 25 and stats['Geometry Misses'] == 3
+    assert db.geometry_cache().get(served[0].href)[0] == 'etag:"2"'
+
+    # without revalidating the server is not asked at all
+    computed.clear()
+    requests = len(stubserver.requests)
+    stats = process_geometry(served, stored.append, workers=0, geofunc=counted, geocache=db.geometry_cache(),
+                             revalidate=False)
+    assert stats['Geometry Hits'] == 26
+    # and the charts that aren't cached are computed without asking it first
+    assert len(stubserver.requests) - requests == 0
+    assert sorted(computed) == ['arctic060807', 'arctic060813']
+    db.close()
+
+
+def test_validator_from_download(stubserver, shapezip, monkeypatch):
+    monkeypatch.delenv(CACHE_DIR_ENV, raising=False)
+    body = shapezip([[(-1e6, -1e6), (1e6, -1e6), (1e6, 1e6), (-1e6, 1e6), (-1e6, -1e6)]])
+    stubserver.routes['/arctic060801.zip'] = lambda request: (
+        200, {'Content-Type': 'application/zip', 'Accept-Ranges': 'bytes', 'ETag': '"1"'}, body)
+    chart = IceChart.from_name('arctic060801', stubserver.url + '/arctic060801.zip')
+    db = StackDB()
+    stats = process_geometry([chart], lambda chart: None, workers=0, geocache=db.geometry_cache())
+    # with nothing cached there is nothing to check, the validator comes from the download
+    assert stats['Geometry Misses'] == 1
+    assert 'HEAD' not in [r[0] for r in stubserver.requests]
+    assert db.geometry_cache().get(chart.href)[0] == 'etag:"1"'
+    # and the next time it is checked before downloading
+    stubserver.requests.clear()
+    stats = process_geometry([chart], lambda chart: None, workers=0, geocache=db.geometry_cache())
+    assert stats['Geometry Hits'] == 1
+    assert [r[0] for r in stubserver.requests] == ['HEAD']
+    db.close()
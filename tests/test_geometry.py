@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Test the geometry helpers
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import numpy as np
+import pyproj
+import pytest
+from shapely.geometry import MultiPoint, MultiPolygon, Point, Polygon, mapping
+from shapely.ops import transform
+from src.geometry import hull_points, StreamingHull, ProjectionCache, outline_geometry, extent_geometry, shp_header_bbox
+
+
+def rings(count, seed=1):
+    """ random star shaped rings scattered across a polar stereographic chart """
+    rnd = np.random.default_rng(seed)
+    for _ in range(count):
+        centre = rnd.uniform(-3e6, 3e6, 2)
+        angles = np.sort(rnd.uniform(0, 2 * np.pi, 50))
+        radii = rnd.uniform(1e3, 5e4, 50)
+        ring = np.column_stack([centre[0] + radii * np.cos(angles), centre[1] + radii * np.sin(angles)])
+        yield np.vstack([ring, ring[:1]])
+
+
+def test_hull_points():
+    pts = np.random.default_rng(2).normal(size=(10000, 2))
+    hull = hull_points(pts)
+    assert MultiPoint(hull.tolist()).convex_hull.equals(MultiPoint(pts.tolist()).convex_hull)
+    # counter-clockwise
+    assert Polygon(hull).exterior.is_ccw
+    # collinear and repeated points
+    grid = np.array([[x, y] for x in range(5) for y in range(5)] * 2, dtype=float)
+    assert sorted(map(tuple, hull_points(grid))) == sorted([(0, 0), (4, 0), (4, 4), (0, 4), (1, 0), (2, 0), (3, 0),
+                                                            (4, 1), (4, 2), (4, 3), (3, 4), (2, 4), (1, 4),
+                                                            (0, 3), (0, 2), (0, 1)])
+    assert len(hull_points(np.array([[1.0, 1.0], [1.0, 1.0]]))) == 1
+
+
+@pytest.mark.parametrize('chunk', [10, 1000, 100000])
+def test_streaminghull(chunk):
+    polygons = [Polygon(r) for r in rings(200)]
+    hull = StreamingHull(chunk=chunk)
+    for polygon in polygons[:100]:
+        hull.add_geometry(mapping(polygon))
+    hull.add_geometry(mapping(MultiPolygon(polygons[100:])))
+    hull.add_geometry(None)
+    assert hull.points == 200 * 51
+    # never more than a chunk of pending points plus the hull candidates
+    assert len(hull.candidates) < 200 * 51
+    expected = MultiPolygon(polygons).convex_hull
+    assert mapping(hull.outline()) == mapping(expected)
+
+
+def test_streaminghull_z():
+    hull = StreamingHull()
+    hull.add([(0, 0, 5), (2, 0, 5), (2, 2, 5), (0, 2, 5), (1, 1, 5)])
+    assert hull.outline().bounds == (0, 0, 2, 2)
+    with pytest.raises(ValueError):
+        hull.add_geometry({'type': 'LineString', 'coordinates': [(0, 0), (1, 1)]})
+
+
+def test_projectioncache():
+    cache = ProjectionCache()
+    wkt = pyproj.CRS('EPSG:3413').to_wkt(pretty=True)
+    north = cache.get(wkt)
+    assert cache.get(' '.join(wkt.split())) is north
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert north.northpole.x == pytest.approx(0, abs=1e-6) and north.northpole.y == pytest.approx(0, abs=1e-6)
+    # the same answer as setting up the transformation every time
+    fresh = pyproj.Transformer.from_crs(pyproj.CRS('EPSG:3413'), pyproj.CRS('EPSG:4326'), always_xy=True)
+    assert north.to_wgs84.transform(1e6, -1e6) == fresh.transform(1e6, -1e6)
+    south = cache.get(pyproj.CRS('EPSG:3976').to_wkt(), crs='EPSG:3976')
+    assert south is not north
+    assert south.southpole.distance(north.northpole) < 1e-6
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def shapely_outline(outline, projection):
+    """ how outlines were transformed before outline_geometry, a point at a time """
+    to_wgs84 = projection.to_wgs84.transform
+    outlinepts_wgs84 = transform(to_wgs84, MultiPoint(list(outline.exterior.coords)))
+    for pole, pole_p in ((90, projection.northpole), (-90, projection.southpole)):
+        if outline.contains(pole_p):
+            tpts = list(outlinepts_wgs84.geoms) + [Point(-179.9999, pole), Point(0, pole), Point(179.9999, pole)]
+            return MultiPoint(tpts).convex_hull
+    return transform(to_wgs84, outline)
+
+
+@pytest.mark.parametrize('epsg', [3413, 3976, 3978])
+def test_outline_geometry(epsg):
+    cache = ProjectionCache()
+    projection = cache.get(pyproj.CRS(epsg).to_wkt())
+    # hulls around the pole, and away from it
+    for seed, centre in enumerate(([0, 0], [2e6, -1e6], [-5e5, 2.5e6])):
+        for ring in rings(5, seed=seed):
+            outline = MultiPoint(((ring - ring.mean(axis=0)) * 20 + centre).tolist()).convex_hull
+            result = outline_geometry(outline, projection, 'WKT')
+            expected = shapely_outline(outline, projection)
+            assert result['geometry'] == mapping(expected)
+            assert result['bbox'] == list(expected.bounds)
+            assert result['pbbox'] == list(outline.bounds)
+            assert result['pgeometry'] == mapping(outline)
+            assert result['crs'] == 'WKT'
+
+
+def test_shp_header_bbox():
+    header = bytearray(100)
+    header[:4] = (9994).to_bytes(4, 'big')
+    header[36:68] = np.array([-1.5, -2.5, 3.5, 4.5], dtype='<f8').tobytes()
+    assert shp_header_bbox(bytes(header)) == [-1.5, -2.5, 3.5, 4.5]
+    with pytest.raises(ValueError):
+        shp_header_bbox(bytes(100))
+
+
+def test_extent_geometry():
+    cache = ProjectionCache()
+    north = cache.get(pyproj.CRS(3413).to_wkt())
+    polar = extent_geometry([-1e6, -1e6, 1e6, 2e6], north, 'WKT')
+    assert polar['bbox'][3] == 90.0 and polar['bbox'][0] == -179.9999
+    assert polar['pgeometry'] == mapping(Polygon([(1e6, -1e6), (1e6, 2e6), (-1e6, 2e6), (-1e6, -1e6)]))
+    assert polar['exact'] is False
+    # the middle of the top edge is further north than the corners
+    edge = extent_geometry([1e6, -1e6, 2e6, 1e6], north, 'WKT')
+    corners = north.to_wgs84.transform([1e6, 2e6, 2e6, 1e6], [-1e6, -1e6, 1e6, 1e6])
+    assert edge['bbox'][3] > max(corners[1])
+    assert edge['bbox'][3] < 90
@@ -29,8 +29,13 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import os
+import copy
+import json
 import datetime
-from src.icechart import IceChart
+import pytest
+from src.icechart import IceChart, CIS_STAC, parse_name, parse_names
+from src.stackdb import StackDB
 
 
 def test_cistypes():
@@ -123,3 +128,92 @@ def test_exactgeo():
     # this should pass
     x.exact_geometry()
     assert x.exactgeo == 1
+
+
+def test_exactgeo_cached(stubserver, shapezip):
+    body = shapezip([[(-1e6, -1e6), (1e6, -1e6), (1e6, 1e6), (-1e6, 1e6), (-1e6, -1e6)]])
+    stubserver.routes['/arctic060803.zip'] = lambda request: (200, {'ETag': '"1"'}, body)
+    db = StackDB()
+    cache = db.geometry_cache()
+    x = IceChart.from_name('arctic060803', stubserver.url + '/arctic060803.zip')
+    x.exact_geometry(geocache=cache)
+    assert x.exactgeo
+    validator, geo = cache.get(x.href)
+    assert validator == 'etag:"1"'
+    assert x.stac.bbox == geo['bbox']
+    # the second time only the headers are requested
+    y = IceChart.from_name('arctic060803', x.href)
+    x.exact_geometry(geocache=cache)
+    y.exact_geometry(geocache=cache)
+    assert y.exactgeo and y.stac.bbox == x.stac.bbox
+    assert [r[0] for r in stubserver.requests[-2:]] == ['HEAD', 'HEAD']
+    db.close()
+
+
+def test_templates():
+    before = copy.deepcopy(CIS_STAC['Hudson Bay'])
+    x = IceChart.from_name('rgc_a09_20201214_CEXPRHB', 'https://example.com/rgc_a09_20201214_CEXPRHB.zip')
+    y = IceChart.from_name('rgc_a09_20201221_CEXPRHB', 'https://example.com/rgc_a09_20201221_CEXPRHB.zip')
+    # the charts share the template coordinates, but changing one chart leaves the other alone
+    assert x.stac.geometry['coordinates'] is y.stac.geometry['coordinates']
+    x.stac.properties['proj:geometry']['type'] = 'Point'
+    x.set_geometry({'crs': 'WKT', 'bbox': [0, 0, 1, 1], 'pbbox': [0, 0, 1, 1], 'geometry': None, 'pgeometry': None})
+    assert y.stac.properties['proj:wkt2'] == before['properties']['proj:wkt2']
+    assert y.stac.properties['proj:geometry']['type'] == 'Polygon'
+    assert y.stac.bbox == before['bbox']
+    # and the template the charts were made from is not changed by making them
+    assert CIS_STAC['Hudson Bay'] == before
+    d = json.loads(json.dumps(y.stac.to_dict()))
+    assert d['geometry'] == before['geometry']
+    assert d['properties']['proj:geometry'] == before['properties']['proj:geometry']
+    assert d['properties']['region'] == 'Hudson Bay'
+
+    z = IceChart.from_name('cisarctic20180712', 'https://example.com/cisarctic20180712.zip')
+    assert z.source == 'CIS' and z.stac.properties['collection'] == 'CIS_Ice_Charts'
+
+
+def test_parse_names():
+    corpus = os.path.join(os.path.dirname(__file__), 'data', 'names', 'archive_names.tsv')
+    with open(corpus) as f:
+        rows = [line.rstrip('\n').split('\t') for line in f if not line.startswith('#')]
+    parsed = parse_names([row[0] for row in rows])
+    assert len(parsed) == len(rows) > 30
+    for row, chart in zip(rows, parsed):
+        assert [chart['source'], chart['region'], chart['epoch'].strftime('%Y-%m-%d'), chart['format']] == row[1:]
+    # each date is only made once
+    assert len({id(chart['epoch']) for row, chart in zip(rows, parsed) if '_20201221_' in row[0]}) == 1
+
+    # the NIC links have the file name in the query
+    chart = parse_name('DownloadProduct?products=%2Fweekly%2Fantarctic%2F2017&fName=ANTARC170413.ZIP')
+    assert chart == {'source': 'NIC', 'region': 'antarctic', 'epoch': datetime.datetime(2017, 4, 13),
+                     'format': 'ESRI SHAPEFILE'}
+    assert parse_name('arctic991231.zip')['epoch'] == datetime.datetime(1999, 12, 31)
+    # names that don't match any pattern fall back to finding the date anywhere
+    assert parse_name('nic_arctic_week_20060803.zip')['epoch'] == datetime.datetime(2006, 8, 3)
+    with pytest.raises(ValueError):
+        parse_name('rgc_a09_cexprhb.e00')
+    with pytest.raises(ValueError):
+        parse_name('arctic061332.zip')
+
+
+def test_lazy():
+    href = 'https://usicecenter.gov/File/DownloadProduct?products=%2Fweekly%2Farctic%2F2006&fName=arctic060803.zip'
+    x = IceChart.from_name('arctic060803', href)
+    with pytest.raises(AttributeError):
+        x.notes = 'charts only have the fields in __slots__'
+    # the JSON made from the template is the same as pystac writes
+    text = x.to_json()
+    assert x._stac is None
+    assert text == json.dumps(IceChart(x.__dict__).stac.to_dict())
+
+    # a chart read from the database keeps its JSON text until the item is used
+    db = StackDB()
+    db.add_item(x)
+    row = db.get_items()[0]
+    y = IceChart.from_row(row)
+    assert y.to_json() is row['stac']
+    assert y.stac.id == 'arctic060803' and y.stac.assets['data'].href == href
+    y.set_geometry({'crs': 'WKT', 'bbox': [0, 0, 1, 1], 'pbbox': [0, 0, 1, 1], 'geometry': None, 'pgeometry': None})
+    assert json.loads(y.to_json())['properties']['proj:wkt2'] == 'WKT'
+    assert IceChart(y.__dict__).stac is y.stac
+    db.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Test the fill pipeline
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import threading
+import pytest
+from src.pipeline import run_pipeline
+
+CIS_BASE = 'https://ice-glaces.ec.gc.ca/www_archive/AOI_13/Coverages/'
+NIC_BASE = 'https://usicecenter.gov/File/DownloadProduct?products=%2Fweekly%2Farctic%2F2006%2Fshapefiles%2Fhemispheric'
+
+
+def source(names, base, started=None, wait=None):
+    """ a discovery function for names, which sets started once it is running, and waits for wait after
+    the first chart before finding the rest """
+    def find(store):
+        if started is not None:
+            started.set()
+        for i, name in enumerate(names):
+            if i == 1 and wait is not None and not wait.wait(5):
+                raise TimeoutError('not running at the same time')
+            store(name, base + name + '.zip')
+    return find
+
+
+def broken_source(store):
+    store('arctic060803', NIC_BASE + '&fName=arctic060803.zip')
+    raise ConnectionError('site is down')
+
+
+def test_pipeline():
+    nic = ['arctic0608{0:02d}'.format(d) for d in range(1, 11)]
+    cis = ['rgc_a13_197301{0:02d}_CEXPRGL'.format(d) for d in range(1, 11)]
+    nic_started, cis_started, first_stored = threading.Event(), threading.Event(), threading.Event()
+    stored = []
+
+    def store(chart):
+        stored.append(chart)
+        first_stored.set()
+
+    # each source waits for the other to start, and NIC for its first chart to be stored, which only happens
+    # if all the stages run at the same time
+    stats = run_pipeline({'NIC': source(nic, NIC_BASE + '&fName=', nic_started, first_stored),
+                          'CIS': source(cis, CIS_BASE, cis_started, nic_started)}, store, queue_size=2)
+    assert stats['NIC'] == 10
+    assert stats['CIS'] == 10
+    assert stats['Stored'] == 20
+    assert stats['Errors'] == {}
+    assert sorted(c.name for c in stored) == sorted(nic + cis)
+    assert {c.source for c in stored} == {'NIC', 'CIS'}
+
+
+def test_pipeline_failures():
+    stored = []
+    with pytest.raises(Exception) as failed:
+        run_pipeline({'NIC': broken_source, 'CIS': source(['not_a_chart'], CIS_BASE)}, stored.append)
+    # the failure is raised once the charts that were found are stored
+    assert type(failed.value).__name__ == 'DiscoveryError'
+    assert list(failed.value.errors) == ['NIC']
+    stats = failed.value.stats
+    assert stats['NIC'] == 1
+    assert stats['CIS'] == 1
+    assert stats['Failed'] == 1
+    assert [c.name for c in stored] == ['arctic060803']
+
+
+def test_pipeline_store_fails():
+    cis = ['rgc_a13_1973{0:02d}{1:02d}_CEXPRGL'.format(m, d) for m in range(1, 13) for d in range(1, 29)]
+    finished = threading.Event()
+
+    def find(store):
+        try:
+            source(cis, CIS_BASE)(store)
+        finally:
+            finished.set()
+
+    def store(chart):
+        if chart.name == cis[2]:
+            raise OSError('disk full')
+
+    # the error stops the other stages, which would otherwise stay blocked on the full queues
+    with pytest.raises(OSError, match='disk full'):
+        run_pipeline({'CIS': find}, store, queue_size=2)
+    assert finished.is_set()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Test reading zip files with range requests
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import io
+import random
+import zipfile
+import pytest
+from src.cache import CACHE_DIR_ENV
+from src.remotezip import RemoteFile, RangeNotSupported, read_shapefile
+from src.utility import get_zipshape_bbox, transfer
+
+POLAR = [(-1e6, -1e6), (1e6, -1e6), (1e6, 1e6), (-1e6, 1e6), (-1e6, -1e6)]
+
+
+def ranged_file(body):
+    """ a route serving body that supports range requests """
+    return lambda request: (200, {'Content-Type': 'application/zip', 'Accept-Ranges': 'bytes'}, body)
+
+
+def bigchart(shapezip):
+    """ a chart with plenty of attributes, which are not needed for the geometry """
+    rings = [[(x, y), (x + 1e4, y), (x + 1e4, y + 1e4), (x, y)] for x in range(-10 ** 6, 10 ** 6, 10 ** 5)
+             for y in range(-10 ** 6, 10 ** 6, 10 ** 5)]
+    rnd = random.Random(1)
+    notes = [' '.join('{0}={1:02d}'.format(k, rnd.randrange(100)) for k in ('CT', 'CA', 'SA', 'FA') * 8)
+             for _ in range(len(rings) + 1)]
+    return shapezip([POLAR] + rings, notes=notes)
+
+
+def test_remotefile(stubserver):
+    body = bytes(range(256)) * 400
+    stubserver.routes['/f'] = ranged_file(body)
+    remote = RemoteFile(stubserver.url + '/f', tail=1000, readahead=100)
+    assert remote.size == len(body)
+    assert remote.bytes_read == 1000
+    remote.seek(-10, 2)
+    assert remote.read() == body[-10:]
+    assert remote.requests == 1
+    remote.seek(5)
+    assert remote.read(3) == body[5:8]
+    # only the part we don't already have is requested
+    assert remote.read(200) == body[8:208]
+    assert remote.requests == 3
+    assert remote.bytes_read == 1000 + 100 + 103
+    assert remote.bytes_saved == len(body) - remote.bytes_read
+
+
+def test_remotefile_norange(stubserver):
+    stubserver.routes['/f'] = lambda request: (200, {}, b'x' * 100000)
+    with pytest.raises(RangeNotSupported):
+        RemoteFile(stubserver.url + '/f')
+
+
+def test_remotefile_short(stubserver):
+    body = bytes(range(256)) * 400
+
+    def short(request):
+        # a range response with less than was asked for
+        start = int(request.headers['Range'].split('=')[1].split('-')[0] or len(body) - 1000)
+        return 206, {'Content-Range': 'bytes {0}-{1}/{2}'.format(start, start + 9, len(body))}, body[start:start + 10]
+
+    stubserver.routes['/f'] = short
+    remote = RemoteFile(stubserver.url + '/f', tail=1000)
+    remote.seek(100)
+    with pytest.raises(RangeNotSupported, match='less than'):
+        remote.read(100)
+
+
+def test_remotefile_changed(stubserver):
+    versions = [bytes(range(256)) * 400, bytes(range(255, -1, -1)) * 400]
+
+    def changing(request):
+        # a new version after the first request, the server sends all of it if If-Range doesn't match
+        body, etag = (versions[0], '"v1"') if not stubserver.requests[:-1] else (versions[1], '"v2"')
+        headers = {'Content-Type': 'application/zip', 'ETag': etag}
+        if request.headers.get('If-Range', etag) == etag:
+            headers['Accept-Ranges'] = 'bytes'
+        return 200, headers, body
+
+    stubserver.routes['/f'] = changing
+    remote = RemoteFile(stubserver.url + '/f', tail=1000)
+    assert remote.validator == '"v1"'
+    with pytest.raises(RangeNotSupported, match='changed'):
+        remote.read(100)
+    assert stubserver.requests[-1][2]['If-Range'] == '"v1"'
+
+
+def test_read_shapefile(stubserver, shapezip):
+    data = bigchart(shapezip)
+    stubserver.routes['/chart.zip'] = ranged_file(data)
+    shpfile, members, remote = read_shapefile(stubserver.url + '/chart.zip')
+    assert shpfile == 'chart.shp'
+    assert sorted(zipfile.ZipFile(io.BytesIO(members)).namelist()) == \
+        ['chart.prj', 'chart.shp', 'chart.shx']
+    # the tail, then one request for the members
+    assert remote.requests == 2
+    assert remote.bytes_read + remote.bytes_saved == len(data)
+    assert remote.bytes_saved > 0
+
+
+def test_zipshape_ranged(stubserver, shapezip, monkeypatch):
+    monkeypatch.delenv(CACHE_DIR_ENV, raising=False)
+    data = bigchart(shapezip)
+    stubserver.routes['/ranged.zip'] = ranged_file(data)
+    stubserver.routes['/plain.zip'] = lambda request: (200, {}, data)
+    saved = transfer['Bytes Saved']
+    ranged = get_zipshape_bbox(stubserver.url + '/ranged.zip')
+    assert transfer['Bytes Saved'] > saved
+    # falls back to a full download, giving the same answer
+    assert get_zipshape_bbox(stubserver.url + '/plain.zip') == ranged
+    assert ranged['bbox'][3] == 90.0
+    assert [r[1] for r in stubserver.requests].count('/plain.zip') == 2
@@ -29,8 +29,14 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import os
+import datetime
+import pytest
 from urllib.parse import urlparse
-from src.scrapers import gogetnicdata, gogetcisdata
+from selenium.common.exceptions import WebDriverException
+from src.scrapers import gogetnicdata, gogetcisdata, BrowserPool, CISArchiveClient, CISSearchError, KnownCharts, \
+    cis_searchpage, search_windows
+from src.cache import MemoryResponseCache
 
 
 def uri_validator(x):
@@ -54,3 +60,235 @@ def test_cisscraper():
     assert len(links) > 0
     assert 'rgc_a09_20201214_CEXPRHB' in links[0]
     assert uri_validator(links[0][1]) is True
+
+
+class FakeBrowser:
+    """ records what the pool does with a browser """
+
+    def __init__(self):
+        self.pages = []
+        self.cookies_cleared = 0
+        self.quit_called = False
+
+    def delete_all_cookies(self):
+        self.cookies_cleared += 1
+
+    def get(self, url):
+        self.pages.append(url)
+
+    def quit(self):
+        self.quit_called = True
+
+
+def test_browserpool_reuse():
+    started = []
+
+    def factory():
+        started.append(FakeBrowser())
+        return started[-1]
+
+    with BrowserPool(1, factory=factory) as pool:
+        with pool.session() as first:
+            pass
+        with pool.session() as second:
+            pass
+    # one browser is started and reset to the search page for each session
+    assert len(started) == 1
+    assert first is second
+    assert first.pages == [cis_searchpage, cis_searchpage]
+    assert first.cookies_cleared == 2
+    assert first.quit_called
+
+
+def test_browserpool_size():
+    started = []
+
+    def factory():
+        started.append(FakeBrowser())
+        return started[-1]
+
+    pool = BrowserPool(2, factory=factory)
+    with pool.session() as first:
+        with pool.session() as second:
+            assert first is not second
+    with pool.session():
+        pass
+    assert len(started) == 2
+
+    # a browser that fails is shut down and replaced
+    with pytest.raises(WebDriverException):
+        with pool.session() as broken:
+            raise WebDriverException('browser crashed')
+    assert broken.quit_called
+    assert len(pool.browsers) == 1
+    pool.close()
+    assert all(b.quit_called for b in started)
+
+
+def test_browserpool_start_fails():
+    started = []
+
+    def factory():
+        # the pool can be used by other threads while a browser starts
+        assert not pool.lock.locked()
+        if not started:
+            started.append(None)
+            raise WebDriverException('no geckodriver')
+        started.append(FakeBrowser())
+        return started[-1]
+
+    pool = BrowserPool(1, factory=factory)
+    with pytest.raises(WebDriverException):
+        with pool.session():
+            pass
+    # the place in the pool is given back, so a browser can be started next time
+    assert pool.starting == 0 and pool.browsers == []
+    with pool.session() as driver:
+        assert driver is started[-1]
+    pool.close()
+
+
+CIS_PAGES = os.path.join(os.path.dirname(__file__), 'data', 'cis')
+
+
+def cis_page(name):
+    with open(os.path.join(CIS_PAGES, name)) as f:
+        return f.read()
+
+
+def cis_archive(request):
+    """ replay the recorded CIS archive pages """
+    if request.command == 'GET':
+        return 200, {'Content-Type': 'text/html'}, cis_page('search.html')
+    form = request.form
+    if form.get('javax.faces.ViewState') == 'vs0' and 'submitBtnId' in form:
+        assert form['itemsperpage'] == '200'
+        assert form['j_id_26:5:j_id_28'] == 'on'
+        assert form['j_id_2b'] == 'on'
+        assert 'j_id_26:0:j_id_28' not in form
+        assert request.body.decode().count('selRgnSelId=') == 6
+        request.server.search = (form['fromYear'], form['fromMonth'], form['fromDay'],
+                                 form['toYear'], form['toMonth'], form['toDay'])
+        return 200, {'Content-Type': 'text/html'}, cis_page('results1.html')
+    if form.get('javax.faces.ViewState') == 'vs1' and form.get('j_id_3a:_idcl') == 'j_id_3a:next':
+        return 200, {'Content-Type': 'text/html'}, cis_page('results2.html')
+    return 500, {}, 'unexpected request'
+
+
+def test_cisclient(stubserver):
+    stubserver.routes['/Archive/page1.xhtml'] = cis_archive
+    client = CISArchiveClient(stubserver.url + '/Archive/page1.xhtml?lang=en')
+    stored = []
+    links = client.search(2001, 12, 14, 5, storefunc=lambda name, lnk: stored.append(name))
+    assert stubserver.search == ('2001', '12', '14', '2006', '12', '14')
+    assert len(links) == 6
+    assert links[0][0] == 'rgc_a09_20201214_CEXPRHB'
+    assert links[0][1] == 'https://ice-glaces.ec.gc.ca/www_archive/AOI_09/Coverages/rgc_a09_20201214_CEXPRHB.zip'
+    assert links[-1][0] == 'rgc_a09_20201221_CEXPRHB'
+    assert stored == [lnk[0] for lnk in links]
+    assert all(uri_validator(lnk[1]) for lnk in links)
+    # one page for the form, one to submit it and one for the second page of results
+    assert len(stubserver.requests) == 3
+
+
+def test_cisclient_errors(stubserver):
+    stubserver.routes['/Archive/page1.xhtml'] = lambda request: (200, {}, '<html><body>Maintenance</body></html>')
+    client = CISArchiveClient(stubserver.url + '/Archive/page1.xhtml')
+    with pytest.raises(CISSearchError):
+        client.search(2020, 12, 14)
+
+
+def test_cisdata_retry(stubserver, monkeypatch):
+    url = stubserver.url + '/Archive/page1.xhtml?lang=en'
+    stubserver.routes['/Archive/page1.xhtml'] = cis_archive
+    links = CISArchiveClient(url).search(2020, 12, 14)
+
+    def second_page_fails(request):
+        if request.command == 'POST' and request.form.get('j_id_3a:_idcl') == 'j_id_3a:next':
+            return 500, {}, 'unavailable'
+        return cis_archive(request)
+
+    def browser_search(*args, storefunc=None, **kwargs):
+        for name, lnk in links:
+            storefunc(name, lnk)
+        return links
+
+    stubserver.routes['/Archive/page1.xhtml'] = second_page_fails
+    monkeypatch.setattr('src.scrapers.CISArchiveClient', lambda: CISArchiveClient(url))
+    monkeypatch.setattr('src.scrapers.query_cis_form', browser_search)
+    stored = []
+    # the charts on the first page are found by both searches, but only stored once
+    found = gogetcisdata(startyear=datetime.date.today().year, storefunc=lambda name, lnk: stored.append(name))
+    assert found == links
+    assert sorted(stored) == sorted(lnk[0] for lnk in links)
+
+
+def test_knowncharts():
+    links = [('a{0}'.format(i), 'https://example.com/a{0}.zip'.format(i)) for i in range(10)]
+    known = KnownCharts({'a1', 'a3', 'a4', 'a5', 'a7'}, stop_after=3)
+    assert [name for name, lnk in known.new(links)] == ['a0', 'a2']
+    assert known.skipped == 4
+    known = KnownCharts(['a1', 'a3', 'a4', 'a5', 'a7'], stop_after=0)
+    assert [name for name, lnk in known.new(links)] == ['a0', 'a2', 'a6', 'a8', 'a9']
+    assert 'a7' in known
+
+
+def test_cisclient_known(stubserver):
+    stubserver.routes['/Archive/page1.xhtml'] = cis_archive
+    client = CISArchiveClient(stubserver.url + '/Archive/page1.xhtml?lang=en')
+    known = KnownCharts({'rgc_a10_20201214_CEXPRWA'}, stop_after=0)
+    links = client.search(2020, 12, 14, known=known)
+    assert len(links) == 5
+    assert 'rgc_a10_20201214_CEXPRWA' not in [lnk[0] for lnk in links]
+    # once the whole first page is known there is no need to get the second one
+    stubserver.requests.clear()
+    known = KnownCharts({'rgc_a09_20201214_CEXPRHB', 'rgc_a10_20201214_CEXPRWA', 'rgc_a11_20201214_CEXPREA'},
+                        stop_after=3)
+    links = client.search(2020, 12, 14, known=known)
+    assert links == []
+    assert len(stubserver.requests) == 2
+
+
+def nic_search(request):
+    """ a NIC search result with one chart on the first day of the search """
+    start = datetime.datetime.strptime(request.form['startDate'], '%m/%d/%Y')
+    name = ('arctic' if request.form['searchText'] == 'WeeklyArctic' else 'antarc') + start.strftime('%y%m%d') + '.zip'
+    body = '<html><body><a href="/File/DownloadProduct?fName={0}">{0}</a></body></html>'.format(name)
+    headers = {'ETag': '"' + name + '"'}
+    if request.headers.get('If-None-Match') == headers['ETag']:
+        return 304, headers, b''
+    return 200, headers, body
+
+
+def test_nicscraper_cache(stubserver, monkeypatch):
+    stubserver.routes['/Products/DisplaySearchResults'] = nic_search
+    monkeypatch.setattr('src.scrapers.nic_basesite_new', stubserver.url + '/Products/DisplaySearchResults')
+    cache = MemoryResponseCache(ttl=0)
+    # a full fill, the years that are over then the rest for each hemisphere
+    links = gogetnicdata(startyear=1968, startmonth=6, startday=25, cache=cache)
+    recent = list(search_windows(datetime.date(1968, 6, 25), datetime.date.today()))[1][0].strftime('%y%m%d')
+    assert [lnk[0] for lnk in links] == ['arctic680625', 'arctic' + recent, 'antarc680625', 'antarc' + recent]
+    assert len(stubserver.requests) == 4
+
+    # the second time, only the searches for the recent dates are repeated, and are answered from the cache
+    stubserver.requests.clear()
+    assert gogetnicdata(startyear=1968, startmonth=6, startday=25, cache=cache) == links
+    assert len(stubserver.requests) == 2
+    assert all(req[2]['If-None-Match'] for req in stubserver.requests)
+
+    # a fresh response is used without asking the server at all
+    stubserver.requests.clear()
+    cache.ttl = 3600
+    assert gogetnicdata(startyear=1968, startmonth=6, startday=25, cache=cache) == links
+    assert len(stubserver.requests) == 0
+
+
+def test_searchwindows():
+    windows = list(search_windows(datetime.date(1968, 6, 25), datetime.date(2020, 2, 1)))
+    # 60 days before the end is in 2019
+    assert windows == [(datetime.date(1968, 6, 25), datetime.date(2018, 12, 31)),
+                       (datetime.date(2019, 1, 1), datetime.date(2020, 2, 1))]
+    assert list(search_windows(datetime.date(2020, 1, 10), datetime.date(2020, 6, 1))) == \
+        [(datetime.date(2020, 1, 10), datetime.date(2020, 6, 1))]
+    assert list(search_windows(datetime.date(2019, 6, 1), datetime.date(2020, 6, 1))) == \
+        [(datetime.date(2019, 6, 1), datetime.date(2019, 12, 31)), (datetime.date(2020, 1, 1), datetime.date(2020, 6, 1))]
@@ -30,9 +30,12 @@
 ###############################################################################
 
 import pytest
+import sqlite3
 import datetime
+import json
+from concurrent.futures import ThreadPoolExecutor
 from src.stackdb import StackDB
-from src.icechart import IceChart
+from src.icechart import IceChart, GEO_BBOX, GEO_EXACT
 
 
 @pytest.fixture(scope='function')
@@ -127,3 +130,347 @@ def test_getlast(additems):
     last = db.getlast(source='CIS')
     assert type(last) is datetime.datetime
     assert last.year == 2020
+
+
+def cischarts(count):
+    """ make some CIS charts on consecutive days """
+    day = datetime.datetime(1990, 1, 1)
+    charts = []
+    for i in range(count):
+        name = 'rgc_a13_{0}_CEXPRGL'.format((day + datetime.timedelta(days=i)).strftime('%Y%m%d'))
+        charts.append(IceChart.from_name(name, 'https://ice-glaces.ec.gc.ca/www_archive/AOI_13/Coverages/' + name + '.e00'))
+    return charts
+
+
+def test_additems(createdb):
+    db = createdb
+    assert db.add_items(cischarts(25), batch_size=10) == 25
+    assert db.summary()['Total Items'] == 25
+    # adding the same charts again replaces them
+    assert db.add_items(cischarts(25)) == 25
+    assert db.summary()['Total Items'] == 25
+
+
+def test_batch(createdb):
+    db = createdb
+    with db.batch(batch_size=10) as batch:
+        for chart in cischarts(5):
+            batch.add(chart)
+        batch.add_from_name('rgc_a10_20071015_CEXPRWA',
+                            'https://ice-glaces.ec.gc.ca/www_archive/AOI_10/Coverages/rgc_a10_20071015_CEXPRWA.e00')
+        # nothing is written until the batch is full or the context exits
+        assert batch.count == 0
+    assert batch.count == 6
+    assert db.summary()['Total Items'] == 6
+
+    # a bad row rolls back its whole batch
+    bad = cischarts(13)[5:]
+    bad[-1].name = None
+    with pytest.raises(sqlite3.IntegrityError):
+        db.add_items(bad, batch_size=4)
+    assert db.summary()['Total Items'] == 6 + 4
+
+
+def test_knownnames(additems):
+    db = additems
+    names = db.known_names()
+    assert len(names) == 8
+    assert 'arctic060803' in names
+    assert db.known_names('CIS') == {'rgc_a13_19730102_CEXPRGL', 'rgc_a10_20071015_CEXPRWA',
+                                     'rgc_a11_20200120_CEXPREA', 'rgc_a11_20201207_CEXPREA'}
+
+
+def test_geometry_cache(createdb):
+    db = createdb
+    exact = {'crs': 'WKT', 'bbox': [-1, -1, 1, 1], 'geometry': {'type': 'Polygon', 'coordinates': []}}
+    hull = db.geometry_cache()
+    assert hull.get('a.zip') is None
+    hull.put('a.zip', 'etag:"1"', exact)
+    hull.put('b.zip', 'etag:"2"', dict(exact, exact=False))
+    assert hull.get('a.zip') == ('etag:"1"', exact)
+    # only charts with exact geometry are good enough for the outline
+    assert hull.get('b.zip') is None
+    assert db.geometry_cache('bbox').get('b.zip') == ('etag:"2"', dict(exact, exact=False))
+    hull.put('a.zip', 'etag:"3"', exact)
+    assert hull.get('a.zip')[0] == 'etag:"3"'
+
+    # with a batch, entries are written along with the items
+    with db.batch(batch_size=10) as batch:
+        cache = db.geometry_cache(batch=batch)
+        cache.put('c.zip', 'size:10;modified:', exact)
+        assert hull.get('c.zip') is None
+    assert hull.get('c.zip') == ('size:10;modified:', exact)
+
+
+def test_iteritems(additems):
+    db = additems
+    rows = list(db.iter_items(chunk=3))
+    assert len(rows) == db.count_items() == 8
+    keys = [(row['source'], row['region'], row['epoch']) for row in rows]
+    assert keys == sorted(keys)
+    assert [row['name'] for row in db.iter_items(source='NIC', chunk=2)] == \
+        [row['name'] for row in sorted(db.get_items(source='NIC'), key=lambda r: (r['region'], r['epoch']))]
+    # start after a row from an earlier run
+    assert list(db.iter_items(after=keys[4], chunk=2)) == rows[5:]
+    # or in reverse, which is newest first for each region as with get_stac_items
+    newest = list(db.iter_items(source='CIS', chunk=1, newest_first=True))
+    assert [(row['region'], row['epoch']) for row in newest] == \
+        sorted([(row['region'], row['epoch']) for row in db.get_items(source='CIS')], reverse=True)
+    assert list(db.iter_stac_items(source='CIS', chunk=1)) == [row['stac'] for row in newest]
+    assert list(db.iter_stac_items(source='CIS', region='Eastern Arctic', chunk=1)) == \
+        [row[0] for row in db.get_stac_items(source='CIS', region='Eastern Arctic')]
+    assert list(db.iter_stac_items(year=1973)) == [row[0] for row in db.get_stac_items(year=1973)]
+    item = next(db.iter_stac_items(year=1973, decode=True))
+    assert item.id == 'rgc_a13_19730102_CEXPRGL'
+
+    charts = list(db.iter_items(source='CIS', charts=True))
+    assert all(type(chart).__name__ == 'IceChart' for chart in charts)
+    assert charts[0].stac.id == charts[0].name
+
+
+def test_iteritems_write(createdb):
+    db = createdb
+    db.add_items(cischarts(25))
+    assert db.count_items(exactgeo='False') == 25
+    # the table can be written while it is being read, each row is seen once
+    names = []
+    with db.batch(batch_size=3) as batch:
+        for chart in db.iter_items(exactgeo='False', chunk=4, charts=True):
+            names.append(chart.name)
+            chart.exactgeo = True
+            batch.add(chart)
+    assert names == [chart.name for chart in cischarts(25)]
+    assert db.count_items(exactgeo='False') == 0
+    assert db.count_items(exactgeo='True') == 25
+
+
+def test_bbox_only(createdb):
+    db = createdb
+    charts = cischarts(3)
+    charts[0].exactgeo = GEO_BBOX
+    charts[1].exactgeo = GEO_EXACT
+    db.add_items(charts)
+    # a bounding box still wants the outline, but not another bounding box
+    assert [c.name for c in db.iter_items(exactgeo='False', charts=True)] == [charts[0].name, charts[2].name]
+    assert [c.name for c in db.iter_items(exactgeo='None', charts=True)] == [charts[2].name]
+    assert db.count_items(exactgeo='True') == 1
+    assert 'USING INDEX items_pending' in query_plans(db, lambda: db.count_items(exactgeo='None'))[0]
+
+
+def query_plans(db, func):
+    """ call func, and return the query plan of each SELECT it runs on db """
+    sqls = []
+    db.conn.set_trace_callback(sqls.append)
+    try:
+        func()
+    finally:
+        db.conn.set_trace_callback(None)
+    return [' '.join(row[3] for row in db.query('EXPLAIN QUERY PLAN ' + sql, fetch=True))
+            for sql in sqls if sql.startswith('SELECT')]
+
+
+def test_indexes(additems):
+    db = additems
+    # each chunk is read from the index, without sorting
+    for plan in query_plans(db, lambda: list(db.iter_items(chunk=2))):
+        assert plan.startswith('SEARCH items USING INDEX items_source_region_epoch') or \
+            plan.startswith('SCAN items USING INDEX items_source_region_epoch ')
+    for plan in query_plans(db, lambda: list(db.iter_stac_items(source='CIS', chunk=2))):
+        assert 'USING INDEX items_source_region_epoch (source=?' in plan and 'TEMP B-TREE' not in plan
+    plans = query_plans(db, lambda: db.get_stac_items(source='CIS', region='Eastern Arctic', year=2020))
+    assert plans[0].startswith('SEARCH items USING INDEX items_source_region_year (source=? AND region=? AND year=?)')
+    for plan in query_plans(db, lambda: list(db.iter_stac_items(source='CIS', region='Eastern Arctic', year=2020, chunk=1))):
+        assert plan.startswith('SEARCH items USING INDEX items_source_region_year') and 'TEMP B-TREE' not in plan
+    # only the charts without exact geometry are read
+    for plan in query_plans(db, lambda: list(db.iter_items(exactgeo='False', chunk=2))):
+        assert 'USING INDEX items_pending' in plan and 'TEMP B-TREE' not in plan
+    assert 'USING INDEX items_pending' in query_plans(db, lambda: db.count_items(exactgeo='False'))[0]
+    # the rest only read an index
+    assert query_plans(db, lambda: db.getlast('CIS')) == \
+        ['SEARCH items USING COVERING INDEX sqlite_autoindex_items_1 (source=?)']
+    assert query_plans(db, lambda: db.known_names('CIS')) == ['SEARCH items USING COVERING INDEX items_source_name (source=?)']
+    for plan in query_plans(db, db.summary):
+        assert 'USING COVERING INDEX' in plan and 'TEMP B-TREE' not in plan
+
+
+def test_migration(tmp_path):
+    # a database made before the schema version was kept is updated when it is opened
+    dbname = str(tmp_path / 'old.sqlite')
+    conn = sqlite3.connect(dbname)
+    conn.execute('CREATE TABLE items (name TEXT NOT NULL, href TEXT NOT NULL, source TEXT NOT NULL, region TEXT NOT NULL,'
+                 'epoch timestamp NOT NULL, format TEXT NOT NULL, stac TEXT NOT NULL, exactgeo INTEGER NOT NULL,'
+                 'UNIQUE(source, epoch, region));')
+    chart = cischarts(1)[0]
+    conn.execute('INSERT INTO items VALUES(?,?,?,?,?,?,?,?);',
+                 (chart.name, chart.href, chart.source, chart.region, '1990-12-31 18:30:00', chart.format, chart.to_json(), 0))
+    conn.commit()
+    conn.close()
+    with StackDB(dbname) as db:
+        assert db.query('PRAGMA user_version;', fetch=True)[0][0] == 5
+        indexes = {row[0] for row in db.query("SELECT name FROM sqlite_master WHERE type = 'index';", fetch=True)}
+        assert {'items_source_region_epoch', 'items_source_region_year', 'items_pending', 'items_source_name'} <= indexes
+        assert db.query('SELECT epoch, year FROM items;', fetch=True)[0][:] == (datetime.datetime(1990, 12, 31, 18, 30), 1990)
+        assert db.getlast('CIS') == datetime.datetime(1990, 12, 31, 18, 30)
+        # a chart late on the last day of the year is in that year
+        assert len(db.get_stac_items(year=1990)) == 1
+        assert json.loads(db.get_stac_items(year=1990)[0][0]) == json.loads(chart.to_json())
+        assert db.summary()['CIS Date Range'] == [1990, 1990]
+        db.add_items(cischarts(5)[1:])
+        assert db.count_items(exactgeo='False', epoch1='1990-01-02', epoch2=datetime.datetime(1990, 1, 4)) == 3
+    # and only once
+    with StackDB(dbname) as db:
+        assert db.count_items() == 5
+
+
+def test_newer_schema(tmp_path):
+    dbname = str(tmp_path / 'newer.sqlite')
+    conn = sqlite3.connect(dbname)
+    conn.execute('PRAGMA user_version = 99;')
+    conn.close()
+    with pytest.raises(sqlite3.DatabaseError, match='version 99 is newer'):
+        StackDB(dbname)
+    # and it is left as it was
+    conn = sqlite3.connect(dbname)
+    assert conn.execute("SELECT count(*) FROM sqlite_master;").fetchone()[0] == 0
+    conn.close()
+
+
+def test_shared_geometry(additems):
+    db = additems
+    # the charts from the same region share their outline and CRS, only the CIS regions have a projected outline
+    assert db.query('SELECT count(*) FROM geometries;', fetch=True)[0][0] == 3 * 2 + 2
+    assert db.query('SELECT count(*) FROM crs;', fetch=True)[0][0] == 3
+    chart = IceChart.from_name('rgc_a11_20200120_CEXPREA',
+                               'https://ice-glaces.ec.gc.ca/www_archive/AOI_11/Coverages/rgc_a11_20200120_CEXPREA.zip')
+    stored = db.query("SELECT stac FROM items WHERE name = 'rgc_a11_20200120_CEXPREA';", fetch=True)[0][0]
+    assert len(stored) < len(chart.to_json()) / 2
+    assert json.loads(db.get_items(source='CIS', epoch1='2020-01-20')[0]['stac']) == json.loads(chart.to_json())
+
+    # a chart with geometry of its own
+    chart.set_geometry({'crs': 'LOCAL_CS["test"]', 'bbox': [-60, 60, -50, 70],
+                        'geometry': {'type': 'Polygon', 'coordinates': [[[-60, 60], [-50, 60], [-50, 70], [-60, 60]]]},
+                        'pbbox': [0, 0, 1, 1],
+                        'pgeometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}})
+    with db.batch() as batch:
+        batch.add(chart)
+    assert db.query('SELECT count(*) FROM geometries;', fetch=True)[0][0] == 3 * 2 + 2 + 2
+    assert db.query('SELECT count(*) FROM crs;', fetch=True)[0][0] == 4
+    row = db.get_items(source='CIS', epoch1='2020-01-20')[0]
+    assert row['exactgeo'] == 1
+    assert json.loads(row['stac']) == json.loads(chart.to_json())
+    assert IceChart.from_row(row).stac.geometry == chart.stac.geometry
+
+
+def test_compress(additems):
+    db = additems
+    stacs = {row['name']: row['stac'] for row in db.iter_items()}
+    db.compress()
+    assert db.query("SELECT count(*) FROM items WHERE typeof(stac) = 'blob';", fetch=True)[0][0] == 8
+    assert {row['name']: row['stac'] for row in db.iter_items()} == stacs
+    with db.batch() as batch:
+        for chart in cischarts(5):
+            batch.add(chart)
+    db.add_item(cischarts(6)[-1])
+    assert db.query("SELECT count(*) FROM items WHERE typeof(stac) = 'text';", fetch=True)[0][0] == 0
+    assert db.query("SELECT count(*) FROM geometries WHERE typeof(geometry) = 'text';", fetch=True)[0][0] == 0
+    assert json.loads(db.get_stac_items(year=1990)[0][0]) == json.loads(cischarts(6)[-1].to_json())
+
+    # only reading the items themselves decompresses them
+    inflated = []
+    db.conn.create_function('inflate', 1, lambda value: inflated.append(value) or db.inflate(value))
+    db.summary()
+    db.getlast('CIS')
+    db.known_names('CIS')
+    assert db.count_items(year=1990) == 6
+    assert inflated == []
+    assert len(db.get_stac_items(year=1990)) == 6
+    assert len(inflated) == 6 * 3
+
+    db.compress(False)
+    assert db.zdict is None
+    assert db.query("SELECT count(*) FROM items WHERE typeof(stac) = 'blob';", fetch=True)[0][0] == 0
+    assert {row['name']: row['stac'] for row in db.iter_items() if row['name'] in stacs} == stacs
+
+
+def test_compress_reopen(tmp_path):
+    dbname = str(tmp_path / 'compressed.sqlite')
+    with StackDB(dbname) as db:
+        db.compress()
+        db.add_items(cischarts(3))
+    # the dictionary is kept with the database, and new items are compressed too
+    with StackDB(dbname) as db:
+        assert db.zdict is not None
+        db.add_items(cischarts(5)[3:])
+        assert db.query("SELECT count(*) FROM items WHERE typeof(stac) = 'blob';", fetch=True)[0][0] == 5
+        assert [json.loads(row['stac']) for row in db.iter_items()] == [json.loads(chart.to_json()) for chart in cischarts(5)]
+
+
+def test_wal(tmp_path):
+    dbname = str(tmp_path / 'wal.sqlite')
+    with StackDB(dbname) as db:
+        assert db.query('PRAGMA journal_mode;', fetch=True)[0][0] == 'wal'
+        assert db.query('PRAGMA synchronous;', fetch=True)[0][0] == 1
+        db.add_items(cischarts(3))
+        # the errors of the writer thread are raised by the thread that made the write
+        bad = cischarts(4)[-1]
+        bad.name = None
+        with pytest.raises(sqlite3.IntegrityError):
+            db.add_item(bad)
+        assert db.count_items() == 3
+
+
+def test_threads(tmp_path):
+    dbname = str(tmp_path / 'threads.sqlite')
+    charts = cischarts(40)
+    with StackDB(dbname) as db:
+
+        def fill(part):
+            # each thread reads with its own connection while the others write
+            with db.batch(batch_size=3) as batch:
+                for chart in charts[part::4]:
+                    batch.add(chart)
+                    assert db.count_items() <= 40
+            return batch.count
+
+        with ThreadPoolExecutor(4) as pool:
+            assert sum(pool.map(fill, range(4))) == 40
+        assert [row['name'] for row in db.iter_items()] == [chart.name for chart in charts]
+
+
+def test_batch_errors(tmp_path):
+    dbname = str(tmp_path / 'errors.sqlite')
+    with StackDB(dbname) as db:
+        charts = cischarts(4)
+        charts[0].name = None
+        # the error from the first batch is raised, the second is still written
+        with pytest.raises(sqlite3.IntegrityError):
+            db.add_items(charts, batch_size=2)
+        assert db.known_names() == {chart.name for chart in charts[2:]}
+        # an error in the with block isn't replaced by the error writing a batch
+        charts = cischarts(7)[4:]
+        charts[0].name = None
+        with pytest.raises(KeyError):
+            with db.batch(batch_size=2) as batch:
+                for chart in charts:
+                    batch.add(chart)
+                raise KeyError('interrupted')
+        assert db.count_items() == 2 + 1
+
+
+def test_snapshot(tmp_path):
+    dbname = str(tmp_path / 'snapshot.sqlite')
+    with StackDB(dbname) as db, StackDB(dbname) as other:
+        db.add_items(cischarts(5))
+        with db.snapshot():
+            # items added meanwhile, here by another program, aren't seen until the snapshot ends
+            other.add_items(cischarts(10)[5:])
+            assert other.count_items() == 10
+            assert db.count_items() == 5
+            assert db.summary()['Total Items'] == 5
+            assert len(list(db.iter_stac_items(chunk=2))) == 5
+        assert db.count_items() == 10
+        # including the ones written by this database's writer thread
+        with db.snapshot():
+            db.add_items(cischarts(12)[10:])
+            assert db.count_items() == 10
+        assert db.count_items() == 12
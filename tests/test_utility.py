@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# $Id$
+#
+# Project:  Icechart STAC Service
+# Purpose:  Test utility functions
+# Author:   David Currie <dcurrie at geoanalytic dot com>
+#
+###############################################################################
+# Copyright (c) 2020, David Currie <dcurrie at geoanalytic dot com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import io
+import zipfile
+import numpy as np
+import pytest
+from shapely.geometry import box, mapping
+from src.cache import CACHE_DIR_ENV
+from src.utility import get_zipshape_bbox, get_zipshape_extent, download_bytes, open_zip, extract_bbox_shape, transfer, \
+    content_validator
+
+# a square around the north pole and a small one in Hudson Bay, in NSIDC polar stereographic metres
+POLAR = [(-1e6, -1e6), (1e6, -1e6), (1e6, 1e6), (-1e6, 1e6), (-1e6, -1e6)]
+HUDSON = [(-2.2e6, -3e5), (-2.1e6, -3e5), (-2.1e6, -2e5), (-2.2e6, -2e5), (-2.2e6, -3e5)]
+
+
+@pytest.fixture
+def nocache(monkeypatch):
+    monkeypatch.delenv(CACHE_DIR_ENV, raising=False)
+
+
+def serve(server, path, body):
+    server.routes[path] = lambda request: (200, {'Content-Type': 'application/zip'}, body)
+    return server.url + path
+
+
+def test_download_bytes(stubserver, tmp_path):
+    href = serve(stubserver, '/a.zip', b'x' * 1000)
+    assert download_bytes(href, limit=1000) == b'x' * 1000
+    spill = str(tmp_path / 'spill.zip')
+    assert download_bytes(href, limit=999, spillfile=spill) == spill
+    with open(spill, 'rb') as f:
+        assert f.read() == b'x' * 1000
+    # without a spillfile, a temporary file
+    with download_bytes(href, limit=999) as f:
+        assert f.read() == b'x' * 1000
+    assert download_bytes(stubserver.url + '/missing.zip') is None
+
+
+def test_content_validator(stubserver):
+    stubserver.routes['/etag.zip'] = lambda request: (200, {'ETag': '"abc"'}, b'x' * 10)
+    assert content_validator(stubserver.url + '/etag.zip') == 'etag:"abc"'
+    stubserver.routes['/size.zip'] = lambda request: (200, {'Last-Modified': 'Mon, 02 Jan 2006 00:00:00 GMT'}, b'x' * 10)
+    assert content_validator(stubserver.url + '/size.zip') == 'size:10;modified:Mon, 02 Jan 2006 00:00:00 GMT'
+    # servers that refuse HEAD get a GET, but the body is not read
+    stubserver.routes['/nohead.zip'] = lambda request: (405, {}, b'') if request.command == 'HEAD' else (
+        200, {'ETag': '"def"'}, b'x' * 10)
+    assert content_validator(stubserver.url + '/nohead.zip') == 'etag:"def"'
+    assert [r[0] for r in stubserver.requests[-2:]] == ['HEAD', 'GET']
+    assert content_validator(stubserver.url + '/missing.zip') is None
+
+
+def test_open_zip(shapezip):
+    data = shapezip([HUDSON])
+    zipfl = open_zip(data)
+    assert 'chart.shp' in zipfl.namelist()
+    info = zipfl.getinfo('chart.shp')
+    zipfl.close()
+    assert open_zip(b'not a zip') is None
+    # flip a byte inside the shapefile data so its CRC no longer matches
+    corrupt = bytearray(data)
+    corrupt[info.header_offset + 30 + len(info.filename) + info.compress_size // 2] ^= 0xff
+    assert open_zip(bytes(corrupt)) is None
+
+
+def test_zipshape_memory(stubserver, shapezip, tmp_path, nocache):
+    data = shapezip([POLAR, HUDSON])
+    href = serve(stubserver, '/chart.zip', data)
+    result = get_zipshape_bbox(href, ranged=False)
+    # the archive is only requested once
+    assert len(stubserver.requests) == 1
+    assert result['bbox'][3] == 90.0
+    assert result['pbbox'] == [-2.2e6, -1e6, 1e6, 1e6]
+    # the same as reading from disk
+    zipname = str(tmp_path / 'chart.zip')
+    with open(zipname, 'wb') as f:
+        f.write(data)
+    assert result == extract_bbox_shape('chart.shp', vfs='zip:' + zipname)
+
+
+def test_zipshape_spill(stubserver, shapezip, nocache):
+    data = shapezip([HUDSON])
+    href = serve(stubserver, '/chart.zip', data)
+    inmemory = get_zipshape_bbox(href, ranged=False)
+    assert get_zipshape_bbox(href, memory_limit=100, ranged=False) == inmemory
+    assert inmemory['bbox'][3] < 90
+
+
+def test_zipshape_errors(stubserver, nocache):
+    assert get_zipshape_bbox(serve(stubserver, '/bad.zip', b'not a zip')) is None
+    assert get_zipshape_bbox(stubserver.url + '/missing.zip') is None
+
+
+def ranged(server, path, body):
+    server.routes[path] = lambda request: (200, {'Accept-Ranges': 'bytes'}, body)
+    return server.url + path
+
+
+def test_zipshape_extent(stubserver, shapezip, nocache):
+    # lots of little squares, so the shapes take up most of the archive
+    corners = np.random.default_rng(1).uniform(-1e6, 1e6, (2000, 2))
+    data = shapezip([POLAR] + [[(x, y), (x + 1e3, y), (x + 1e3, y + 1e3), (x, y + 1e3), (x, y)] for x, y in corners])
+    href = ranged(stubserver, '/chart.zip', data)
+    read = transfer['Bytes Read']
+    extent = get_zipshape_extent(href)
+    # the directory, the .prj and the start of the .shp
+    assert transfer['Bytes Read'] - read < 16000 < len(data)
+    hull = get_zipshape_bbox(href, ranged=False)
+    assert extent['pbbox'] == hull['pbbox']
+    assert extent['pgeometry'] == mapping(box(*hull['pbbox']))
+    assert extent['bbox'][3] == 90.0
+    assert extent['bbox'][1] <= hull['bbox'][1]
+    assert not extent['exact']
+    assert 'exact' not in hull
+    # the CRS is read the same way for both
+    assert extent['crs'] == hull['crs'] == get_zipshape_bbox(href)['crs']
+    # the same without range requests
+    assert get_zipshape_extent(href, ranged=False) == extent
+    assert get_zipshape_extent(serve(stubserver, '/plain.zip', data)) == extent
+
+
+def test_zipshape_extent_cached(stubserver, shapezip, tmp_path, monkeypatch):
+    monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path / 'cache'))
+    href = serve(stubserver, '/chart.zip', shapezip([HUDSON]))
+    extent = get_zipshape_extent(href)
+    assert extent['pbbox'] == [-2.2e6, -3e5, -2.1e6, -2e5]
+    assert extent['bbox'][3] < 90
+    get_zipshape_extent(href)
+    assert len(stubserver.requests) == 1
+
+
+def test_zipshape_extent_errors(stubserver, shapezip, nocache):
+    # a shapefile without its projection
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zout:
+        zout.writestr('chart.shp', zipfile.ZipFile(io.BytesIO(shapezip([HUDSON]))).read('chart.shp'))
+    assert get_zipshape_extent(serve(stubserver, '/noprj.zip', buf.getvalue())) is None
+    assert get_zipshape_extent(serve(stubserver, '/bad.zip', b'not a zip')) is None
+    assert get_zipshape_extent(stubserver.url + '/missing.zip') is None